@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for GitMirroredRepo.
+
+Generates synthetic upstream repos locally, mirrors them over file:// and times every stage separately.
+The results are written as JSON, so scaling curves of different versions can be compared.
+
+    python3 benchmarks/bench_git_mirror.py --commits 100,1000,10000 --output bench.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from umbrella.git_mirror import GitMirroredRepo, UMBRELLA_CORE_VERSION  # noqa: E402
+
+
+def git(*args: str, cwd: typing.Union[str, None] = None, stdin: typing.Union[bytes, None] = None) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=cwd, input=stdin, stdout=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8").strip()
+
+
+def git_lfs_available() -> bool:
+    try:
+        git("lfs", "version")
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+
+def generate_upstream(
+        path: str,
+        commits: int,
+        files_per_commit: int,
+        blob_size: int,
+        branches: int,
+        tags: int,
+        lfs_objects: int,
+        lfs_object_size: int,
+        loose: bool,
+        seed: int,
+) -> None:
+    """
+    Create a bare repo with a synthetic history through `git fast-import`.
+    LFS objects are stored under `<path>/lfs/objects`, where git-lfs looks for them on a local (file://) remote.
+    """
+    rng = random.Random(seed)
+    git("init", "-q", "--bare", path)
+
+    stream: typing.List[bytes] = []
+
+    def data(content: bytes) -> None:
+        stream.append(f"data {len(content)}\n".encode("utf-8"))
+        stream.append(content)
+        stream.append(b"\n")
+
+    lfs_every = max(1, commits // lfs_objects) if lfs_objects else 0
+    lfs_count = 0
+    commit_marks: typing.List[int] = []
+    for i in range(commits):
+        mark = i + 1
+        commit_marks.append(mark)
+        stream.append(f"commit refs/heads/master\nmark :{mark}\n".encode("utf-8"))
+        stream.append(f"committer Bench <bench@example.com> {1500000000 + i} +0000\n".encode("utf-8"))
+        data(f"commit {i}".encode("utf-8"))
+        if i == 0:
+            stream.append(b"M 100644 inline .gitattributes\n")
+            data(b"*.bin filter=lfs diff=lfs merge=lfs -text\n" if lfs_objects else b"\n")
+        for _ in range(files_per_commit):
+            name = f"dir{rng.randrange(32)}/file{rng.randrange(files_per_commit * 8)}.txt"
+            stream.append(f"M 100644 inline {name}\n".encode("utf-8"))
+            data(rng.getrandbits(blob_size * 8).to_bytes(blob_size, "little") if blob_size else b"")
+        if lfs_every and i % lfs_every == 0 and lfs_count < lfs_objects:
+            content = rng.getrandbits(lfs_object_size * 8).to_bytes(lfs_object_size, "little")
+            oid = hashlib.sha256(content).hexdigest()
+            lfs_dir = os.path.join(path, "lfs", "objects", oid[0:2], oid[2:4])
+            os.makedirs(lfs_dir, exist_ok=True)
+            with open(os.path.join(lfs_dir, oid), "wb") as f:
+                f.write(content)
+            stream.append(f"M 100644 inline lfs/object{lfs_count}.bin\n".encode("utf-8"))
+            data(f"version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {len(content)}\n".encode("utf-8"))
+            lfs_count += 1
+
+    for kind, count in (("heads/branch", branches), ("tags/v", tags)):
+        for k in range(count):
+            mark = commit_marks[rng.randrange(len(commit_marks))]
+            stream.append(f"reset refs/{kind}{k}\nfrom :{mark}\n\n".encode("utf-8"))
+
+    git("fast-import", "--quiet", cwd=path, stdin=b"".join(stream))
+
+    if loose:
+        # unpack-objects skips objects that already exist, so the packs have to be moved out of the way first
+        packs_dir = os.path.join(path, "objects", "pack")
+        packs = []
+        for f in os.listdir(packs_dir):
+            with open(os.path.join(packs_dir, f), "rb") as pack:
+                if f.endswith(".pack"):
+                    packs.append(pack.read())
+            os.remove(os.path.join(packs_dir, f))
+        for pack in packs:
+            git("unpack-objects", "-q", cwd=path, stdin=pack)
+
+
+def timed(results: typing.Dict[str, float], phase: str, f: typing.Callable[[], typing.Any]) -> typing.Any:
+    start = time.perf_counter()
+    ret = f()
+    results[phase] = time.perf_counter() - start
+    return ret
+
+
+def run_case(workdir: str, case: typing.Dict[str, typing.Any], lfs: bool) -> typing.Dict[str, typing.Any]:
+    upstream = os.path.join(workdir, "upstream.git")
+    mirror = os.path.join(workdir, "mirror")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+
+    results: typing.Dict[str, float] = dict()
+    timed(results, "generate", lambda: generate_upstream(upstream, **case))
+    url = "file://" + os.path.abspath(upstream).replace(os.sep, "/")
+
+    m = timed(results, "init", lambda: GitMirroredRepo(mirror, url, git_lfs_enable=lfs))
+    timed(results, "update", m.update)
+    timed(results, "unpack_git_objects", m._GitMirroredRepo__unpack_git_objects)
+    timed(results, "snapshot", m.snapshot)
+    timed(results, "fill_object_details", m.fill_object_details)
+    # like a run that exits, so the second one doesn't start against an open database and running git processes
+    m.close()
+
+    # a second run against an unchanged upstream
+    m = timed(results, "init_existing", lambda: GitMirroredRepo(mirror, url, git_lfs_enable=lfs))
+    timed(results, "update_unchanged", m.update)
+    timed(results, "snapshot_unchanged", m.snapshot)
+
+    m.db_cursor.execute(r"""SELECT COUNT(*) FROM "objects_sha1";""")
+    object_count = m.db_cursor.fetchone()[0]
+    m.close()
+    return {
+        "params": case,
+        "objects": object_count,
+        "seconds": results,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark GitMirroredRepo on synthetic local repos.")
+    parser.add_argument('--commits', type=str, default="100,1000", help="Comma separated list of commit counts")
+    parser.add_argument('--files-per-commit', type=int, default=4, help="Files changed by every commit")
+    parser.add_argument('--blob-size', type=int, default=256, help="Size of every generated file in bytes")
+    parser.add_argument('--branches', type=int, default=10, help="Number of extra branches")
+    parser.add_argument('--tags', type=int, default=50, help="Number of tags")
+    parser.add_argument('--layout', choices=["packed", "loose", "both"], default="both", help="How the upstream stores its objects")
+    parser.add_argument('--lfs-objects', type=int, default=0, help="Number of LFS objects (needs git-lfs)")
+    parser.add_argument('--lfs-object-size', type=int, default=65536, help="Size of every LFS object in bytes")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--workdir', type=str, default=None, help="Scratch directory (default: a temporary directory)")
+    parser.add_argument('--output', type=str, default=None, help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    lfs = git_lfs_available()
+    if args.lfs_objects and not lfs:
+        print("git-lfs is not installed, LFS objects are generated but not fetched", file=sys.stderr)
+
+    layouts = ["packed", "loose"] if args.layout == "both" else [args.layout]
+    scratch = args.workdir or tempfile.mkdtemp(prefix="umbrella-bench-")
+    cases = []
+    try:
+        for commits in (int(c) for c in args.commits.split(",")):
+            for layout in layouts:
+                case = {
+                    "commits": commits,
+                    "files_per_commit": args.files_per_commit,
+                    "blob_size": args.blob_size,
+                    "branches": args.branches,
+                    "tags": args.tags,
+                    "lfs_objects": args.lfs_objects,
+                    "lfs_object_size": args.lfs_object_size,
+                    "loose": layout == "loose",
+                    "seed": args.seed,
+                }
+                print(f"Running {case}...", file=sys.stderr)
+                cases.append(run_case(os.path.join(scratch, f"{commits}-{layout}"), case, lfs))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        "umbrella_core_version": UMBRELLA_CORE_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "os": platform.platform(),
+            "git": git("--version"),
+            "git_lfs": lfs,
+        },
+        "timestamp": int(time.time()),
+        "cases": cases,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
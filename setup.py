@@ -13,11 +13,16 @@ setup(
    author='James Swineson',
    author_email='github@public.swineson.me',
    url="https://github.com/Jamesits/Umbrella",
-   packages=find_namespace_packages(), 
+   packages=find_namespace_packages(include=['umbrella', 'umbrella.*']),
+   python_requires='>=3.8',
    install_requires=['GitPython', 'requests', 'pyyaml'],
    entry_points = {
       'console_scripts': [
-          'umbrella=umbrella:main'
-      ]
+          'umbrella=umbrella.__main__:cli'
+      ],
+      'umbrella.dir_providers': [
+          'null=umbrella.dir.null:NullDirProvider',
+          'github=umbrella.dir.github:GitHubDirProvider',
+      ],
    }
 )
@@ -0,0 +1,63 @@
+import os
+import subprocess
+import typing
+import pytest
+
+
+def run_git(cwd: str, *args: str) -> str:
+    env = dict(os.environ)
+    env.update({
+        "GIT_AUTHOR_NAME": "Umbrella Test",
+        "GIT_AUTHOR_EMAIL": "test@example.com",
+        "GIT_COMMITTER_NAME": "Umbrella Test",
+        "GIT_COMMITTER_EMAIL": "test@example.com",
+    })
+    return subprocess.run(
+        ["git", *args], cwd=cwd, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout.decode("utf-8").strip()
+
+
+class Upstream:
+    """
+    A plain git repo to back up, with helpers to change its history.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.url: str = "file://" + path
+        os.makedirs(path)
+        run_git(path, "init", "-q", "-b", "master")
+
+    def commit(self, files: typing.Dict[str, str], message: str = "commit") -> str:
+        for name, content in files.items():
+            file_path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as f:
+                f.write(content)
+        run_git(self.path, "add", "-A")
+        run_git(self.path, "commit", "-q", "-m", message)
+        return self.head()
+
+    def head(self, ref: str = "HEAD") -> str:
+        return run_git(self.path, "rev-parse", ref)
+
+    def git(self, *args: str) -> str:
+        return run_git(self.path, *args)
+
+
+@pytest.fixture
+def upstream(tmp_path) -> Upstream:
+    u = Upstream(str(tmp_path / "upstream"))
+    u.commit({"README.md": "hello\n"}, "initial")
+    return u
+
+
+@pytest.fixture
+def backup_root(tmp_path, monkeypatch) -> str:
+    """
+    The working directory of the test, like `umbrella` changes into the backup root before it starts.
+    """
+    root = tmp_path / "backup"
+    root.mkdir()
+    monkeypatch.chdir(root)
+    return str(root)
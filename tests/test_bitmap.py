@@ -0,0 +1,21 @@
+from umbrella.bitmap import ObjectBitmap
+
+
+def test_round_trip():
+    b = ObjectBitmap()
+    b.add([0, 1, 7, 8, 63, 1000])
+    b.add([7])
+    restored = ObjectBitmap.decompress(b.compress())
+    assert list(restored) == [0, 1, 7, 8, 63, 1000]
+    assert len(restored) == 6
+    assert 1000 in restored and 999 not in restored and 5000 not in restored
+
+
+def test_difference():
+    a = ObjectBitmap()
+    a.add(range(20))
+    b = ObjectBitmap()
+    b.add(range(10, 100))
+    assert list(a - b) == list(range(10))
+    assert list(b - a) == list(range(20, 100))
+    assert len(ObjectBitmap() - a) == 0
@@ -0,0 +1,114 @@
+import os
+from umbrella.catalog import Catalog
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.metrics import RepoMetrics, get_object_store_bytes
+
+
+def backup(catalog: Catalog, run_id: int, url: str, storage_directory: str) -> None:
+    m = GitMirroredRepo(storage_directory, url)
+    try:
+        m.update()
+        m.snapshot()
+        catalog.record_backup(run_id, url, storage_directory, RepoMetrics(url), m)
+    finally:
+        m.close()
+
+
+def test_same_url_in_two_directories(upstream, backup_root):
+    c = Catalog(os.path.join(backup_root, "catalog.sqlite3"))
+    try:
+        run_id = c.start_run()
+        backup(c, run_id, upstream.url, "a")
+        upstream.commit({"a.txt": "a\n"})
+        backup(c, run_id, upstream.url, "./b")
+        c.finish_run(run_id)
+
+        c.db_cursor.execute(r"""
+            SELECT "storage_directory", "last_snapshot_id" FROM "repos" WHERE "url" = ? ORDER BY 1;
+        """, (upstream.url,))
+        assert c.db_cursor.fetchall() == [("a", 1), ("b", 1)]
+        c.db_cursor.execute(r"""SELECT "repos_total" FROM "runs" WHERE "id" = ?;""", (run_id,))
+        assert c.db_cursor.fetchone()[0] == 2
+        assert len(c.find_commit(upstream.head())) == 1
+        assert len(c.find_commit(upstream.head("HEAD~1"))) == 2
+    finally:
+        c.close()
+
+
+class TimedMetrics(RepoMetrics):
+    def __init__(self, url: str, seconds: float) -> None:
+        super().__init__(url)
+        self.__seconds = seconds
+
+    @property
+    def seconds(self) -> float:
+        return self.__seconds
+
+
+def test_expected_durations(upstream, backup_root):
+    c = Catalog(os.path.join(backup_root, "catalog.sqlite3"))
+    try:
+        def backup_timed(storage_directory: str, seconds: float, error: str = None) -> None:
+            m = GitMirroredRepo(storage_directory, upstream.url)
+            try:
+                m.update()
+                m.snapshot()
+                c.record_backup(c.start_run(), upstream.url, storage_directory, TimedMetrics(upstream.url, seconds), m,
+                                error)
+            finally:
+                m.close()
+
+        # a big repo that rarely changes: the quick runs that found nothing new don't make it look small
+        backup_timed("big", 100)
+        for _ in range(3):
+            backup_timed("big", 1)
+        # the same repo backed up into another directory is timed on its own
+        backup_timed("copy", 30)
+        backup_timed("copy", 5, error="fatal: early EOF")
+        # the recent runs are averaged
+        upstream.commit({"a.txt": "a\n"})
+        backup_timed("medium", 50)
+        upstream.commit({"b.txt": "b\n"})
+        backup_timed("medium", 70)
+
+        c.db_cursor.execute(r"""SELECT "status", COUNT(*) FROM "run_status" GROUP BY 1 ORDER BY 1;""")
+        assert c.db_cursor.fetchall() == [("failed", 1), ("ok", 4), ("unchanged", 3)]
+
+        durations = c.expected_durations()
+        assert {k: seconds for k, (seconds, _) in durations.items()} == {
+            (upstream.url, "big"): 100,
+            (upstream.url, "copy"): 30,
+            (upstream.url, "medium"): 60,
+        }
+        # longest first
+        assert sorted(durations, key=lambda k: -durations[k][0]) == [
+            (upstream.url, "big"), (upstream.url, "medium"), (upstream.url, "copy"),
+        ]
+    finally:
+        c.close()
+
+
+def test_storage_bytes_without_walking_the_objects(upstream, backup_root, monkeypatch):
+    scanned = []
+    scandir = os.scandir
+
+    def recording_scandir(path="."):
+        if isinstance(path, str):
+            scanned.append(os.path.normpath(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", recording_scandir)
+    c = Catalog(os.path.join(backup_root, "catalog.sqlite3"))
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        m.snapshot()
+        scanned.clear()
+        c.record_backup(c.start_run(), upstream.url, "mirror", RepoMetrics(upstream.url), m)
+        assert not [p for p in scanned if p.startswith(os.path.join("mirror", "git", "objects"))]
+        (group, count, storage_bytes), = c.storage_usage("repo")
+        assert (group, count) == (upstream.url, 1)
+        assert storage_bytes >= get_object_store_bytes(m.repo) > 0
+    finally:
+        m.close()
+        c.close()
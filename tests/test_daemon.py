@@ -0,0 +1,161 @@
+import os
+import signal
+import threading
+import time
+import pytest
+from umbrella.daemon import BackupDaemon, get_default_max_open_repos
+from umbrella.git_mirror import GitMirroredRepo
+
+resource = pytest.importorskip("resource")
+
+
+@pytest.mark.parametrize("soft_limit, expected", [(1024, 170), (256, 42), (4, 1), (1048576, 1000)])
+def test_default_max_open_repos_fits_file_limit(monkeypatch, soft_limit, expected):
+    monkeypatch.setattr(resource, "getrlimit", lambda _: (soft_limit, resource.RLIM_INFINITY))
+    assert get_default_max_open_repos() == expected
+    assert BackupDaemon(lambda url: None, lambda: []).max_open_repos == expected
+    assert BackupDaemon(lambda url: None, lambda: [], max_open_repos=5).max_open_repos == 5
+
+
+def test_idle_repo_releases_git_processes(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        m.snapshot()
+        m.repo.commit("HEAD").tree.blobs[0].data_stream.read()
+        assert m.repo.git.cat_file_all is not None
+        m.release()
+        assert m.repo.git.cat_file_all is None and m.repo.git.cat_file_header is None
+        # still usable
+        assert m.repo.commit("HEAD").hexsha == upstream.head()
+    finally:
+        m.close()
+
+
+class FakeRepo:
+    """
+    Stands in for a GitMirroredRepo; update() blocks while `resumed` is clear.
+    """
+
+    def __init__(self, url: str, paused: bool = False) -> None:
+        self.url = url
+        self.snapshots = 0
+        self.closed = False
+        self.started = threading.Event()
+        self.resumed = threading.Event()
+        if not paused:
+            self.resumed.set()
+
+    def update(self) -> None:
+        self.started.set()
+        assert self.resumed.wait(10)
+
+    def snapshot(self) -> None:
+        self.snapshots += 1
+
+    def save_metrics(self) -> None:
+        pass
+
+    def submodules(self):
+        return ["https://example.com/submodule.git"] if self.url == "https://example.com/a.git" else []
+
+    def estimate_poll_interval(self, min_interval: float, max_interval: float) -> float:
+        return min_interval
+
+    def release(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def wait_for(condition) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Directory:
+    """
+    The repos a fake directory lists right now.
+    """
+
+    def __init__(self, *urls: str) -> None:
+        self.urls = list(urls)
+        self.searches = 0
+
+    def search(self):
+        self.searches += 1
+        return list(self.urls)
+
+
+def make_daemon(repos, directory: Directory, paused: bool = False) -> BackupDaemon:
+    def open_repo(url: str) -> FakeRepo:
+        repos[url] = FakeRepo(url, paused)
+        return repos[url]
+
+    return BackupDaemon(open_repo, directory.search, jobs=2, discovery_interval=0.05, min_interval=0.01)
+
+
+def test_vanished_repos_are_no_longer_polled():
+    a, b, c = "https://example.com/a.git", "https://example.com/b.git", "https://example.com/c.git"
+    repos = dict()
+    directory = Directory(a, b, c)
+    daemon = make_daemon(repos, directory)
+    runner = threading.Thread(target=daemon.run)
+    runner.start()
+    try:
+        wait_for(lambda: all(url in repos and repos[url].snapshots > 0 for url in (a, b, c)))
+        # c is being backed up when it disappears
+        repos[c].resumed.clear()
+        repos[c].started.clear()
+        wait_for(repos[c].started.is_set)
+        directory.urls = [a]
+        wait_for(lambda: b not in daemon.known and c not in daemon.known and repos[b].closed)
+        assert not repos[c].closed
+        repos[c].resumed.set()
+        wait_for(lambda: repos[c].closed)
+
+        snapshots = {url: repos[url].snapshots for url in (a, b, c)}
+        searches = directory.searches
+        wait_for(lambda: directory.searches > searches + 2 and repos[a].snapshots > snapshots[a] + 2)
+        assert (repos[b].snapshots, repos[c].snapshots) == (snapshots[b], snapshots[c])
+        # submodules are not in the directories, but stay
+        assert daemon.known == {a, "https://example.com/submodule.git"}
+    finally:
+        daemon.stop()
+        runner.join()
+
+
+def test_only_repos_from_the_last_discovery_run_are_removed():
+    a, b = "https://example.com/a.git", "https://example.com/b.git"
+    daemon = BackupDaemon(lambda url: None, lambda: [])
+    # e.g. a submodule
+    daemon.add(a)
+    assert daemon.remove_vanished({b}) == set()
+    daemon.add(b)
+    assert daemon.remove_vanished(set()) == {b}
+    assert daemon.known == {a}
+    assert [url for _, url in daemon.due] == [a]
+
+
+def test_sigterm_finishes_running_backups():
+    url = "https://example.com/a.git"
+    repos = dict()
+    daemon = make_daemon(repos, Directory(url), paused=True)
+
+    def send_sigterm():
+        wait_for(lambda: url in repos and repos[url].started.is_set())
+        os.kill(os.getpid(), signal.SIGTERM)
+        wait_for(daemon.stopped.is_set)
+        repos[url].resumed.set()
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    sender = threading.Thread(target=send_sigterm)
+    sender.start()
+    daemon.run()
+    sender.join()
+    assert repos[url].snapshots == 1
+    assert repos[url].closed
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import typing
+import pytest
+from umbrella.git_mirror import GitMirroredRepo, UMBRELLA_DB_SCHEMA_VERSION
+from umbrella.pack_index import iter_object_sha1s
+from conftest import run_git
+
+
+class BaselineDatabase:
+    """
+    Writes the database layout of the first umbrella releases (schema version 1): objects_sha1 with a rowid, one
+    `refs_snapshot_<id>` table per snapshot, and the full config file of every snapshot in `configs`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.execute(r"""CREATE TABLE "umbrella_config" ("key" TEXT, "value" TEXT, PRIMARY KEY("key"));""")
+        self.db.execute(r"""CREATE TABLE "objects_sha1" (
+                "sha1"	BLOB,
+                "type"  TEXT,
+                "size"  INTEGER,
+                "first_appearance_in_snapshots"	INTEGER,
+                PRIMARY KEY("sha1")
+        );""")
+        self.db.execute(r"""CREATE TABLE "snapshots" (
+                "id"	INTEGER PRIMARY KEY AUTOINCREMENT,
+                "timestamp"	INTEGER,
+                "umbrella_core_version"	INTEGER,
+                "os"	TEXT
+        );""")
+        self.db.execute(r"""CREATE TABLE "configs" ("snapshot_id" INTEGER PRIMARY KEY, "content" BLOB);""")
+        self.db.execute(r"""INSERT INTO "snapshots" VALUES (0, 1500000000, 1, 'test');""")
+        self.db.commit()
+
+    def snapshot(self, git_directory: str) -> int:
+        cursor = self.db.cursor()
+        cursor.execute(r"""
+            INSERT INTO "snapshots" ("timestamp", "umbrella_core_version", "os") VALUES (1500000000, 1, 'test');
+        """)
+        snapshot_id = cursor.lastrowid
+        cursor.execute(fr"""CREATE TABLE "refs_snapshot_{snapshot_id}" (
+                "path"	TEXT,
+                "commit"	TEXT,
+                PRIMARY KEY("path")
+        );""")
+        cursor.executemany(fr"""INSERT INTO "refs_snapshot_{snapshot_id}" ("path", "commit") VALUES (?, ?);""",
+                           list(read_refs(git_directory).items()))
+        with open(os.path.join(git_directory, "config"), "r") as f:
+            cursor.execute(r"""
+                INSERT INTO "configs" ("snapshot_id", "content") VALUES (?, ?);
+            """, (snapshot_id, f.read()))
+        cursor.executemany(r"""
+            INSERT OR IGNORE INTO "objects_sha1" ("sha1", "first_appearance_in_snapshots") VALUES (?, ?);
+        """, [(sha1, snapshot_id) for sha1 in iter_object_sha1s(os.path.join(git_directory, "objects"))])
+        self.db.commit()
+        return snapshot_id
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def read_refs(git_directory: str) -> typing.Dict[str, str]:
+    output = run_git(git_directory, "for-each-ref", "--format=%(refname) %(objectname)")
+    return dict(line.split(" ") for line in output.splitlines())
+
+
+class Baseline(typing.NamedTuple):
+    db_file: str
+    first: str
+    pushed: str
+    refs_1: typing.Dict[str, str]
+    refs_2: typing.Dict[str, str]
+
+
+@pytest.fixture
+def baseline(upstream, backup_root) -> Baseline:
+    """
+    A mirror with two snapshots recorded in a baseline database.
+    """
+    # let the current code set up the git directory, then replace the database with a baseline one
+    m = GitMirroredRepo("mirror", upstream.url)
+    m.update()
+    git_directory = m.git_directory
+    db_file = m.sqlite3_db_file
+    m.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+    db = BaselineDatabase(db_file)
+    first = upstream.head()
+    db.snapshot(git_directory)
+    refs_1 = read_refs(git_directory)
+    pushed = upstream.commit({"secret.txt": "oops\n"})
+    upstream.git("tag", "v1", first)
+    run_git(git_directory, "fetch", "-q", "origin")
+    db.snapshot(git_directory)
+    refs_2 = read_refs(git_directory)
+    db.close()
+    assert refs_1 != refs_2
+    return Baseline(db_file, first, pushed, refs_1, refs_2)
+
+
+def assert_migrated(upstream, baseline: Baseline) -> None:
+    first, pushed = baseline.first, baseline.pushed
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.db_cursor.execute(r"""SELECT "value" FROM "umbrella_config" WHERE "key" = 'schema_version';""")
+        assert int(m.db_cursor.fetchone()[0]) == UMBRELLA_DB_SCHEMA_VERSION == 4
+        m.db_cursor.execute(r"""
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND (name LIKE 'refs\_snapshot\_%' ESCAPE '\' OR name LIKE 'objects\_sha1\_%' ESCAPE '\'
+                                    OR name = 'configs');
+        """)
+        assert m.db_cursor.fetchall() == []
+
+        assert m.get_current_snapshot_id() == 2
+        assert m.get_snapshot_refs(1) == baseline.refs_1
+        assert m.get_snapshot_refs(2) == baseline.refs_2
+        assert m.diff_snapshots(1, 2)["changed"] == {"refs/heads/master": (first, pushed)}
+
+        # object ids are unique and follow the order the objects arrived in
+        m.db_cursor.execute(r"""
+            SELECT "first_appearance_in_snapshots", MIN("object_id"), MAX("object_id"), COUNT(*)
+            FROM "objects_sha1" GROUP BY 1 ORDER BY 1;
+        """)
+        (s1, low_1, high_1, count_1), (s2, low_2, high_2, count_2) = m.db_cursor.fetchall()
+        assert (s1, s2) == (1, 2)
+        assert (low_1, high_1, low_2, high_2) == (1, count_1, count_1 + 1, count_1 + count_2)
+
+        # the bitmaps of the old snapshots are built on demand
+        assert len(m.get_reachability_bitmap(1)) == count_1
+        assert m.lost_objects(1, 2) == []
+
+        # and the backup goes on from there
+        upstream.git("reset", "-q", "--hard", first)
+        m.update()
+        m.snapshot()
+        assert m.get_current_snapshot_id() == 3
+        assert dict(m.lost_objects(2))[pushed] == "commit"
+        m.db_cursor.execute(r"""SELECT COUNT(DISTINCT "object_id"), COUNT(*) FROM "objects_sha1";""")
+        distinct_ids, count = m.db_cursor.fetchone()
+        assert distinct_ids == count
+        assert m.verify()["snapshots"][1]["missing"] == []
+    finally:
+        m.close()
+
+
+def test_migrate_from_baseline(upstream, baseline):
+    assert_migrated(upstream, baseline)
+
+
+def test_interrupted_migration(upstream, baseline, monkeypatch):
+    def killed(self, *args):
+        # like the process being killed: the connection goes away without a commit
+        self.db_connection.close()
+        raise KeyboardInterrupt()
+
+    # the refs are folded into refs_history by then, the configs come last
+    with monkeypatch.context() as patched:
+        patched.setattr(GitMirroredRepo, "_GitMirroredRepo__db_save_config", killed)
+        with pytest.raises(KeyboardInterrupt):
+            GitMirroredRepo("mirror", upstream.url)
+
+    # the steps before the interrupted one are kept, the interrupted one left no trace
+    db = sqlite3.connect(baseline.db_file)
+    try:
+        assert db.execute(r"""SELECT "value" FROM "umbrella_config" WHERE "key" = 'schema_version';""").fetchone() \
+            == ("2",)
+        assert db.execute(r"""SELECT COUNT(*) FROM "objects_sha1" WHERE "object_id" IS NULL;""").fetchone() == (0,)
+        tables = [name for name, in db.execute(r"""SELECT name FROM sqlite_master WHERE type='table';""")]
+        assert "refs_snapshot_1" in tables and "configs" in tables and "refs_history" not in tables
+    finally:
+        db.close()
+
+    assert_migrated(upstream, baseline)
+
+
+@pytest.mark.parametrize("leftover", [
+    # the scratch table was created, and maybe partially filled
+    r"""
+    CREATE TABLE "objects_sha1_migration" (
+        "sha1" BLOB, "type" TEXT, "size" INTEGER, "first_appearance_in_snapshots" INTEGER, PRIMARY KEY("sha1")
+    ) WITHOUT ROWID;
+    INSERT INTO "objects_sha1_migration" SELECT * FROM "objects_sha1" LIMIT 1;
+    """,
+    # the old table was dropped, but the complete copy never renamed
+    r"""
+    CREATE TABLE "objects_sha1_migration" (
+        "sha1" BLOB, "type" TEXT, "size" INTEGER, "first_appearance_in_snapshots" INTEGER, PRIMARY KEY("sha1")
+    ) WITHOUT ROWID;
+    INSERT INTO "objects_sha1_migration" SELECT * FROM "objects_sha1";
+    DROP TABLE "objects_sha1";
+    """,
+    # the object_id column was added, but the objects never numbered
+    r"""
+    INSERT INTO "umbrella_config" ("key", "value") VALUES ('schema_version', '2');
+    ALTER TABLE "objects_sha1" ADD COLUMN "object_id" INTEGER;
+    """,
+], ids=["scratch-table", "not-renamed", "not-numbered"])
+def test_leftovers_of_a_non_transactional_migration(upstream, baseline, leftover):
+    """
+    Earlier versions of the migration ran the DDL outside of transactions, and could leave these behind.
+    """
+    db = sqlite3.connect(baseline.db_file)
+    db.executescript(leftover)
+    db.close()
+    assert_migrated(upstream, baseline)
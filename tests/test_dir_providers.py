@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import pytest
+from umbrella import dir as dir_providers
+from umbrella.dir import get_provider
+from umbrella.dir.github import GitHubDirProvider
+from umbrella.dir.null import NullDirProvider
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    get_provider.cache_clear()
+    yield
+    get_provider.cache_clear()
+
+
+@pytest.fixture
+def installed_provider(tmp_path, monkeypatch):
+    """
+    A third party provider package, registered the way pip would install it.
+    """
+    (tmp_path / "umbrella_fake_provider.py").write_text(
+        "from umbrella.dir import DirProvider\n"
+        "\n"
+        "class FakeDirProvider(DirProvider):\n"
+        "    def search(self):\n"
+        "        return ['https://example.com/fake.git']\n"
+    )
+    dist_info = tmp_path / "umbrella_fake_provider-1.0.dist-info"
+    dist_info.mkdir()
+    (dist_info / "METADATA").write_text("Metadata-Version: 2.1\nName: umbrella-fake-provider\nVersion: 1.0\n")
+    (dist_info / "entry_points.txt").write_text(
+        f"[{dir_providers.PROVIDER_ENTRY_POINT_GROUP}]\nFake = umbrella_fake_provider:FakeDirProvider\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+
+def test_builtin_providers_need_no_metadata(monkeypatch):
+    def no_metadata():
+        raise AssertionError("package metadata read for a built-in provider")
+
+    monkeypatch.setattr(dir_providers, "_iter_provider_entry_points", no_metadata)
+    assert get_provider("null") is NullDirProvider
+    assert get_provider("GitHub") is GitHubDirProvider
+
+
+def test_provider_from_an_entry_point(installed_provider):
+    provider = get_provider("fake")
+    assert provider.__name__ == "FakeDirProvider"
+    assert provider({}, None).search() == ["https://example.com/fake.git"]
+
+
+def test_unknown_provider(installed_provider):
+    assert get_provider("gitlab") is None
+
+
+def test_providers_are_imported_lazily():
+    code = "import sys; from umbrella.dir import get_provider; get_provider('null'); print('requests' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True, stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8").strip()
+    assert output == "False"
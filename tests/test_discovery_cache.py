@@ -0,0 +1,52 @@
+from umbrella.dir import DirProvider
+from umbrella.dir.cache import DiscoveryCache, CacheEntry
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr("umbrella.dir.cache.time.time", lambda: now)
+    cache = DiscoveryCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    try:
+        cache.put("a", CacheEntry('"e"', None, [{"x": 1}], {"next": {"url": "u", "rel": "next"}}))
+        assert cache.get("a") == CacheEntry('"e"', None, [{"x": 1}], {"next": {"url": "u", "rel": "next"}})
+        now += 61
+        assert cache.get("a") is None
+        cache.put("b", CacheEntry(None, "yesterday", {}, {}))
+        now += 50
+        # revalidated by the server
+        cache.touch("b")
+        now += 50
+        assert cache.get("b") is not None
+    finally:
+        cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr("umbrella.dir.cache.time.time", lambda: now)
+    path = str(tmp_path / "cache.sqlite3")
+    cache = DiscoveryCache(path, max_entries=2)
+    for key in ("a", "b", "c"):
+        now += 1
+        cache.put(key, CacheEntry('"e"', None, [], {}))
+    now += 1
+    cache.touch("a")
+    cache.close()
+
+    cache = DiscoveryCache(path, max_entries=2)
+    try:
+        assert cache.get("a") is not None
+        assert cache.get("b") is None
+        assert cache.get("c") is not None
+    finally:
+        cache.close()
+
+
+def test_cache_key():
+    class Auth:
+        username = "someone"
+
+    key = DirProvider.cache_key("https://api.example.com/x", {"page": 2, "per_page": 100}, Auth())
+    assert key.startswith("https://api.example.com/x?page=2&per_page=100#")
+    assert "someone" not in key
+    assert DirProvider.cache_key("https://api.example.com/x?a=1", {"page": 2}) == "https://api.example.com/x?a=1&page=2"
@@ -0,0 +1,102 @@
+import json
+import os
+import umbrella.__main__ as umbrella_main
+from umbrella.git_mirror import GitMirroredRepo
+
+
+def backup(m: GitMirroredRepo) -> None:
+    m.update()
+    m.snapshot()
+
+
+def ship(source: GitMirroredRepo, target: GitMirroredRepo, bundle_file: str) -> int:
+    manifest = source.export_bundle(bundle_file)
+    assert manifest is not None
+    source.commit_export(manifest)
+    bundle = None if manifest["bundle"] is None else os.path.join(os.path.dirname(bundle_file), manifest["bundle"])
+    return target.import_bundle(manifest, bundle)
+
+
+def assert_same_snapshots(source: GitMirroredRepo, target: GitMirroredRepo) -> None:
+    assert target.get_current_snapshot_id() == source.get_current_snapshot_id()
+    for i in range(1, source.get_current_snapshot_id() + 1):
+        assert target.get_snapshot_refs(i) == source.get_snapshot_refs(i)
+        assert target.get_snapshot_timestamp(i) == source.get_snapshot_timestamp(i)
+
+
+def test_export_import_round_trip(upstream, backup_root):
+    source = GitMirroredRepo("source", upstream.url)
+    target = GitMirroredRepo("target", upstream.url)
+    try:
+        base = upstream.head()
+        backup(source)
+        upstream.git("tag", "-a", "v1", "-m", "v1")
+        pushed = upstream.commit({"a.txt": "a\n"})
+        backup(source)
+        assert ship(source, target, os.path.abspath("first.bundle")) == 2
+        assert_same_snapshots(source, target)
+
+        # force-pushed away between two exports; the incremental bundle must still carry it
+        upstream.git("reset", "-q", "--hard", base)
+        gone = upstream.commit({"b.txt": "b\n"})
+        backup(source)
+        upstream.git("reset", "-q", "--hard", base)
+        upstream.commit({"c.txt": "c\n"})
+        backup(source)
+        assert ship(source, target, os.path.abspath("second.bundle")) == 2
+        assert_same_snapshots(source, target)
+        for commit in (pushed, gone):
+            assert target.repo.git.cat_file("-t", commit) == "commit"
+        assert target.repo.git.cat_file("-t", "refs/tags/v1") == "tag"
+
+        assert source.export_bundle(os.path.abspath("third.bundle")) is None
+    finally:
+        source.close()
+        target.close()
+
+
+def test_export_import_without_new_objects(upstream, backup_root):
+    source = GitMirroredRepo("source", upstream.url)
+    target = GitMirroredRepo("target", upstream.url)
+    try:
+        backup(source)
+        ship(source, target, os.path.abspath("first.bundle"))
+
+        # only a new reference to a commit the other copy has: nothing to bundle, but the snapshot still has to arrive
+        upstream.git("branch", "feature")
+        backup(source)
+        manifest = source.export_bundle(os.path.abspath("second.bundle"))
+        assert manifest["bundle"] is None
+        source.commit_export(manifest)
+        assert target.import_bundle(manifest, None) == 1
+        assert_same_snapshots(source, target)
+        assert "refs/heads/feature" in target.get_snapshot_refs()
+    finally:
+        source.close()
+        target.close()
+
+
+def test_export_is_recorded_after_the_manifest_is_written(upstream, backup_root, monkeypatch):
+    source = GitMirroredRepo("source", upstream.url)
+    backup(source)
+    source.close()
+
+    with monkeypatch.context() as patched:
+        def disk_full(*args, **kwargs):
+            raise OSError(28, "No space left on device")
+
+        patched.setattr(umbrella_main.json, "dump", disk_full)
+        assert umbrella_main.main(["export", "source", "--output", "outbox"]) == -1
+    assert not os.path.exists(os.path.join("outbox", "source.json"))
+
+    # so the next export starts over
+    assert umbrella_main.main(["export", "source", "--output", "outbox"]) == 0
+    with open(os.path.join("outbox", "source.json"), encoding="utf-8") as f:
+        assert json.load(f)["since_snapshot"] == 0
+    assert sorted(os.listdir("outbox")) == ["source.bundle", "source.json"]
+
+    source = GitMirroredRepo("source", upstream.url)
+    try:
+        assert source.export_bundle(os.path.abspath("again.bundle")) is None
+    finally:
+        source.close()
@@ -0,0 +1,166 @@
+import json
+import threading
+import typing
+import requests
+from umbrella.auth import AuthRuleMatcher
+from umbrella.dir import github
+from umbrella.dir.cache import DiscoveryCache
+from umbrella.dir.github import GitHubDirProvider, GitHubRateLimiter
+
+API = "https://api.example.com"
+
+
+def make_response(url: str, status_code: int, body: typing.Any, headers: typing.Dict[str, str] = None):
+    r = requests.Response()
+    r.url = url
+    r.status_code = status_code
+    r._content = json.dumps(body).encode("utf-8")
+    r.headers.update(headers or {})
+    return r
+
+
+def link_header(url: str, **pages: int) -> str:
+    return ", ".join(f'<{url}?per_page=100&page={page}>; rel="{rel}"' for rel, page in pages.items())
+
+
+class FakeSession:
+    """
+    Stands in for requests.Session; answers from a dict of (url, page) => list of responses, one per attempt.
+    """
+
+    def __init__(self, responses: typing.Dict[typing.Tuple[str, int], typing.List[requests.Response]]) -> None:
+        self.responses = responses
+        self.lock = threading.Lock()
+        self.requests: typing.List[typing.Tuple[str, int]] = []
+        self.sent_headers: typing.List[typing.Dict[str, str]] = []
+
+    def get(self, url, params=None, auth=None, headers=None, **kwargs):
+        with self.lock:
+            self.requests.append((url, params["page"]))
+            self.sent_headers.append(dict(headers or {}))
+            return self.responses[(url, params["page"])].pop(0)
+
+
+def repo(name: str, has_wiki: bool = False) -> typing.Dict[str, typing.Any]:
+    return {
+        "clone_url": f"https://github.com/a/{name}.git",
+        "html_url": f"https://github.com/a/{name}",
+        "has_wiki": has_wiki,
+    }
+
+
+def make_provider(responses, searches, cache=None) -> GitHubDirProvider:
+    p = GitHubDirProvider({"api_endpoint": API, "searches": searches, "concurrency": 3}, AuthRuleMatcher([]), cache)
+    p.session = FakeSession(responses)
+    return p
+
+
+def test_pages_from_the_last_link_are_loaded_together():
+    url = f"{API}/users/a/repos"
+    p = make_provider({
+        (url, 1): [make_response(url, 200, [repo("r1", has_wiki=True)], {"Link": link_header(url, next=2, last=3)})],
+        (url, 2): [make_response(url, 200, [repo("r2")], {"Link": link_header(url, next=3, last=3)})],
+        (url, 3): [make_response(url, 200, [repo("r3")], {"Link": link_header(url, first=1)})],
+    }, ["users/a/repos"])
+    assert sorted(p.search()) == [
+        "https://github.com/a/r1.git",
+        "https://github.com/a/r1.wiki.git",
+        "https://github.com/a/r2.git",
+        "https://github.com/a/r3.git",
+    ]
+    assert sorted(p.session.requests) == [(url, 1), (url, 2), (url, 3)]
+
+
+def test_next_links_are_followed_without_a_last_link():
+    url = f"{API}/orgs/a/repos"
+    single = f"{API}/repos/a/single"
+    p = make_provider({
+        (url, 1): [make_response(url, 200, [repo("r1")], {"Link": link_header(url, next=2)})],
+        (url, 2): [make_response(url, 200, [repo("r2")], {"Link": link_header(url, next=3)})],
+        (url, 3): [make_response(url, 200, [repo("r3")])],
+        # a single repo rather than a listing
+        (single, 1): [make_response(single, 200, repo("single"))],
+    }, ["orgs/a/repos", "/repos//a/single"])
+    assert sorted(p.search()) == [
+        "https://github.com/a/r1.git",
+        "https://github.com/a/r2.git",
+        "https://github.com/a/r3.git",
+        "https://github.com/a/single.git",
+    ]
+
+
+def test_rate_limited_requests_are_retried(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(github.time, "sleep", sleeps.append)
+    url = f"{API}/users/a/repos"
+    p = make_provider({
+        (url, 1): [
+            make_response(url, 403, {"message": "secondary rate limit"}, {"Retry-After": "7"}),
+            make_response(url, 200, [repo("r1")]),
+        ],
+    }, ["users/a/repos"])
+    assert sorted(p.search()) == ["https://github.com/a/r1.git"]
+    assert sleeps == [7]
+
+
+def test_rate_limiter_waits_for_the_reset(monkeypatch):
+    limiter = GitHubRateLimiter(reserve=2)
+    now = 1000000.0
+    monkeypatch.setattr(github.time, "time", lambda: now)
+    sleeps = []
+
+    def sleep(delay):
+        nonlocal now
+        sleeps.append(delay)
+        now += delay
+
+    monkeypatch.setattr(github.time, "sleep", sleep)
+
+    url = f"{API}/users/a/repos"
+    ok = make_response(url, 200, [], {"X-RateLimit-Remaining": "3", "X-RateLimit-Reset": str(now + 60)})
+    assert limiter.update(ok) == 0
+    limiter.wait()
+    assert sleeps == []
+    # the quota is down to the reserve now
+    limiter.wait()
+    assert sleeps == [61]
+
+    exhausted = make_response(url, 403, {}, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(now + 30)})
+    assert limiter.update(exhausted) == 31
+
+
+def test_unchanged_pages_are_served_from_the_cache(tmp_path):
+    url = f"{API}/users/a/repos"
+    cache = DiscoveryCache(str(tmp_path / "discovery_cache.sqlite3"))
+    try:
+        p = make_provider({
+            (url, 1): [
+                make_response(url, 200, [repo("r1")], {"ETag": '"v1"', "Link": link_header(url, next=2, last=2)}),
+            ],
+            (url, 2): [make_response(url, 200, [repo("r2")])],
+        }, ["users/a/repos"], cache)
+        assert sorted(p.search()) == ["https://github.com/a/r1.git", "https://github.com/a/r2.git"]
+
+        # page 1 is unchanged, page 2 had no validators to send
+        p = make_provider({
+            (url, 1): [make_response(url, 304, None)],
+            (url, 2): [make_response(url, 200, [repo("r3")])],
+        }, ["users/a/repos"], cache)
+        assert sorted(p.search()) == ["https://github.com/a/r1.git", "https://github.com/a/r3.git"]
+        sent = dict(zip(p.session.requests, p.session.sent_headers))
+        assert sent[(url, 1)] == {"If-None-Match": '"v1"'}
+        assert sent[(url, 2)] == {}
+    finally:
+        cache.close()
+
+
+def test_pages_that_are_not_json_are_skipped():
+    broken = f"{API}/users/a/repos"
+    url = f"{API}/users/b/repos"
+    html = make_response(broken, 200, None, {"Content-Type": "text/html"})
+    html._content = b"<html><body>502 Bad Gateway</body></html>"
+    p = make_provider({
+        (broken, 1): [html],
+        (url, 1): [make_response(url, 200, [repo("r1")])],
+    }, ["users/a/repos", "users/b/repos"])
+    assert list(p.search()) == ["https://github.com/a/r1.git"]
@@ -0,0 +1,130 @@
+import os
+import git
+import pytest
+from umbrella.git_mirror import GitMirroredRepo
+
+
+@pytest.fixture
+def mirror(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    yield m
+    m.close()
+
+
+def backup(m: GitMirroredRepo) -> int:
+    m.update()
+    m.snapshot()
+    return m.get_current_snapshot_id()
+
+
+def bitmap_sha1s(m: GitMirroredRepo, snapshot_id: int):
+    ids = list(m.get_reachability_bitmap(snapshot_id))
+    m.db_cursor.execute(fr"""
+        SELECT "sha1" FROM "objects_sha1" WHERE "object_id" IN ({", ".join("?" * len(ids))});
+    """, ids)
+    return set(sha1.hex() for sha1, in m.db_cursor.fetchall())
+
+
+def reachable_sha1s(upstream):
+    # tag objects are not in the bitmaps
+    return set(
+        line.split(" ")[0] for line in upstream.git("rev-list", "--objects", "--branches", "--tags").splitlines()
+    )
+
+
+def test_diff_snapshots(upstream, mirror):
+    first = upstream.head()
+    backup(mirror)
+    upstream.git("branch", "feature")
+    second = upstream.commit({"a.txt": "a\n"})
+    backup(mirror)
+    upstream.git("tag", "v1")
+    backup(mirror)
+
+    assert mirror.diff_snapshots(1, 2) == {
+        "added": {"refs/heads/feature": first},
+        "changed": {"refs/heads/master": (first, second)},
+        "deleted": {},
+    }
+    assert mirror.diff_snapshots(2) == {"added": {"refs/tags/v1": second}, "changed": {}, "deleted": {}}
+    assert mirror.diff_snapshots(3, 1) == {
+        "added": {},
+        "changed": {"refs/heads/master": (second, first)},
+        "deleted": {"refs/heads/feature": first, "refs/tags/v1": second},
+    }
+    assert mirror.diff_snapshots(0, 1)["added"] == {"refs/heads/master": first}
+
+
+def test_lost_objects_after_force_push(upstream, mirror):
+    base = upstream.head()
+    pushed = upstream.commit({"secret.txt": "oops\n"})
+    backup(mirror)
+    upstream.git("reset", "-q", "--hard", base)
+    upstream.commit({"other.txt": "fine\n"})
+    backup(mirror)
+
+    lost = dict(mirror.lost_objects(1, 2))
+    assert lost[pushed] == "commit"
+    assert lost[upstream.git("rev-parse", f"{pushed}:secret.txt")] == "blob"
+    assert lost[upstream.git("rev-parse", f"{pushed}^{{tree}}")] == "tree"
+    assert len(lost) == 3
+    assert mirror.lost_objects(2) == []
+
+
+def test_bitmaps_follow_rewritten_refs(upstream, mirror):
+    # like refs/pull/*/merge on GitHub: a ref that is rewritten over and over, while the rest only grows
+    iter_reachable_sha1s = mirror._GitMirroredRepo__iter_reachable_sha1s
+    full_walks = []
+
+    def counting_iter_reachable_sha1s(known_tips, *options, tips=None):
+        known_tips = list(known_tips)
+        if tips is not None and len(known_tips) == 0:
+            full_walks.append(mirror.get_current_snapshot_id() + 1)
+        return iter_reachable_sha1s(known_tips, *options, tips=tips)
+
+    mirror._GitMirroredRepo__iter_reachable_sha1s = counting_iter_reachable_sha1s
+    upstream.git("checkout", "-q", "-b", "pr")
+    for i in range(3):
+        upstream.git("checkout", "-q", "master")
+        upstream.commit({f"m{i}.txt": f"{i}\n"})
+        upstream.git("checkout", "-q", "pr")
+        upstream.git("reset", "-q", "--hard", "master")
+        upstream.commit({"pr.txt": f"attempt {i}\n"})
+        upstream.git("checkout", "-q", "master")
+        snapshot_id = backup(mirror)
+        assert bitmap_sha1s(mirror, snapshot_id) == reachable_sha1s(upstream)
+        if snapshot_id > 1:
+            lost = dict(mirror.lost_objects(snapshot_id - 1, snapshot_id))
+            assert set(lost.values()) == {"commit", "tree", "blob"}
+    assert full_walks == [1]
+
+
+def test_unknown_snapshot_ids_are_rejected(upstream, mirror):
+    backup(mirror)
+    for method in (mirror.diff_snapshots, mirror.lost_objects):
+        with pytest.raises(ValueError):
+            method(0, 2)
+        with pytest.raises(ValueError):
+            method(-1)
+    with pytest.raises(ValueError):
+        mirror.get_reachability_bitmap(5)
+    mirror.db_cursor.execute(r"""SELECT COUNT(*) FROM "reachability_bitmaps" WHERE "snapshot_id" > 1;""")
+    assert mirror.db_cursor.fetchone()[0] == 0
+
+
+def test_walks_clean_up_after_themselves(upstream, mirror):
+    for i in range(3):
+        upstream.commit({f"{i}.txt": f"{i}\n"})
+    backup(mirror)
+
+    # abandoned halfway
+    walk = mirror.iter_new_commits([])
+    next(walk)
+    walk.close()
+    assert os.listdir(mirror.temp_directory) == []
+    # failed
+    with pytest.raises(git.exc.GitCommandError):
+        list(mirror.iter_new_commits(["0" * 40]))
+    assert os.listdir(mirror.temp_directory) == []
+    # two at once
+    assert len(list(zip(mirror.iter_new_commits([]), mirror.iter_new_commits([])))) == 4
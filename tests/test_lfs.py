@@ -0,0 +1,74 @@
+import git
+import pytest
+from umbrella.git_mirror import GitMirroredRepo
+
+LFS_ATTRIBUTES = "*.bin filter=lfs diff=lfs merge=lfs -text\n"
+
+
+@pytest.fixture
+def lfs_calls(monkeypatch):
+    """
+    Record the `git lfs` commands instead of running them; the upstream has no LFS server.
+    """
+    calls = []
+
+    def lfs(self, *args, **kwargs):
+        calls.append(args)
+        return ""
+
+    monkeypatch.setattr(git.cmd.Git, "lfs", lfs, raising=False)
+    return calls
+
+
+@pytest.fixture
+def mirror(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    yield m
+    m.db_connection.close()
+
+
+def backup(m: GitMirroredRepo) -> None:
+    m.update()
+    m.snapshot()
+
+
+def test_repos_without_lfs_attributes_are_skipped(upstream, mirror, lfs_calls):
+    backup(mirror)
+    upstream.commit({"a.txt": "a\n", ".gitattributes": "*.txt text\n"})
+    backup(mirror)
+    assert lfs_calls == []
+
+
+def test_only_new_commits_are_fetched(upstream, mirror, lfs_calls):
+    upstream.commit({".gitattributes": LFS_ATTRIBUTES})
+    backup(mirror)
+    # nothing to compare with in the first backup
+    assert lfs_calls == [("fetch", "--all", "origin")]
+
+    lfs_calls.clear()
+    upstream.git("checkout", "-q", "-b", "feature")
+    first = upstream.commit({"a.bin": "a\n"})
+    second = upstream.commit({"b.bin": "b\n"})
+    backup(mirror)
+    assert len(lfs_calls) == 1
+    assert lfs_calls[0][:2] == ("fetch", "origin")
+    assert sorted(lfs_calls[0][2:]) == sorted([first, second])
+
+    # the attributes can be in any directory, and only in the new commits
+    lfs_calls.clear()
+    upstream.git("checkout", "-q", "master")
+    upstream.git("rm", "-q", ".gitattributes")
+    upstream.commit({"sub/.gitattributes": LFS_ATTRIBUTES}, "move the attributes")
+    backup(mirror)
+    assert lfs_calls == [("fetch", "origin", upstream.head())]
+
+
+def test_long_histories_are_fetched_at_once(upstream, mirror, lfs_calls):
+    upstream.commit({".gitattributes": LFS_ATTRIBUTES})
+    backup(mirror)
+    lfs_calls.clear()
+    mirror.lfs_max_incremental_commits = 2
+    for i in range(3):
+        upstream.commit({f"{i}.bin": f"{i}\n"})
+    backup(mirror)
+    assert lfs_calls == [("fetch", "--all", "origin")]
@@ -0,0 +1,51 @@
+import json
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.metrics import RepoMetrics, RunMetrics, get_object_store_bytes
+
+
+def test_object_store_bytes(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        before = get_object_store_bytes(m.repo)
+        m.update()
+        # a small fetch ends up as loose objects
+        assert m.repo.git.count_objects() != "0 objects, 0 kilobytes"
+        assert get_object_store_bytes(m.repo) > before
+        m.repo.git.repack("-a", "-d", "-q")
+        assert m.repo.git.count_objects() == "0 objects, 0 kilobytes"
+        assert get_object_store_bytes(m.repo) > before
+    finally:
+        m.close()
+
+
+def test_bytes_fetched(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        m.snapshot()
+        assert m.metrics.counters["bytes_fetched"] > 0
+
+        m.metrics = RepoMetrics(upstream.url)
+        upstream.commit({"a.txt": "a\n" * 1000})
+        m.update()
+        # the fetch is too small to keep as a pack
+        assert m.metrics.counters["bytes_fetched"] > 0
+
+        m.metrics = RepoMetrics(upstream.url)
+        m.skip_unchanged = False
+        m.update()
+        assert m.metrics.counters["bytes_fetched"] == 0
+    finally:
+        m.close()
+
+
+def test_peak_memory_is_reported_per_run():
+    run = RunMetrics()
+    repo = run.new_repo("https://example.com/a.git")
+    with repo.phase("fetch"):
+        pass
+    run.finish()
+    d = json.loads(json.dumps(run.to_dict()))
+    assert "peak_rss_bytes" in d
+    assert "peak_rss_bytes" not in d["repos"][0]
+    assert list(d["repos"][0]["phases"][0]) == ["phase", "seconds"]
@@ -0,0 +1,61 @@
+import pytest
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.git_objects import GitObjectInfoReader
+
+
+@pytest.fixture
+def mirror(upstream, backup_root):
+    for i in range(5):
+        upstream.commit({f"{i}.txt": f"{i}\n" * (i + 1)})
+    m = GitMirroredRepo("mirror", upstream.url)
+    m.update()
+    m.snapshot()
+    yield m
+    m.db_connection.close()
+
+
+def object_details(m: GitMirroredRepo):
+    m.db_cursor.execute(r"""SELECT "sha1", "type", "size" FROM "objects_sha1" ORDER BY "sha1";""")
+    return [(sha1.hex(), t, s) for sha1, t, s in m.db_cursor.fetchall()]
+
+
+def expected_details(upstream):
+    output = upstream.git("cat-file", "--batch-all-objects", "--batch-check=%(objectname) %(objecttype) %(objectsize)")
+    return sorted((name, t, int(s)) for name, t, s in (line.split(" ") for line in output.splitlines()))
+
+
+def test_fill_in_bounded_runs(upstream, mirror):
+    mirror.object_details_batch_size = 4
+    total = len(object_details(mirror))
+    assert mirror.fill_object_details(max_objects=6) == 6
+    details = object_details(mirror)
+    # the first objects in sha1 order are done, and nothing else
+    assert [t is not None for _, t, _ in details] == [True] * 6 + [False] * (total - 6)
+    assert mirror._GitMirroredRepo__db_get_config("metadata_fill_cursor") == details[5][0]
+
+    assert mirror.fill_object_details() == total - 6
+    assert object_details(mirror) == expected_details(upstream)
+    assert mirror._GitMirroredRepo__db_get_config("metadata_fill_cursor") is None
+    assert mirror.fill_object_details() == 0
+
+
+def test_resume_after_interruption(upstream, mirror, monkeypatch):
+    mirror.object_details_batch_size = 4
+    query = GitObjectInfoReader.query
+    queried = []
+
+    def failing_query(self, names):
+        if len(queried) == 2:
+            raise KeyboardInterrupt()
+        queried.append(list(names))
+        return query(self, names)
+
+    monkeypatch.setattr(GitObjectInfoReader, "query", failing_query)
+    with pytest.raises(KeyboardInterrupt):
+        mirror.fill_object_details()
+    # the two chunks before the interruption are kept
+    assert sum(1 for _, t, _ in object_details(mirror) if t is not None) == 8
+
+    monkeypatch.setattr(GitObjectInfoReader, "query", query)
+    assert mirror.fill_object_details() == len(object_details(mirror)) - 8
+    assert object_details(mirror) == expected_details(upstream)
@@ -0,0 +1,84 @@
+import os
+import pytest
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.object_pool import POOL_PACK_KEEP_MARKER
+from umbrella.pack_index import iter_object_sha1s, list_alternates
+from umbrella.utils import get_object_pool_key
+from conftest import Upstream, run_git
+
+
+@pytest.mark.parametrize("a,b", [
+    ("https://github.com/a/project.git", "https://github.com/b/project"),
+    ("git@github.com:a/project.git", "https://GitHub.com/b/Project.git"),
+])
+def test_forks_share_a_pool_key(a, b):
+    assert get_object_pool_key(a) == get_object_pool_key(b)
+
+
+@pytest.mark.parametrize("a,b", [
+    ("https://github.com/a/project.git", "https://github.com/a/other.git"),
+    ("https://github.com/a/project.git", "https://gitlab.com/a/project.git"),
+])
+def test_other_repos_do_not_share_a_pool_key(a, b):
+    assert get_object_pool_key(a) != get_object_pool_key(b)
+
+
+@pytest.fixture
+def fork(upstream, tmp_path) -> Upstream:
+    f = Upstream(str(tmp_path / "fork"))
+    f.git("pull", "-q", upstream.path, "master")
+    return f
+
+
+def own_object_count(m: GitMirroredRepo) -> int:
+    return sum(1 for _ in iter_object_sha1s(os.path.join(m.git_directory, "objects")))
+
+
+def recorded_sha1s(m: GitMirroredRepo):
+    m.db_cursor.execute(r"""SELECT "sha1" FROM "objects_sha1";""")
+    return set(sha1.hex() for sha1, in m.db_cursor.fetchall())
+
+
+def reachable_sha1s(u: Upstream):
+    return set(line.split(" ")[0] for line in u.git("rev-list", "--objects", "--all").splitlines())
+
+
+def test_forks_borrow_objects_from_the_pool(upstream, fork, backup_root):
+    # enough objects for git to keep the fetched pack instead of exploding it
+    for i in range(40):
+        upstream.commit({f"{i}.txt": f"{i}\n"})
+    fork.git("pull", "-q", upstream.path, "master")
+    fork_only = fork.commit({"fork.txt": "fork\n"})
+
+    original = GitMirroredRepo("original", upstream.url, object_pool_directory="pool.git")
+    mirrored_fork = GitMirroredRepo("fork", fork.url, object_pool_directory="pool.git")
+    try:
+        for m in (original, mirrored_fork):
+            m.update()
+            m.snapshot()
+            alternates = list_alternates(os.path.join(m.git_directory, "objects"))
+            assert [os.path.abspath(a) for a in alternates] == [os.path.abspath(os.path.join("pool.git", "objects"))]
+
+        # the objects of both repos are stored once, in the pool, and the mirrors borrow all of them
+        pool_objects = set(sha1.hex() for sha1 in iter_object_sha1s(os.path.join("pool.git", "objects")))
+        assert pool_objects == reachable_sha1s(upstream) | reachable_sha1s(fork)
+        assert own_object_count(original) == 0
+        assert own_object_count(mirrored_fork) == 0
+        # but each backup still records all of its own objects
+        assert recorded_sha1s(original) == reachable_sha1s(upstream)
+        assert recorded_sha1s(mirrored_fork) == reachable_sha1s(fork)
+        assert fork_only not in recorded_sha1s(original)
+
+        # the refs of both members keep their objects alive in the pool, and no pack may be repacked away
+        pool_refs = run_git("pool.git", "for-each-ref", "--format=%(refname)")
+        assert len([r for r in pool_refs.splitlines() if r.startswith("refs/forks/")]) == 2
+        pack_dir = os.path.join("pool.git", "objects", "pack")
+        keep_files = [f for f in os.listdir(pack_dir) if f.endswith(".keep")]
+        assert len(keep_files) == len([f for f in os.listdir(pack_dir) if f.endswith(".pack")]) > 0
+        with open(os.path.join(pack_dir, keep_files[0]), "r") as f:
+            assert f.read() == POOL_PACK_KEEP_MARKER
+
+        mirrored_fork.repo.git.fsck("--connectivity-only")
+    finally:
+        original.db_connection.close()
+        mirrored_fork.db_connection.close()
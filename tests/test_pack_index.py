@@ -0,0 +1,91 @@
+import os
+import struct
+import subprocess
+import pytest
+from umbrella.pack_index import PackIndex, ObjectDirectory, iter_object_sha1s, PACK_IDX_SHA1_TABLE_OFFSET
+
+
+def make_pack(upstream, tmp_path, *index_pack_options: str) -> str:
+    """
+    Pack the history of the upstream and index it again with git's options.
+    :return: path of the new `.idx` file
+    """
+    for i in range(20):
+        upstream.commit({f"f{i}.txt": f"{i}\n" * (i + 1)})
+    pack_dir = tmp_path / "packs"
+    pack_dir.mkdir()
+    objects = upstream.git("rev-list", "--objects", "--all")
+    pack_name = subprocess.run(
+        ["git", "pack-objects", "-q", str(pack_dir / "pack")], cwd=upstream.path, input=objects.encode("utf-8"),
+        check=True, stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8").strip()
+    pack_file = str(pack_dir / f"pack-{pack_name}.pack")
+    idx_file = str(pack_dir / f"test-{pack_name}.idx")
+    subprocess.run(["git", "index-pack", *index_pack_options, "-o", idx_file, pack_file], check=True,
+                   stdout=subprocess.PIPE)
+    return idx_file
+
+
+def git_show_index(idx_file: str):
+    with open(idx_file, "rb") as f:
+        output = subprocess.run(["git", "show-index"], stdin=f, check=True, stdout=subprocess.PIPE).stdout
+    return [bytes.fromhex(line.split(" ")[1]) for line in output.decode("utf-8").splitlines()]
+
+
+def test_read_pack_index(upstream, tmp_path):
+    idx_file = make_pack(upstream, tmp_path)
+    expected = git_show_index(idx_file)
+    with PackIndex(idx_file) as idx:
+        assert len(idx) == len(expected) > 60
+        assert list(idx) == sorted(expected)
+        assert all(sha1 in idx for sha1 in expected)
+        assert b"\x00" * 20 not in idx
+        assert b"\xff" * 20 not in idx
+        assert bytes.fromhex(upstream.head()[:38] + "00") not in idx
+
+
+def test_read_pack_index_with_64bit_offsets(upstream, tmp_path):
+    # every object above offset 0x40 goes to the 64-bit offset table, like in packs larger than 2 GiB
+    idx_file = make_pack(upstream, tmp_path, "--index-version=2,0x40")
+    object_count = len(git_show_index(idx_file))
+    # 4-byte offsets with the MSB set point into a table of 8-byte offsets after the CRC32 table
+    with open(idx_file, "rb") as f:
+        data = f.read()
+    offsets_start = PACK_IDX_SHA1_TABLE_OFFSET + object_count * (20 + 4)
+    offsets = struct.unpack_from(f">{object_count}I", data, offsets_start)
+    assert sum(1 for o in offsets if o & 0x80000000) > 0
+    assert len(data) > offsets_start + object_count * 4 + 40
+
+    with PackIndex(idx_file) as idx:
+        assert list(idx) == sorted(git_show_index(idx_file))
+
+
+def test_reject_other_index_versions(upstream, tmp_path):
+    idx_file = make_pack(upstream, tmp_path, "--index-version=1")
+    with pytest.raises(ValueError):
+        PackIndex(idx_file)
+
+
+def test_reject_truncated_index(upstream, tmp_path):
+    idx_file = make_pack(upstream, tmp_path)
+    with open(idx_file, "rb") as f:
+        data = f.read()
+    truncated_file = str(tmp_path / "truncated.idx")
+    with open(truncated_file, "wb") as f:
+        f.write(data[:PACK_IDX_SHA1_TABLE_OFFSET + 30])
+    with pytest.raises(ValueError):
+        PackIndex(truncated_file)
+
+
+def test_object_directory(upstream):
+    packed = upstream.head()
+    upstream.git("repack", "-adq")
+    loose = upstream.commit({"loose.txt": "loose\n"})
+    objects_directory = os.path.join(upstream.path, ".git", "objects")
+
+    sha1s = set(sha1.hex() for sha1 in iter_object_sha1s(objects_directory))
+    assert sha1s == set(line.split(" ")[0] for line in upstream.git("rev-list", "--objects", "--all").splitlines())
+    with ObjectDirectory(objects_directory) as objects:
+        assert bytes.fromhex(packed) in objects
+        assert bytes.fromhex(loose) in objects
+        assert b"\x01" * 20 not in objects
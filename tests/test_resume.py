@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import git
+import pytest
+import yaml
+import umbrella.__main__ as umbrella_main
+from umbrella.catalog import Catalog
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.utils import is_transient_git_error
+from conftest import Upstream
+
+
+@pytest.mark.parametrize("stderr", [
+    "fatal: unable to access 'https://example.com/r.git/': The requested URL returned error: 503",
+    "fatal: unable to access 'https://example.com/r.git/': Could not resolve host: example.com",
+    "fatal: unable to access 'https://example.com/r.git/': Operation timed out after 300000 milliseconds",
+    "error: RPC failed; HTTP 502 curl 22 The requested URL returned error: 502",
+    b"fatal: the remote end hung up unexpectedly\nfatal: early EOF",
+    "ssh: connect to host example.com port 22: Connection refused",
+])
+def test_transient_git_errors(stderr):
+    assert is_transient_git_error(stderr)
+
+
+@pytest.mark.parametrize("stderr", [
+    "remote: Repository not found.\nfatal: repository 'https://example.com/r.git/' not found",
+    "fatal: Authentication failed for 'https://example.com/r.git/'",
+    "fatal: unable to access 'https://example.com/r.git/': The requested URL returned error: 403",
+    "",
+    None,
+])
+def test_permanent_git_errors(stderr):
+    assert not is_transient_git_error(stderr)
+
+
+def write_config(tmp_path, root: str, repos=None) -> str:
+    config = {
+        "global": {
+            "backup_destination_root": root,
+            "retry": {"max_attempts": 3, "backoff": 1},
+            "metrics": {"enabled": False},
+        },
+    }
+    if repos is not None:
+        config["directories"] = [{"provider": "null", "repos": repos}]
+    path = str(tmp_path / "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+class CallLog(list):
+    failures: dict
+
+
+def run_status(root: str):
+    c = Catalog(os.path.join(root, ".umbrella", "catalog.sqlite3"))
+    try:
+        c.db_cursor.execute(r"""
+            SELECT "run_status"."run_id", "repos"."url", "run_status"."status" FROM "run_status"
+            JOIN "repos" ON "repos"."id" = "run_status"."repo_id" ORDER BY 1, 2;
+        """)
+        return c.db_cursor.fetchall()
+    finally:
+        c.close()
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    """
+    The URLs GitMirroredRepo.update() was called for; failures to inject can be queued per URL.
+    """
+    calls = CallLog()
+    failures = dict()
+    update = GitMirroredRepo.update
+
+    def recording_update(self):
+        calls.append(self.upstream_url)
+        queued = failures.get(self.upstream_url)
+        if queued:
+            raise queued.pop(0)
+        return update(self)
+
+    monkeypatch.setattr(GitMirroredRepo, "update", recording_update)
+    calls.failures = failures
+    return calls
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(umbrella_main.time, "sleep", delays.append)
+    return delays
+
+
+def http_error(status: int) -> git.exc.GitCommandError:
+    return git.exc.GitCommandError(
+        ["git", "fetch"], 128, f"fatal: unable to access 'https://example.com/': The requested URL returned error: {status}"
+    )
+
+
+def test_transient_errors_are_retried(upstream, tmp_path, monkeypatch, updates, sleeps):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / "root")
+    updates.failures[upstream.url] = [http_error(503), git.exc.GitCommandError(["git", "fetch"], 128, "Connection reset")]
+    assert umbrella_main.main([upstream.url, "mirror", "--config", write_config(tmp_path, root)]) == 0
+    assert updates == [upstream.url] * 3
+    assert sleeps == [1, 2]
+    assert run_status(root) == [(1, upstream.url, "ok")]
+
+
+def test_retries_give_up(upstream, tmp_path, monkeypatch, updates, sleeps):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / "root")
+    updates.failures[upstream.url] = [http_error(500), http_error(502), http_error(503)]
+    assert umbrella_main.main([upstream.url, "mirror", "--config", write_config(tmp_path, root)]) == 0
+    assert updates == [upstream.url] * 3
+    assert sleeps == [1, 2]
+    assert run_status(root) == [(1, upstream.url, "failed")]
+
+
+def test_permanent_errors_are_not_retried(upstream, tmp_path, monkeypatch, updates, sleeps):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / "root")
+    updates.failures[upstream.url] = [http_error(404)]
+    assert umbrella_main.main([upstream.url, "mirror", "--config", write_config(tmp_path, root)]) == 0
+    assert updates == [upstream.url]
+    assert sleeps == []
+    assert run_status(root) == [(1, upstream.url, "failed")]
+
+
+def test_resume_an_interrupted_run(upstream, tmp_path, monkeypatch, updates):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / "root")
+    failing = Upstream(str(tmp_path / "failing"))
+    failing.commit({"a.txt": "a\n"})
+    killed = Upstream(str(tmp_path / "killed"))
+    killed.commit({"b.txt": "b\n"})
+    config = write_config(tmp_path, root, [upstream.url, failing.url, killed.url])
+
+    updates.failures[failing.url] = [http_error(404)]
+    # like Ctrl+C while the third repo is being backed up
+    updates.failures[killed.url] = [KeyboardInterrupt()]
+    with pytest.raises(KeyboardInterrupt):
+        umbrella_main.main(["--config", config])
+    while any(t.name == "umbrella-discovery" for t in threading.enumerate()):
+        time.sleep(0.01)
+    assert run_status(root) == [(1, failing.url, "failed"), (1, upstream.url, "ok")]
+
+    c = Catalog(os.path.join(root, ".umbrella", "catalog.sqlite3"))
+    try:
+        run_id, discovery_finished, pending, done = c.resume_run()
+    finally:
+        c.close()
+    assert (run_id, discovery_finished) == (1, True)
+    assert sorted(pending) == sorted([failing.url, killed.url])
+    assert done == [upstream.url]
+
+    updates.clear()
+    assert umbrella_main.main(["--config", config, "--resume"]) == 0
+    # the repo that was done is neither searched for again nor backed up
+    assert sorted(updates) == sorted([failing.url, killed.url])
+    assert run_status(root) == sorted([(1, failing.url, "ok"), (1, killed.url, "ok"), (1, upstream.url, "ok")])
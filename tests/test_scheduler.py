@@ -0,0 +1,84 @@
+import collections
+import threading
+import time
+from umbrella.scheduler import BackupScheduler
+from umbrella.utils import get_url_host
+
+
+def test_per_host_cap():
+    lock = threading.Lock()
+    running = collections.Counter()
+    peak = collections.Counter()
+    peak_total = [0]
+
+    def worker(url):
+        host = get_url_host(url)
+        with lock:
+            running[host] += 1
+            peak[host] = max(peak[host], running[host])
+            peak_total[0] = max(peak_total[0], sum(running.values()))
+        time.sleep(0.02)
+        with lock:
+            running[host] -= 1
+
+    s = BackupScheduler(worker, jobs=6, max_jobs_per_host=2)
+    for i in range(8):
+        s.submit(f"https://a.example.com/o/{i}.git")
+        s.submit(f"https://b.example.com/o/{i}.git")
+    s.close()
+    s.run()
+
+    assert peak["a.example.com"] == 2
+    assert peak["b.example.com"] == 2
+    assert peak_total[0] <= 4
+    assert s.started_count == 16
+
+
+def test_discovered_repos_run_once():
+    done = []
+
+    def worker(url):
+        done.append(url)
+        # submodules that point back at repos already queued
+        return ["https://example.com/lib.git", "https://example.com/app.git"]
+
+    s = BackupScheduler(worker, jobs=3)
+    s.submit("https://example.com/app.git")
+    s.close()
+    s.run()
+    assert sorted(done) == ["https://example.com/app.git", "https://example.com/lib.git"]
+
+
+def test_hosts_are_served_round_robin():
+    done = []
+    s = BackupScheduler(done.append, jobs=1)
+    for url in ["https://a.example.com/1", "https://a.example.com/2", "https://b.example.com/1"]:
+        s.submit(url)
+    assert not s.submit("https://a.example.com/1")
+    s.close()
+    s.run()
+    assert done == ["https://a.example.com/1", "https://b.example.com/1", "https://a.example.com/2"]
+
+
+def test_priority_and_round_robin():
+    done = []
+    s = BackupScheduler(done.append, jobs=1, priority=lambda url: int(url.rsplit("/", 1)[-1]))
+    for url in ["https://a.example.com/1", "https://a.example.com/5", "https://b.example.com/5",
+                "https://b.example.com/3"]:
+        s.submit(url)
+    s.close()
+    s.run()
+    # highest first; on a tie the host that waited longest wins
+    assert done == ["https://a.example.com/5", "https://b.example.com/5", "https://b.example.com/3",
+                    "https://a.example.com/1"]
+
+
+def test_repos_done_before_are_skipped():
+    done = []
+    s = BackupScheduler(done.append, jobs=1)
+    s.mark_done(["https://example.com/1"])
+    assert not s.submit("https://example.com/1")
+    assert s.submit("https://example.com/2")
+    s.close()
+    s.run()
+    assert done == ["https://example.com/2"]
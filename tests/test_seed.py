@@ -0,0 +1,27 @@
+import os
+from umbrella.git_mirror import GitMirroredRepo
+
+
+def test_seed_relative_to_working_directory(upstream, backup_root):
+    upstream.commit({"a.txt": "a\n"})
+    upstream.git("bundle", "create", os.path.join(backup_root, "seed.bundle"), "--all")
+    head = upstream.commit({"b.txt": "b\n"})
+
+    m = GitMirroredRepo("mirror", upstream.url, seed="seed.bundle")
+    try:
+        m.update()
+        m.snapshot()
+        assert m.get_snapshot_refs()["refs/heads/master"] == head
+        assert not any(ref.startswith("refs/umbrella-seed/") for ref in m.get_snapshot_refs())
+    finally:
+        m.close()
+
+
+def test_broken_seed_falls_back_to_upstream(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url, seed="missing.bundle")
+    try:
+        m.update()
+        m.snapshot()
+        assert m.get_snapshot_refs()["refs/heads/master"] == upstream.head()
+    finally:
+        m.close()
@@ -0,0 +1,79 @@
+import pytest
+import umbrella.git_mirror
+from umbrella.git_mirror import GitMirroredRepo
+
+
+def count_objects(m: GitMirroredRepo) -> int:
+    m.db_cursor.execute(r"""SELECT COUNT(*) FROM "objects_sha1";""")
+    return m.db_cursor.fetchone()[0]
+
+
+def test_preflight_skips_unchanged_upstream(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        assert not m.up_to_date
+        m.snapshot()
+        assert m.get_current_snapshot_id() == 1
+
+        m.update()
+        assert m.up_to_date
+        m.snapshot()
+        assert m.get_current_snapshot_id() == 1
+
+        upstream.git("branch", "feature")
+        head = upstream.commit({"a.txt": "a\n"})
+        m.update()
+        assert not m.up_to_date
+        m.snapshot()
+        assert m.get_current_snapshot_id() == 2
+        assert m.get_snapshot_refs()["refs/heads/master"] == head
+
+        # deleted branches stay in the backup, so they don't count as a change
+        upstream.git("branch", "-D", "feature")
+        m.update()
+        assert m.up_to_date
+    finally:
+        m.close()
+
+
+def test_interrupted_snapshot_is_taken_again(upstream, backup_root, monkeypatch):
+    upstream.commit({"a.txt": "a\n", "b/c.txt": "c\n"})
+    m = GitMirroredRepo("mirror", upstream.url)
+    m.db_bulk_chunk_size = 2
+    iter_object_sha1s = umbrella.git_mirror.iter_object_sha1s
+
+    def dying_iter_object_sha1s(objects_directory):
+        for i, sha1 in enumerate(iter_object_sha1s(objects_directory)):
+            if i == 3:
+                raise OSError("disk full")
+            yield sha1
+
+    monkeypatch.setattr(umbrella.git_mirror, "iter_object_sha1s", dying_iter_object_sha1s)
+    try:
+        m.update()
+        with pytest.raises(OSError):
+            m.snapshot()
+    finally:
+        m.close()
+    monkeypatch.setattr(umbrella.git_mirror, "iter_object_sha1s", iter_object_sha1s)
+
+    # the next run
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        assert 0 < count_objects(m) < 8
+        assert m.get_current_snapshot_id() == 0
+        assert m.get_snapshot_refs() == {}
+
+        m.update()
+        assert not m.up_to_date
+        m.snapshot()
+        assert m.get_current_snapshot_id() == 1
+        assert count_objects(m) == 8
+        assert len(m.get_reachability_bitmap(1)) == 8
+        assert m.verify()["snapshots"][1]["missing"] == []
+
+        m.update()
+        assert m.up_to_date
+    finally:
+        m.close()
@@ -0,0 +1,34 @@
+import os
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.pack_index import iter_loose_object_sha1s, list_pack_indexes
+
+
+def test_archive_from_relative_storage_directory(upstream, backup_root):
+    # batch and daemon runs pass storage directories relative to the backup root
+    m = GitMirroredRepo("mirror", upstream.url, storage_layout="packed")
+    try:
+        m.update()
+        m.snapshot()
+        upstream.commit({"a.txt": "a\n"})
+        m.update()
+        m.snapshot()
+
+        assert m.archive_git_objects(force=True)
+        objects_directory = os.path.join("mirror", "git", "objects")
+        assert len(list(iter_loose_object_sha1s(objects_directory))) == 0
+        assert len(list_pack_indexes(objects_directory)) == 1
+        assert not any(name.startswith("tmp_") for name in os.listdir(os.path.join(objects_directory, "pack")))
+        assert m.verify()["snapshots"][2]["missing"] == []
+    finally:
+        m.close()
+
+
+def test_migrate_to_packed_layout(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        m.snapshot()
+        m.migrate_storage_layout("packed")
+        assert len(list_pack_indexes(os.path.join("mirror", "git", "objects"))) == 1
+    finally:
+        m.close()
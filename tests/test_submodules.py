@@ -0,0 +1,78 @@
+import pytest
+from umbrella.git_mirror import GitMirroredRepo
+from umbrella.git_objects import GitObjectContentReader
+from umbrella.utils import resolve_submodule_url
+
+
+def gitmodules(**submodules: str) -> str:
+    return "".join(f'[submodule "{name}"]\n\tpath = {name}\n\turl = {url}\n' for name, url in submodules.items())
+
+
+@pytest.fixture
+def mirror(upstream, backup_root):
+    m = GitMirroredRepo("mirror", upstream.url)
+    yield m
+    m.close()
+
+
+@pytest.fixture
+def parsed_blobs(monkeypatch):
+    """
+    The .gitmodules blobs read from the repo, i.e. the ones not found in the cache.
+    """
+    blobs = []
+    query = GitObjectContentReader.query
+
+    def recording_query(self, names):
+        blobs.extend(names)
+        return query(self, names)
+
+    monkeypatch.setattr(GitObjectContentReader, "query", recording_query)
+    return blobs
+
+
+def test_submodules_of_all_refs(upstream, mirror, parsed_blobs):
+    upstream.git("checkout", "-q", "-b", "feature")
+    upstream.commit({".gitmodules": gitmodules(lib="../lib.git")})
+    upstream.git("checkout", "-q", "master")
+    upstream.commit({".gitmodules": gitmodules(vendor="https://example.com/vendor.git")})
+    upstream.git("tag", "v1")
+    # a later commit with the same .gitmodules
+    upstream.commit({"a.txt": "a\n"})
+    mirror.update()
+    mirror.snapshot()
+
+    assert mirror.submodules() == sorted([
+        resolve_submodule_url(upstream.url, "../lib.git"),
+        "https://example.com/vendor.git",
+    ])
+    # master and v1 share a blob
+    assert len(parsed_blobs) == 2
+
+
+def test_gitmodules_blobs_are_parsed_once(upstream, mirror, parsed_blobs):
+    upstream.commit({".gitmodules": gitmodules(vendor="https://example.com/vendor.git")})
+    mirror.update()
+    mirror.snapshot()
+    assert mirror.submodules() == ["https://example.com/vendor.git"]
+    assert len(parsed_blobs) == 1
+
+    parsed_blobs.clear()
+    upstream.commit({"a.txt": "a\n"})
+    mirror.update()
+    mirror.snapshot()
+    assert mirror.submodules() == ["https://example.com/vendor.git"]
+    assert parsed_blobs == []
+
+    upstream.git("checkout", "-q", "-b", "feature")
+    changed = upstream.commit({".gitmodules": gitmodules(other="https://example.com/other.git")})
+    mirror.update()
+    mirror.snapshot()
+    assert mirror.submodules() == ["https://example.com/other.git", "https://example.com/vendor.git"]
+    assert parsed_blobs == [upstream.git("rev-parse", f"{changed}:.gitmodules")]
+
+
+def test_repos_without_submodules(upstream, mirror):
+    mirror.update()
+    mirror.snapshot()
+    assert mirror.submodules() == []
@@ -0,0 +1,19 @@
+import pytest
+from umbrella.utils import resolve_submodule_url
+
+
+@pytest.mark.parametrize("superproject_url, url, expected", [
+    ("https://github.com/org/repo.git", "../lib.git", "https://github.com/org/lib.git"),
+    ("https://github.com/org/repo", "./lib", "https://github.com/org/repo/lib"),
+    ("https://github.com/org/repo/", "../../other/lib.git", "https://github.com/other/lib.git"),
+    ("https://github.com/repo", "../../../lib.git", "https://github.com/lib.git"),
+    ("file:///tmp/smoke/sm", "../lib.git", "file:///tmp/smoke/lib.git"),
+    ("file:///srv/org/repo", "./lib", "file:///srv/org/repo/lib"),
+    ("git@github.com:org/repo.git", "../lib.git", "git@github.com:org/lib.git"),
+    ("github.com:org/repo.git", "../lib.git", "github.com:org/lib.git"),
+    ("/srv/org/repo", "../lib", "/srv/org/lib"),
+    ("srv/org/repo", "../lib", "srv/org/lib"),
+    ("https://github.com/org/repo.git", "https://gitlab.com/org/lib.git", "https://gitlab.com/org/lib.git"),
+])
+def test_resolve_submodule_url(superproject_url, url, expected):
+    assert resolve_submodule_url(superproject_url, url) == expected
@@ -0,0 +1,39 @@
+import os
+import random
+from umbrella.git_mirror import GitMirroredRepo
+
+
+def corrupt_loose_object(git_directory: str, sha1: str) -> None:
+    path = os.path.join(git_directory, "objects", sha1[:2], sha1[2:])
+    os.chmod(path, 0o644)
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    # flip a bit near the end, so git can read the object header but dies while streaming the content
+    data[len(data) - 10] ^= 0x01
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_verify_reports_corrupt_object(upstream, backup_root):
+    rng = random.Random(1)
+    upstream.commit({"data.txt": "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(5000))})
+    m = GitMirroredRepo("mirror", upstream.url)
+    try:
+        m.update()
+        m.snapshot()
+        blob = upstream.git("rev-parse", "HEAD:data.txt")
+        upstream.commit({"a.txt": "a\n"})
+        m.update()
+        m.snapshot()
+
+        assert m.verify(hash_sample_rate=1)["snapshots"][1]["corrupt"] == []
+        corrupt_loose_object(m.git_directory, blob)
+
+        report = m.verify(hash_sample_rate=1, incremental=False)
+        assert report["snapshots"][1]["corrupt"] == [blob]
+        assert report["snapshots"][1]["hashed"] == 6
+        # the objects after the corrupt one are still checked
+        assert report["snapshots"][2]["hashed"] == 3
+        assert report["snapshots"][2]["corrupt"] == []
+    finally:
+        m.close()
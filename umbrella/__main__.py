@@ -1,28 +1,331 @@
 import logging
 from .logger_config import init_logging
-import yaml
 import sys
-from .git_mirror import GitMirroredRepo
 import argparse
-from .utils import dict_search
+from .utils import dict_search, get_state_directory, get_object_pool_key, is_transient_git_error
 import os
 from .auth import AuthRuleMatcher
-from .dir.null import NullDirProvider
-from .dir.github import GitHubDirProvider
+from .dir import get_provider
+from .dir.cache import DiscoveryCache
+from .scheduler import BackupScheduler
+from .metrics import RunMetrics, RepoMetrics
 import re
-import git
+import typing
+import threading
+import time
+import sqlite3
+import json
+import math
+
+# GitPython, PyYAML and requests make up most of the startup time; they are imported by the commands that use them,
+# so `--help` returns right away and a single-repo backup loads neither PyYAML nor any directory provider
+if typing.TYPE_CHECKING:
+    from .git_mirror import GitMirroredRepo
 
 logger = logging.getLogger(__name__)
 
-provider_mapping = {
-    "null": NullDirProvider,
-    "github": GitHubDirProvider,
+
+def open_backup(storage_directory: str) -> typing.Union['GitMirroredRepo', None]:
+    """
+    Open an existing backup for inspection; never creates a new one.
+    :param storage_directory: the backup directory of a repo
+    :return: the repo, or None if the directory is not a backup
+    """
+    from .git_mirror import GitMirroredRepo
+    if not os.path.isfile(os.path.join(storage_directory, "umbrella", "initialized")):
+        logger.error(f"{storage_directory} is not an umbrella backup")
+        return None
+    return GitMirroredRepo(storage_directory, None)
+
+
+def diff(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella diff", description="Show the references changed between two snapshots.")
+    parser.add_argument('repo', type=str, help="Backup directory of the repo")
+    parser.add_argument('old_snapshot', type=int, help="Snapshot id to compare from")
+    parser.add_argument('new_snapshot', type=int, nargs='?', default=None, help="Snapshot id to compare to (default: latest)")
+    args = parser.parse_args(argv)
+
+    m = open_backup(args.repo)
+    if m is None:
+        return -1
+    try:
+        d = m.diff_snapshots(args.old_snapshot, args.new_snapshot)
+    except ValueError as ex:
+        logger.error(f"{args.repo}: {ex}")
+        return -1
+    for path, commit in sorted(d["added"].items()):
+        print(f"A\t{path}\t{commit}")
+    for path, (old_commit, new_commit) in sorted(d["changed"].items()):
+        print(f"M\t{path}\t{old_commit}..{new_commit}")
+    for path, commit in sorted(d["deleted"].items()):
+        print(f"D\t{path}\t{commit}")
+    return 0
+
+
+def lost(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella lost", description="List the objects reachable in one snapshot but not in a later one.")
+    parser.add_argument('repo', type=str, help="Backup directory of the repo")
+    parser.add_argument('old_snapshot', type=int, help="Snapshot id to compare from")
+    parser.add_argument('new_snapshot', type=int, nargs='?', default=None, help="Snapshot id to compare to (default: latest)")
+    parser.add_argument('--type', type=str, choices=["commit", "tree", "blob", "tag"], action='append', default=None, help="Only list objects of this type (repeatable)")
+    args = parser.parse_args(argv)
+
+    m = open_backup(args.repo)
+    if m is None:
+        return -1
+    try:
+        lost_objects = m.lost_objects(args.old_snapshot, args.new_snapshot)
+    except ValueError as ex:
+        logger.error(f"{args.repo}: {ex}")
+        return -1
+    for sha1, object_type in lost_objects:
+        if args.type is None or object_type in args.type:
+            print(f"{sha1}\t{object_type}")
+    return 0
+
+
+def find_backups(root: str) -> typing.List[str]:
+    """
+    List the repo backups directly under a backup root.
+    :param root: the backup root directory
+    :return: the backup directories
+    """
+    return sorted(
+        e.path for e in os.scandir(root)
+        if e.is_dir() and os.path.isfile(os.path.join(e.path, "umbrella", "initialized"))
+    )
+
+
+def index(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella index", description="Run the indexing stages that are not part of a backup run.")
+    parser.add_argument('repos', type=str, nargs='*', help="Backup directories of the repos (default: every backup under --root)")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory to look for backups in")
+    parser.add_argument('--fill-metadata', action='store_true', help="Look up the type and size of the objects not documented yet")
+    parser.add_argument('--max-objects', type=int, default=None, help="Stop after this many objects per repo; the next run resumes")
+    args = parser.parse_args(argv)
+
+    if not args.fill_metadata:
+        parser.error("nothing to do, specify a stage (e.g. --fill-metadata)")
+
+    import git
+
+    ret = 0
+    for storage_directory in args.repos or find_backups(args.root):
+        m = open_backup(storage_directory)
+        if m is None:
+            ret = -1
+            continue
+        try:
+            logger.info(f"{storage_directory}: filling object metadata...")
+            count = m.fill_object_details(max_objects=args.max_objects)
+            logger.info(f"{storage_directory}: {count} objects documented")
+        except git.exc.GitCommandError as ex:
+            logger.exception(f"{storage_directory}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            ret = -1
+    return ret
+
+
+def verify(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella verify", description="Check that the backups still hold every object they recorded.")
+    parser.add_argument('repos', type=str, nargs='*', help="Backup directories of the repos (default: every backup under --root)")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory to look for backups in")
+    parser.add_argument('--sample', type=float, default=0.01, help="Share of the objects to read back and hash (0 to 1)")
+    parser.add_argument('--full', action='store_true', help="Hash every object (same as --sample 1)")
+    parser.add_argument('--all', action='store_true', help="Check all the objects, not only the ones added since the last verification")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of repos to verify in parallel (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    from .verify import verify_backups
+
+    ret = 0
+    repos = args.repos or find_backups(args.root)
+    for storage_directory, report in verify_backups(repos, 1.0 if args.full else args.sample, not args.all, args.jobs):
+        if "error" in report:
+            logger.error(f"{storage_directory}: {report['error']}")
+            ret = -1
+            continue
+        problems = 0
+        for snapshot_id, r in sorted(report["snapshots"].items()):
+            for sha1 in r["missing"]:
+                print(f"{storage_directory}\tsnapshot {snapshot_id}\tmissing\t{sha1}")
+            for sha1 in r["corrupt"]:
+                print(f"{storage_directory}\tsnapshot {snapshot_id}\tcorrupt\t{sha1}")
+            problems += len(r["missing"]) + len(r["corrupt"])
+        checked = sum(r["checked"] for r in report["snapshots"].values())
+        hashed = sum(r["hashed"] for r in report["snapshots"].values())
+        status = "OK" if problems == 0 else f"{problems} problems"
+        if report['since_snapshot'] >= report['until_snapshot']:
+            snapshot_range = "no new snapshots"
+        else:
+            snapshot_range = f"snapshots {report['since_snapshot'] + 1}-{report['until_snapshot']}"
+        print(f"{storage_directory}\t{snapshot_range}\t{checked} objects checked, {hashed} hashed\t{status}")
+        if problems > 0:
+            ret = 1
+    return ret
+
+
+def migrate(argv: typing.List[str]) -> int:
+    from .git_mirror import STORAGE_LAYOUTS
+    parser = argparse.ArgumentParser(prog="umbrella migrate", description="Convert backups to another storage layout.")
+    parser.add_argument('repos', type=str, nargs='*', help="Backup directories of the repos (default: every backup under --root)")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory to look for backups in")
+    parser.add_argument('--storage-layout', type=str, choices=STORAGE_LAYOUTS, required=True, help="The layout to convert to")
+    args = parser.parse_args(argv)
+
+    import git
+
+    ret = 0
+    for storage_directory in args.repos or find_backups(args.root):
+        m = open_backup(storage_directory)
+        if m is None:
+            ret = -1
+            continue
+        try:
+            m.migrate_storage_layout(args.storage_layout)
+        except git.exc.GitCommandError as ex:
+            logger.exception(f"{storage_directory}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            ret = -1
+    return ret
+
+
+def export(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella export", description="Write what changed in the backups as incremental git bundles.")
+    parser.add_argument('repos', type=str, nargs='*', help="Backup directories of the repos (default: every backup under --root)")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory to look for backups in")
+    parser.add_argument('--output', type=str, required=True, help="Directory to write the bundles and their manifests to")
+    parser.add_argument('--since-snapshot', type=int, default=None, help="Snapshot the receiving side already has (default: the last exported one)")
+    args = parser.parse_args(argv)
+
+    import git
+    os.makedirs(args.output, exist_ok=True)
+    ret = 0
+    for storage_directory in args.repos or find_backups(args.root):
+        m = open_backup(storage_directory)
+        if m is None:
+            ret = -1
+            continue
+        name = os.path.basename(os.path.normpath(storage_directory))
+        try:
+            manifest = m.export_bundle(os.path.join(args.output, f"{name}.bundle"), args.since_snapshot)
+            if manifest is None:
+                logger.info(f"{storage_directory}: no new snapshots")
+                continue
+            # the manifest is replaced atomically, and only then is the export recorded in the backup
+            manifest_file = os.path.join(args.output, f"{name}.json")
+            with open(f"{manifest_file}.tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(f"{manifest_file}.tmp", manifest_file)
+            m.commit_export(manifest)
+            logger.info(f"{storage_directory}: snapshots {manifest['since_snapshot'] + 1}-{manifest['until_snapshot']} exported")
+        except git.exc.GitCommandError as ex:
+            logger.exception(f"{storage_directory}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            ret = -1
+        except OSError:
+            logger.exception(f"{storage_directory}: unable to write the export")
+            ret = -1
+        finally:
+            m.close()
+    return ret
+
+
+def import_(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella import", description="Apply the bundles written by `umbrella export` to another copy of the backups.")
+    parser.add_argument('input', type=str, help="Directory with the bundles and their manifests")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory to import into")
+    args = parser.parse_args(argv)
+
+    import git
+    from .git_mirror import GitMirroredRepo
+
+    ret = 0
+    for manifest_file in sorted(f for f in os.listdir(args.input) if f.endswith(".json")):
+        with open(os.path.join(args.input, manifest_file), encoding="utf-8") as f:
+            manifest = json.load(f)
+        storage_directory = os.path.join(args.root, manifest_file[:-len(".json")])
+        bundle_file = os.path.join(args.input, manifest["bundle"]) if manifest["bundle"] else None
+        m = GitMirroredRepo(storage_directory, manifest["upstream_url"])
+        try:
+            count = m.import_bundle(manifest, bundle_file)
+            logger.info(f"{storage_directory}: {count} snapshots imported")
+        except ValueError as ex:
+            logger.error(f"{storage_directory}: {ex}")
+            ret = -1
+        except git.exc.GitCommandError as ex:
+            logger.exception(f"{storage_directory}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            ret = -1
+        finally:
+            m.close()
+    return ret
+
+
+def catalog(argv: typing.List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="umbrella catalog", description="Query the catalog of all the backups at a backup root.")
+    parser.add_argument('--root', type=str, default=".", help="Backup root directory")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+    p = subparsers.add_parser("contains", help="List the repos whose history contains a commit")
+    p.add_argument('commit', type=str, help="Full commit sha1")
+    p = subparsers.add_parser("failed", help="List the repos that failed in a run")
+    p.add_argument('--run', type=int, default=None, help="Run id (default: the latest run)")
+    p = subparsers.add_parser("storage", help="Show the disk usage of the backups")
+    p.add_argument('--by', type=str, choices=["host", "owner", "repo"], default="owner", help="How to group the repos")
+    subparsers.add_parser("rebuild", help="Add the backups under the backup root that are missing from the catalog")
+    args = parser.parse_args(argv)
+
+    from .catalog import Catalog
+    c = Catalog(os.path.join(get_state_directory(args.root), "catalog.sqlite3"))
+    try:
+        if args.query == "contains":
+            if not re.fullmatch(r"[0-9a-fA-F]{40}", args.commit):
+                parser.error("the commit must be a full sha1")
+            for url, storage_directory, refs in c.find_commit(args.commit):
+                print(f"{url}\t{storage_directory}\t{' '.join(refs)}")
+        elif args.query == "failed":
+            for url, error in c.failed_repos(args.run):
+                print(f"{url}\t{' '.join((error or '').split())}")
+        elif args.query == "storage":
+            for group, repo_count, size in c.storage_usage(args.by):
+                print(f"{group}\t{repo_count}\t{size}")
+        elif args.query == "rebuild":
+            for storage_directory in find_backups(args.root):
+                m = open_backup(storage_directory)
+                if m is None:
+                    continue
+                logger.info(f"Cataloging {storage_directory}...")
+                c.record_backup(None, m.upstream_url, os.path.relpath(storage_directory, args.root), None, m)
+                m.close()
+    finally:
+        c.close()
+    return 0
+
+
+commands = {
+    "catalog": catalog,
+    "diff": diff,
+    "export": export,
+    "import": import_,
+    "index": index,
+    "lost": lost,
+    "verify": verify,
+    "migrate": migrate,
 }
 
-def main() -> int:
+
+def main(argv: typing.Union[typing.List[str], None] = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+    return backup(argv)
+
+
+def backup(argv: typing.List[str]) -> int:
     # logger.info("Starting")
     
-    parser = argparse.ArgumentParser(description="Backup your Git repo.")
+    parser = argparse.ArgumentParser(
+        prog="umbrella",
+        description="Backup your Git repo.",
+        epilog=f"Other commands: {', '.join(commands)} (see `umbrella <command> --help`)",
+    )
     parser.add_argument('git_repo', type=str, nargs='?', help="URL to the source Git repo that you want to archive")
     parser.add_argument('destination', type=str, nargs='?', default=".", help="Backup target directory")
     parser.add_argument('--config', type=str, nargs='?', default=None, help="Config file (YAML) path")
@@ -30,10 +333,22 @@ def main() -> int:
     parser.add_argument('--password', type=str, nargs='?', default=None, help="Git password")
     parser.add_argument('--key', type=str, nargs='?', default=None, help="SSH private key file")
     parser.add_argument('--recursive', type=bool, nargs='?', default=True, help='Backup submodules')
-    args = parser.parse_args()
+    parser.add_argument('--force-fetch', action='store_true', help="Fetch and snapshot even if the upstream refs are unchanged")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of repos to back up in parallel")
+    parser.add_argument('--max-jobs-per-host', type=int, default=None, help="Max parallel backups against the same host (0 = unlimited)")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and back up every repo again on its own schedule")
+    parser.add_argument('--seed', type=str, default=None, help="Git bundle or local clone to take the objects of a new git_repo from")
+    parser.add_argument('--resume', action='store_true', help="Continue the last run: back up only the repos it did not finish or that failed")
+    args = parser.parse_args(argv)
+    if args.resume and args.daemon:
+        parser.error("--resume can not be used with --daemon")
+
+    import git
+    from .git_mirror import GitMirroredRepo
 
     config_content = None
     if args.config is not None:
+        import yaml
         logger.debug("Reading config file")
         try:
             with open(args.config, encoding="utf-8") as f:
@@ -45,6 +360,10 @@ def main() -> int:
             logger.exception("Config file parsing failed")
             return -1
 
+    if args.seed is not None:
+        # relative to where we were started, not to the backup root
+        args.seed = os.path.abspath(args.seed)
+
     root_dir = dict_search(config_content, 'global', 'backup_destination_root')
     if root_dir:
         logging.debug(f"Backup root dir: {root_dir}")
@@ -59,35 +378,97 @@ def main() -> int:
         a.add_authentication_ssh_key(r"^git@", args.key)
 
     # read directories
-    repos = []
     config_directories = dict_search(config_content, "directories")
-    if config_directories:
-        for d in config_directories:
-            provider = dict_search(d, "provider")
-            if not provider: provider = "null"
-            provider = provider.lower()
-            for key, value in provider_mapping.items():
-                if key.lower() == provider:
-                    repos.extend(value(d, a).search())
-                    continue
-    if args.git_repo:
-        repos.append(args.git_repo)
+    discovery_cache = None
+    if config_directories and dict_search(config_content, 'global', 'discovery_cache', 'enabled') is not False:
+        discovery_cache = DiscoveryCache(
+            os.path.join(get_state_directory(), "discovery_cache.sqlite3"),
+            ttl=dict_search(config_content, 'global', 'discovery_cache', 'ttl') or 7 * 24 * 3600,
+            max_entries=dict_search(config_content, 'global', 'discovery_cache', 'max_entries') or 100000,
+        )
+    run_metrics = RunMetrics()
+
+    catalog = None
+    run_id = None
+    # (run id, whether the discovery had finished, repos left to do, repos done) of the run being resumed
+    resumed = None
+    if dict_search(config_content, 'global', 'catalog', 'enabled') is not False:
+        from .catalog import Catalog
+        catalog = Catalog(os.path.join(get_state_directory(), "catalog.sqlite3"))
+        if args.resume:
+            resumed = catalog.resume_run()
+            if resumed is None:
+                logger.info("No run to resume, starting a new one")
+        if resumed is not None:
+            run_id = resumed[0]
+            logger.info(f"Resuming run {run_id}: {len(resumed[3])} repos done, {len(resumed[2])} to go")
+        else:
+            run_id = catalog.start_run()
+    elif args.resume:
+        logger.error("--resume needs the catalog (global.catalog.enabled), which keeps the run journal")
+        return -1
 
-    repos = list(set(repos))
-    for r in repos:
-        logging.debug(f"Backup: {r}")
+    def storage_directory_of(r: str) -> str:
+        return args.destination if r == args.git_repo else re.subn(r"[/:\\]", "_", r)[0]
 
-    logging.info(f"{len(repos)} repos collected")
+    def record_backup(r: str, repo_metrics: RepoMetrics, m: typing.Union[GitMirroredRepo, None], error: typing.Union[str, None]) -> None:
+        if catalog is None:
+            return
+        try:
+            # the backup root is the working directory by now
+            catalog.record_backup(run_id, r, os.path.relpath(storage_directory_of(r)), repo_metrics, m, error)
+        except (sqlite3.Error, git.exc.GitError, OSError):
+            logger.exception(f"{r}: unable to update the catalog")
+
+    def journal(urls: typing.List[str]) -> None:
+        if catalog is None or len(urls) == 0:
+            return
+        try:
+            catalog.add_run_repos(run_id, urls)
+        except sqlite3.Error:
+            logger.exception("Unable to update the run journal")
 
-    finished_repos = []
-    while len(repos) > 0:
-        r = repos.pop(0)
-        logger.info(f"{len(finished_repos) + 1}/{len(finished_repos) + len(repos) + 1} backing up {r} ...")
+    retry_max_attempts = dict_search(config_content, 'global', 'retry', 'max_attempts') or 3
+    retry_backoff = dict_search(config_content, 'global', 'retry', 'backoff') or 30
 
+    def update_with_retry(r: str, m: GitMirroredRepo) -> None:
+        # network hiccups and overloaded servers usually go away if we wait a bit
+        attempt = 1
+        while True:
+            try:
+                m.update()
+                return
+            except git.exc.GitCommandError as ex:
+                if attempt >= retry_max_attempts or not is_transient_git_error(ex.stderr):
+                    raise
+                delay = retry_backoff * 2 ** (attempt - 1)
+                logger.warning(f"{r}: `{' '.join(ex.command)}` failed with error {ex.stderr}; "
+                               f"retrying in {delay}s (attempt {attempt + 1}/{retry_max_attempts})")
+                time.sleep(delay)
+                attempt += 1
+
+    def open_repo(r: str, repo_metrics: typing.Union[RepoMetrics, None] = None) -> GitMirroredRepo:
         kwargs = {
-            "storage_directory": args.destination if r == args.git_repo else re.subn(r"[/:\\]", "_", r)[0],
+            "storage_directory": storage_directory_of(r),
             "upstream_url": r,
+            "skip_unchanged": not args.force_fetch,
+            "git_lfs_enable": dict_search(config_content, 'global', 'lfs', 'enabled') is not False,
+            "git_lfs_concurrent_transfers": dict_search(config_content, 'global', 'lfs', 'concurrent_transfers'),
+            "metrics": repo_metrics,
+            "storage_layout": dict_search(config_content, 'global', 'storage_layout'),
         }
+        if dict_search(config_content, 'global', 'object_pools', 'enabled'):
+            kwargs['object_pool_directory'] = os.path.join(
+                get_state_directory(), "object_pools", get_object_pool_key(r) + ".git"
+            )
+        seed = args.seed if r == args.git_repo else None
+        if seed is None:
+            seed = dict_search(config_content, 'global', 'seeds', r)
+            if seed is not None:
+                # relative to the backup root, which is the working directory by now
+                seed = os.path.abspath(seed)
+        if seed is not None:
+            kwargs['seed'] = seed
         auth_strategy = a.match(r)
         if auth_strategy["type"] == "null":
             pass
@@ -98,28 +479,156 @@ def main() -> int:
             kwargs['git_ssh_key_path'] = auth_strategy['ssh_key']
         else:
             logger.error(f"Unsupported auth strategy type {auth_strategy['type']}")
+        return GitMirroredRepo(**kwargs)
 
+    def backup_repo(r: str) -> typing.List[str]:
+        repo_metrics = run_metrics.new_repo(r)
+        m = None
         try:
-            m = GitMirroredRepo(**kwargs)
-            m.update()
+            with repo_metrics.phase("init"):
+                m = open_repo(r, repo_metrics)
+            update_with_retry(r, m)
             m.snapshot()
+            m.save_metrics()
+            record_backup(r, repo_metrics, m, None)
 
-            # search for submodules
+            # search for submodules; the scheduler takes care of the ones already queued or backed up
             if args.recursive:
-                for sm in m.submodules():
-                    if sm in repos:
-                        logger.debug(f"Submodule {sm} already in queue")
-                    elif sm in finished_repos:
-                        logger.debug(f"Submodule {sm} already backed up")
-                    else:
-                        repos.append(sm)
-                        logger.info(f"Submodule {sm} appended to the queue")
+                submodules = m.submodules()
+                journal(submodules)
+                return submodules
         except git.exc.GitCommandError as ex:
+            repo_metrics.success = False
             logger.exception(f"{r}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            record_backup(r, repo_metrics, m, f"`{' '.join(ex.command)}` failed with error {ex.stderr}")
+        except Exception as ex:
+            repo_metrics.success = False
+            record_backup(r, repo_metrics, m, str(ex))
+            raise
+        return []
+
+    def search_directories() -> typing.Iterator[str]:
+        if config_directories:
+            for d in config_directories:
+                name = dict_search(d, "provider") or "null"
+                provider = get_provider(name)
+                if provider is None:
+                    logger.error(f"Unknown directory provider {name}")
+                    continue
+                yield from provider(d, a, discovery_cache).search()
+
+    metrics_enabled = dict_search(config_content, 'global', 'metrics', 'enabled') is not False
+    metrics_dir = os.path.join(get_state_directory(), "metrics")
+    json_file = dict_search(config_content, 'global', 'metrics', 'json_file') or os.path.join(metrics_dir, "last_run.json")
+    prometheus_file = dict_search(config_content, 'global', 'metrics', 'prometheus_file') \
+        or os.path.join(metrics_dir, "umbrella.prom")
+
+    def write_metrics() -> None:
+        if not metrics_enabled:
+            return
+        try:
+            run_metrics.write(json_file, prometheus_file)
+        except OSError:
+            logger.exception("Unable to write the metrics")
+
+    jobs = args.jobs if args.jobs is not None else dict_search(config_content, 'global', 'jobs')
+    max_jobs_per_host = args.max_jobs_per_host if args.max_jobs_per_host is not None \
+        else dict_search(config_content, 'global', 'max_jobs_per_host')
+
+    if args.daemon:
+        from .daemon import BackupDaemon
+        last_metrics_write = [0.0]
+
+        def discover_all() -> typing.Iterator[str]:
+            if args.git_repo:
+                yield args.git_repo
+            yield from search_directories()
+
+        def on_backup(r: str, repo_metrics: RepoMetrics, m: typing.Union[GitMirroredRepo, None], error: typing.Union[str, None]) -> None:
+            record_backup(r, repo_metrics, m, error)
+            # keep the latest backup of every repo; rewriting the files after every single backup would be a waste
+            run_metrics.add_repo(repo_metrics, replace=True)
+            if time.monotonic() - last_metrics_write[0] >= 60:
+                last_metrics_write[0] = time.monotonic()
+                write_metrics()
+
+        daemon = BackupDaemon(
+            lambda r: open_repo(r),
+            discover_all,
+            jobs=jobs or 1,
+            max_jobs_per_host=max_jobs_per_host or 0,
+            discovery_interval=dict_search(config_content, 'global', 'daemon', 'discovery_interval') or 3600,
+            min_interval=dict_search(config_content, 'global', 'daemon', 'min_interval') or 300,
+            max_interval=dict_search(config_content, 'global', 'daemon', 'max_interval') or 86400,
+            max_open_repos=dict_search(config_content, 'global', 'daemon', 'max_open_repos'),
+            recursive=args.recursive,
+            on_backup=on_backup,
+        )
+        daemon.run()
+        write_metrics()
+        if catalog is not None:
+            catalog.finish_run(run_id)
+            catalog.close()
+        return 0
+
+    expected_durations = catalog.expected_durations() if catalog is not None else dict()
+
+    def backup_priority(r: str) -> typing.Tuple[float, int]:
+        # longest first, so a big repo doesn't start last and stretch the run; repos without any history are
+        # probably new, and their first backup is the longest
+        seconds, storage_bytes = expected_durations.get((r, os.path.relpath(storage_directory_of(r))), (None, None))
+        return math.inf if seconds is None else seconds, storage_bytes or 0
+
+    scheduler = BackupScheduler(
+        backup_repo,
+        jobs=jobs or 1,
+        max_jobs_per_host=max_jobs_per_host or 0,
+        max_pending=dict_search(config_content, 'global', 'max_pending') or 10000,
+        priority=backup_priority,
+    )
+
+    def discover() -> None:
+        # providers stream their results, so backups start while the listings are still being paged through
+        try:
+            if resumed is not None:
+                scheduler.mark_done(resumed[3])
+                for r in resumed[2]:
+                    scheduler.submit(r, block=True)
+            if args.git_repo and scheduler.submit(args.git_repo):
+                journal([args.git_repo])
+            if resumed is None or not resumed[1]:
+                for r in search_directories():
+                    if scheduler.submit(r, block=True):
+                        journal([r])
+                        logging.debug(f"Backup: {r}")
+                if catalog is not None:
+                    catalog.finish_discovery(run_id)
+        except Exception:
+            logger.exception("Repo discovery failed")
         finally:
-            finished_repos.append(r)
+            logging.info(f"{len(scheduler.seen)} repos collected")
+            scheduler.close()
 
+    discovery_thread = threading.Thread(target=discover, name="umbrella-discovery", daemon=True)
+    discovery_thread.start()
+    scheduler.run()
+    discovery_thread.join()
 
-if __name__ == "__main__":
+    run_metrics.finish()
+    write_metrics()
+    if catalog is not None:
+        catalog.finish_run(run_id)
+        catalog.close()
+    return 0
+
+
+def cli() -> None:
+    """
+    Entry point of the `umbrella` console script.
+    """
     init_logging()
     sys.exit(main())
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,52 @@
+import zlib
+import typing
+
+
+class ObjectBitmap:
+    """
+    A set of objects as a bitmap over their object_id in objects_sha1: bit n (least significant bit first) is set if
+    the object with object_id n is in the set. Object ids are handed out in the order the objects arrive, so the
+    bitmaps are dense and compress well.
+    """
+
+    def __init__(self, data: typing.Union[bytes, bytearray] = b"") -> None:
+        self.data: bytearray = bytearray(data)
+
+    def add(self, object_ids: typing.Iterable[int]) -> None:
+        """
+        :param object_ids: the object ids to add
+        :return: None
+        """
+        data = self.data
+        for object_id in object_ids:
+            byte_index = object_id >> 3
+            if byte_index >= len(data):
+                data.extend(bytes(byte_index - len(data) + 1))
+            data[byte_index] |= 1 << (object_id & 7)
+
+    def __contains__(self, object_id: int) -> bool:
+        byte_index = object_id >> 3
+        return byte_index < len(self.data) and self.data[byte_index] & (1 << (object_id & 7)) != 0
+
+    def __len__(self) -> int:
+        return bin(int.from_bytes(self.data, "little")).count("1")
+
+    def __sub__(self, other: 'ObjectBitmap') -> 'ObjectBitmap':
+        a = int.from_bytes(self.data, "little")
+        b = int.from_bytes(other.data, "little")
+        return ObjectBitmap((a & ~b).to_bytes(len(self.data), "little"))
+
+    def __iter__(self) -> typing.Iterator[int]:
+        for byte_index, byte in enumerate(self.data):
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    yield (byte_index << 3) | bit
+
+    def compress(self) -> bytes:
+        return zlib.compress(bytes(self.data))
+
+    @classmethod
+    def decompress(cls, blob: bytes) -> 'ObjectBitmap':
+        return cls(zlib.decompress(blob))
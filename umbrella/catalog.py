@@ -0,0 +1,374 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+from urllib.parse import urlsplit
+from .metrics import RepoMetrics
+from .utils import get_url_host
+
+if typing.TYPE_CHECKING:
+    from .git_mirror import GitMirroredRepo
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def get_url_owner(url: str) -> str:
+    """
+    Get the first path component of a remote URL, which is the user or the organization on most hosting services.
+    :param url: The remote URL
+    :return: the owner, or an empty string if unknown
+    """
+    if urlsplit(url).netloc:
+        path = urlsplit(url).path
+    elif get_url_host(url):
+        # scp-like syntax
+        path = url.split(":", maxsplit=1)[-1]
+    else:
+        return ""
+    parts = [p for p in path.split("/") if p]
+    return parts[0] if len(parts) > 1 else ""
+
+
+class Catalog:
+    """
+    Run-wide index over all the backups at a backup root, so questions across repos don't need to open the database
+    of every single repo. It is updated as every repo finishes; the per-repo databases remain the source of truth.
+    """
+
+    def __init__(self, path: typing.AnyStr) -> None:
+        self.path: str = str(path)
+        self.lock: threading.Lock = threading.Lock()
+
+        # updated from the worker threads; all the access is serialized by self.lock
+        self.db_connection: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.db_cursor: sqlite3.Cursor = self.db_connection.cursor()
+        self.db_cursor.execute(r"""PRAGMA journal_mode = WAL;""")
+        self.db_cursor.execute(r"""PRAGMA synchronous = NORMAL;""")
+
+        # the same URL may be backed up into more than one directory, e.g. with `--git-repo` and `destination`
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "repos" (
+                "id"	INTEGER PRIMARY KEY AUTOINCREMENT,
+                "url"	TEXT,
+                "storage_directory"	TEXT,
+                "host"	TEXT,
+                "owner"	TEXT,
+                "first_seen_at"	REAL,
+                "last_run_id"	INTEGER,
+                "last_status"	TEXT,
+                "last_success_at"	REAL,
+                "last_snapshot_id"	INTEGER,
+                "storage_bytes"	INTEGER,
+                UNIQUE("url", "storage_directory")
+        );""")
+        self.db_cursor.execute(r"""CREATE INDEX IF NOT EXISTS "repos_host_owner" ON "repos" ("host", "owner");""")
+        self.db_cursor.execute(r"""CREATE INDEX IF NOT EXISTS "repos_last_status" ON "repos" ("last_status");""")
+
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "runs" (
+                "id"	INTEGER PRIMARY KEY AUTOINCREMENT,
+                "started_at"	REAL,
+                "finished_at"	REAL,
+                "repos_total"	INTEGER,
+                "repos_failed"	INTEGER,
+                "discovery_finished_at"	REAL
+        );""")
+
+        # run journal: every repo queued in a run, so an interrupted run can be resumed without starting over
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "run_repos" (
+                "run_id"	INTEGER,
+                "url"	TEXT,
+                "queued_at"	REAL,
+                PRIMARY KEY("run_id", "url")
+        ) WITHOUT ROWID;""")
+
+        # status: "ok" (new snapshot), "unchanged" or "failed"
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "run_status" (
+                "run_id"	INTEGER,
+                "repo_id"	INTEGER,
+                "status"	TEXT,
+                "error"	TEXT,
+                "finished_at"	REAL,
+                "seconds"	REAL,
+                PRIMARY KEY("run_id", "repo_id")
+        );""")
+        self.db_cursor.execute(r"""CREATE INDEX IF NOT EXISTS "run_status_status" ON "run_status" ("status", "run_id");""")
+        self.db_cursor.execute(r"""CREATE INDEX IF NOT EXISTS "run_status_repo_id" ON "run_status" ("repo_id");""")
+
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "snapshots" (
+                "repo_id"	INTEGER,
+                "snapshot_id"	INTEGER,
+                "timestamp"	REAL,
+                "ref_count"	INTEGER,
+                "changed_ref_count"	INTEGER,
+                "new_object_count"	INTEGER,
+                PRIMARY KEY("repo_id", "snapshot_id")
+        ) WITHOUT ROWID;""")
+
+        # the refs of the latest snapshot of every repo
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "refs" (
+                "repo_id"	INTEGER,
+                "path"	TEXT,
+                "commit"	TEXT,
+                "snapshot_id"	INTEGER,
+                PRIMARY KEY("repo_id", "path")
+        ) WITHOUT ROWID;""")
+        self.db_cursor.execute(r"""CREATE INDEX IF NOT EXISTS "refs_commit" ON "refs" ("commit");""")
+
+        # every commit reachable from the refs of every repo
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "commits" (
+                "sha1"	BLOB,
+                "repo_id"	INTEGER,
+                PRIMARY KEY("sha1", "repo_id")
+        ) WITHOUT ROWID;""")
+        self.db_connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db_connection.close()
+
+    def start_run(self) -> int:
+        """
+        :return: the id of a new run
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""INSERT INTO "runs" ("started_at") VALUES (?);""", (time.time(),))
+            self.db_connection.commit()
+            return self.db_cursor.lastrowid
+
+    def finish_run(self, run_id: int) -> None:
+        with self.lock:
+            self.db_cursor.execute(r"""
+                UPDATE "runs" SET "finished_at" = ?,
+                    "repos_total" = (SELECT COUNT(*) FROM "run_status" WHERE "run_id" = ?),
+                    "repos_failed" = (SELECT COUNT(*) FROM "run_status" WHERE "run_id" = ? AND "status" = 'failed')
+                WHERE "id" = ?;
+            """, (time.time(), run_id, run_id, run_id))
+            self.db_connection.commit()
+
+    def add_run_repos(self, run_id: int, urls: typing.Iterable[str]) -> None:
+        """
+        Record in the run journal that repos have been queued.
+        :param run_id: the run
+        :param urls: upstream URLs of the repos
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            self.db_cursor.executemany(r"""
+                INSERT OR IGNORE INTO "run_repos" ("run_id", "url", "queued_at") VALUES (?, ?, ?);
+            """, [(run_id, url, now) for url in urls])
+            self.db_connection.commit()
+
+    def finish_discovery(self, run_id: int) -> None:
+        """
+        Record that every directory provider went through in a run, so a resumed run doesn't have to search again.
+        :param run_id: the run
+        :return: None
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""UPDATE "runs" SET "discovery_finished_at" = ? WHERE "id" = ?;""", (time.time(), run_id))
+            self.db_connection.commit()
+
+    def resume_run(self) -> typing.Union[typing.Tuple[int, bool, typing.List[str], typing.List[str]], None]:
+        """
+        Pick up the latest run again, e.g. after it was killed.
+        :return: (run id, whether its discovery had finished, the queued repos that are not done yet or failed,
+                 the repos that are done), or None if there was no run yet
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""SELECT "id", "discovery_finished_at" FROM "runs" ORDER BY "id" DESC LIMIT 1;""")
+            row = self.db_cursor.fetchone()
+            if row is None:
+                return None
+            run_id, discovery_finished_at = row
+            self.db_cursor.execute(r"""
+                SELECT "repos"."url" FROM "run_status" JOIN "repos" ON "repos"."id" = "run_status"."repo_id"
+                WHERE "run_status"."run_id" = ? AND "run_status"."status" != 'failed';
+            """, (run_id,))
+            done = [url for url, in self.db_cursor.fetchall()]
+            self.db_cursor.execute(r"""
+                SELECT "url" FROM "run_repos" WHERE "run_id" = ? ORDER BY "queued_at", "url";
+            """, (run_id,))
+            done_set = set(done)
+            pending = [url for url, in self.db_cursor.fetchall() if url not in done_set]
+            self.db_cursor.execute(r"""UPDATE "runs" SET "finished_at" = NULL WHERE "id" = ?;""", (run_id,))
+            self.db_connection.commit()
+            return run_id, discovery_finished_at is not None, pending, done
+
+    def __get_repo_id(self, url: str, storage_directory: str) -> int:
+        """
+        Must be called with the lock held.
+        :param url: upstream URL of the repo
+        :param storage_directory: the backup directory of the repo, relative to the backup root
+        """
+        storage_directory = os.path.normpath(storage_directory)
+        self.db_cursor.execute(r"""
+            INSERT OR IGNORE INTO "repos" ("url", "storage_directory", "host", "owner", "first_seen_at")
+            VALUES (?, ?, ?, ?, ?);
+        """, (url, storage_directory, get_url_host(url), get_url_owner(url), time.time()))
+        self.db_cursor.execute(r"""
+            SELECT "id" FROM "repos" WHERE "url" = ? AND "storage_directory" = ?;
+        """, (url, storage_directory))
+        return self.db_cursor.fetchone()[0]
+
+    def record_backup(
+            self,
+            run_id: typing.Union[int, None],
+            url: str,
+            storage_directory: str,
+            metrics: typing.Union[RepoMetrics, None],
+            repo: typing.Union['GitMirroredRepo', None],
+            error: typing.Union[str, None] = None,
+    ) -> None:
+        """
+        Update the catalog after a repo has been backed up (or failed to).
+        :param run_id: the run; None to only update the state of the repo (e.g. when rebuilding the catalog)
+        :param url: upstream URL of the repo
+        :param storage_directory: the backup directory of the repo, relative to the backup root
+        :param metrics: the metrics of the backup, if any
+        :param repo: the repo, if it could be opened
+        :param error: the error message if the backup failed
+        :return: None
+        """
+        failed = error is not None or (metrics is not None and not metrics.success) or repo is None
+        up_to_date = repo is not None and repo.up_to_date
+
+        with self.lock:
+            repo_id = self.__get_repo_id(url, storage_directory)
+            self.db_cursor.execute(r"""SELECT "path", "commit" FROM "refs" WHERE "repo_id" = ?;""", (repo_id,))
+            known_refs: typing.Dict[str, str] = dict(self.db_cursor.fetchall())
+            self.db_cursor.execute(r"""SELECT "last_snapshot_id" FROM "repos" WHERE "id" = ?;""", (repo_id,))
+            known_snapshot_id = self.db_cursor.fetchone()[0]
+
+        # collect everything from the repo first, the git part may take a while
+        snapshot_id = None
+        refs: typing.Dict[str, str] = dict()
+        new_commits: typing.List[bytes] = []
+        storage_bytes = None
+        if not failed and repo is not None:
+            snapshot_id = repo.get_current_snapshot_id()
+            if snapshot_id != known_snapshot_id:
+                refs = repo.get_snapshot_refs(snapshot_id)
+                # the history of the refs recorded last time is in the catalog already
+                new_commits = list(repo.iter_new_commits(set(known_refs.values())))
+                storage_bytes = repo.get_storage_bytes()
+
+        status = "failed" if failed else ("unchanged" if up_to_date else "ok")
+        now = time.time()
+        with self.lock:
+            if run_id is not None:
+                self.db_cursor.execute(r"""
+                    INSERT OR REPLACE INTO "run_status" ("run_id", "repo_id", "status", "error", "finished_at", "seconds")
+                    VALUES (?, ?, ?, ?, ?, ?);
+                """, (run_id, repo_id, status, error, now, metrics.seconds if metrics is not None else None))
+            self.db_cursor.execute(r"""
+                UPDATE "repos" SET "last_run_id" = COALESCE(?, "last_run_id"), "last_status" = ? WHERE "id" = ?;
+            """, (run_id, status, repo_id))
+            if not failed:
+                self.db_cursor.execute(r"""
+                    UPDATE "repos" SET "last_success_at" = ? WHERE "id" = ?;
+                """, (now, repo_id))
+
+            if snapshot_id is not None and snapshot_id != known_snapshot_id:
+                counters = metrics.counters if metrics is not None else dict()
+                self.db_cursor.execute(r"""
+                    INSERT OR REPLACE INTO "snapshots" ("repo_id", "snapshot_id", "timestamp", "ref_count",
+                        "changed_ref_count", "new_object_count")
+                    VALUES (?, ?, ?, ?, ?, ?);
+                """, (repo_id, snapshot_id, repo.get_snapshot_timestamp(snapshot_id), len(refs),
+                      counters.get("changed_refs"), counters.get("new_objects")))
+                self.db_cursor.execute(r"""DELETE FROM "refs" WHERE "repo_id" = ?;""", (repo_id,))
+                self.db_cursor.executemany(r"""
+                    INSERT INTO "refs" ("repo_id", "path", "commit", "snapshot_id") VALUES (?, ?, ?, ?);
+                """, [(repo_id, path, commit, snapshot_id) for path, commit in refs.items()])
+                self.db_cursor.executemany(r"""
+                    INSERT OR IGNORE INTO "commits" ("sha1", "repo_id") VALUES (?, ?);
+                """, [(sha1, repo_id) for sha1 in new_commits])
+                self.db_cursor.execute(r"""
+                    UPDATE "repos" SET "last_snapshot_id" = ?, "storage_bytes" = ? WHERE "id" = ?;
+                """, (snapshot_id, storage_bytes, repo_id))
+            self.db_connection.commit()
+
+    def find_commit(self, sha1: str) -> typing.List[typing.Tuple[str, str, typing.List[str]]]:
+        """
+        Find the repos containing a commit.
+        :param sha1: the full commit sha1 (hex string)
+        :return: (repo URL, backup directory, refs pointing exactly at the commit) for every backup whose history
+                 contains the commit
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""
+                SELECT "repos"."url", "repos"."storage_directory", "refs"."path" FROM "commits"
+                JOIN "repos" ON "repos"."id" = "commits"."repo_id"
+                LEFT JOIN "refs" ON "refs"."repo_id" = "commits"."repo_id" AND "refs"."commit" = ?
+                WHERE "commits"."sha1" = ?
+                ORDER BY "repos"."url", "repos"."storage_directory", "refs"."path";
+            """, (sha1.lower(), bytes.fromhex(sha1)))
+            rows = self.db_cursor.fetchall()
+        ret: typing.Dict[typing.Tuple[str, str], typing.List[str]] = dict()
+        for url, storage_directory, path in rows:
+            ret.setdefault((url, storage_directory), [])
+            if path is not None:
+                ret[(url, storage_directory)].append(path)
+        return [(url, storage_directory, refs) for (url, storage_directory), refs in ret.items()]
+
+    def failed_repos(self, run_id: typing.Union[int, None] = None) -> typing.List[typing.Tuple[str, str]]:
+        """
+        List the repos that failed in a run.
+        :param run_id: the run; None for the latest one
+        :return: (repo URL, error message) pairs
+        """
+        with self.lock:
+            if run_id is None:
+                self.db_cursor.execute(r"""SELECT MAX("id") FROM "runs";""")
+                run_id = self.db_cursor.fetchone()[0]
+            self.db_cursor.execute(r"""
+                SELECT "repos"."url", "run_status"."error" FROM "run_status"
+                JOIN "repos" ON "repos"."id" = "run_status"."repo_id"
+                WHERE "run_status"."run_id" = ? AND "run_status"."status" = 'failed'
+                ORDER BY "repos"."url";
+            """, (run_id,))
+            return self.db_cursor.fetchall()
+
+    def storage_usage(self, group_by: str = "owner") -> typing.List[typing.Tuple[str, int, int]]:
+        """
+        Sum up the disk usage of the backups (not counting shared object pools).
+        :param group_by: "host", "owner" or "repo"
+        :return: (group, number of repos, bytes), largest first
+        """
+        column = {"host": '"host"', "owner": '"host" || \'/\' || "owner"', "repo": '"url"'}[group_by]
+        with self.lock:
+            self.db_cursor.execute(rf"""
+                SELECT {column} AS "group", COUNT(*), COALESCE(SUM("storage_bytes"), 0) FROM "repos"
+                GROUP BY "group" ORDER BY 3 DESC;
+            """)
+            return self.db_cursor.fetchall()
+
+    def expected_durations(self, history: int = 5) -> typing.Dict[
+            typing.Tuple[str, str], typing.Tuple[typing.Union[float, None], typing.Union[int, None]]]:
+        """
+        Estimate how long the backup of every known repo takes, from the runs recorded so far. Only runs that fetched
+        something count: failed runs often fail early, and a run that found the repo unchanged takes a second or so
+        whatever its size. Repos that were never anything but unchanged fall back to those runs.
+        :param history: number of recent runs to average
+        :return: a dict of (url, backup directory relative to the backup root) => (average seconds, or None if never
+                 backed up; storage bytes, or None if unknown)
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""
+                SELECT "repos"."url", "repos"."storage_directory",
+                    COALESCE(AVG(CASE WHEN "recent"."status" = 'ok' THEN "recent"."seconds" END), AVG("recent"."seconds")),
+                    "repos"."storage_bytes"
+                FROM "repos"
+                LEFT JOIN (
+                    SELECT "repo_id", "status", "seconds",
+                        ROW_NUMBER() OVER (PARTITION BY "repo_id", "status" ORDER BY "run_id" DESC) AS "n"
+                    FROM "run_status" WHERE "status" IN ('ok', 'unchanged') AND "seconds" IS NOT NULL
+                ) AS "recent" ON "recent"."repo_id" = "repos"."id" AND "recent"."n" <= ?
+                GROUP BY "repos"."id";
+            """, (history,))
+            return {
+                (url, storage_directory): (seconds, storage_bytes)
+                for url, storage_directory, seconds, storage_bytes in self.db_cursor.fetchall()
+            }
@@ -0,0 +1,315 @@
+import logging
+import heapq
+import signal
+import threading
+import collections
+import time
+import typing
+import git
+from .git_mirror import GitMirroredRepo
+from .metrics import RepoMetrics
+from .utils import get_url_host
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# an idle repo handle still holds its SQLite database with the WAL and shared memory files
+FILES_PER_IDLE_REPO: int = 3
+
+
+def get_default_max_open_repos() -> int:
+    """
+    How many idle repo handles to keep open: as many as fit in half the open file limit, the other half is left for
+    the running backups.
+    :return: the number of handles
+    """
+    try:
+        import resource
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError, OSError):
+        # no resource module on Windows
+        return 64
+    if soft_limit == resource.RLIM_INFINITY:
+        return 1000
+    return max(1, min(1000, soft_limit // 2 // FILES_PER_IDLE_REPO))
+
+
+class BackupDaemon:
+    """
+    Keeps backing up a changing set of repos. Every repo is polled on its own interval, which adapts to how often its
+    references changed in the past; all the repos share one pool of worker threads. Repo handles (the git.Repo and the
+    SQLite connection) stay open between polls, but their git processes are stopped. Repos that disappear from the
+    directories are no longer polled; their backups are kept.
+    """
+
+    def __init__(
+            self: 'BackupDaemon',
+            open_repo: typing.Callable[[str], GitMirroredRepo],
+            discover: typing.Callable[[], typing.Iterable[str]],
+            jobs: int = 1,
+            max_jobs_per_host: int = 0,
+            discovery_interval: float = 3600,
+            min_interval: float = 300,
+            max_interval: float = 86400,
+            max_open_repos: typing.Union[int, None] = None,
+            recursive: bool = True,
+            on_backup: typing.Union[
+                typing.Callable[[str, RepoMetrics, typing.Union[GitMirroredRepo, None], typing.Union[str, None]], None],
+                None
+            ] = None,
+    ) -> None:
+        """
+        :param open_repo: opens (or creates) the backup of a repo URL
+        :param discover: lists the repo URLs to back up; called again every discovery_interval
+        :param jobs: the number of worker threads, i.e. the global concurrency budget
+        :param max_jobs_per_host: the max number of concurrent jobs against the same host; 0 means unlimited
+        :param discovery_interval: seconds between two discovery runs
+        :param min_interval: shortest polling interval of a repo, in seconds
+        :param max_interval: longest polling interval of a repo, in seconds
+        :param max_open_repos: the least recently used repo handles are closed above this number; None to derive it
+                               from the open file limit
+        :param recursive: back up the submodules too
+        :param on_backup: called after every backup attempt with the URL, the metrics, the repo (None if it could not
+                          be opened) and the error message (None on success)
+        """
+        self.open_repo = open_repo
+        self.discover = discover
+        self.jobs: int = max(1, int(jobs))
+        self.max_jobs_per_host: int = max(0, int(max_jobs_per_host))
+        self.discovery_interval: float = discovery_interval
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.max_open_repos: int = max(1, int(max_open_repos)) if max_open_repos is not None \
+            else get_default_max_open_repos()
+        self.recursive: bool = recursive
+        self.on_backup = on_backup
+
+        self.lock: threading.Condition = threading.Condition()
+        # (due time, url); a url is either in here or running, never both
+        self.due: typing.List[typing.Tuple[float, str]] = []
+        self.known: typing.Set[str] = set()
+        # the repos found by the last complete discovery run, as opposed to submodules
+        self.discovered: typing.Set[str] = set()
+        # repos removed while they were being backed up; they are dropped when the backup finishes
+        self.removed: typing.Set[str] = set()
+        self.running_per_host: typing.Dict[str, int] = collections.defaultdict(int)
+        # open handles of the repos not being backed up right now, least recently used first
+        self.handles: typing.Dict[str, GitMirroredRepo] = collections.OrderedDict()
+        self.stopped: threading.Event = threading.Event()
+
+    def add(self, url: str) -> bool:
+        """
+        Start polling a repo; it is backed up as soon as a worker is free. Thread safe.
+        :param url: repo URL
+        :return: True if the repo is new
+        """
+        with self.lock:
+            if url in self.known:
+                return False
+            self.known.add(url)
+            if url in self.removed:
+                # still running, and rescheduled as usual when done
+                self.removed.discard(url)
+                return True
+            heapq.heappush(self.due, (time.monotonic(), url))
+            self.lock.notify_all()
+            return True
+
+    def remove_vanished(self, found: typing.Set[str]) -> typing.Set[str]:
+        """
+        Stop polling the repos that the last discovery run found, but this one did not. Submodules are not affected.
+        A repo being backed up right now is dropped when its backup finishes. Thread safe.
+        :param found: the repos found by a complete discovery run
+        :return: the repos removed
+        """
+        evicted = []
+        with self.lock:
+            vanished = self.discovered - found
+            self.discovered = set(found)
+            vanished &= self.known
+            if len(vanished) == 0:
+                return vanished
+            self.known -= vanished
+            waiting = set(url for _, url in self.due if url in vanished)
+            self.due = [item for item in self.due if item[1] not in vanished]
+            heapq.heapify(self.due)
+            self.removed |= vanished - waiting
+            for url in vanished:
+                if url in self.handles:
+                    evicted.append(self.handles.pop(url))
+        for e in evicted:
+            e.close()
+        return vanished
+
+    def stop(self) -> None:
+        """
+        Ask the daemon to exit. Running backups are finished first.
+        :return: None
+        """
+        self.stopped.set()
+        with self.lock:
+            self.lock.notify_all()
+
+    def __take(self) -> typing.Union[typing.Tuple[str, str], float]:
+        """
+        Pick the repo due first whose host still has free slots. Must be called with the lock held.
+        :return: (host, url), or the seconds until something may be due
+        """
+        now = time.monotonic()
+        skipped = []
+        ret: typing.Union[typing.Tuple[str, str], float] = self.min_interval
+        while len(self.due) > 0 and self.due[0][0] <= now:
+            item = heapq.heappop(self.due)
+            host = get_url_host(item[1])
+            if self.max_jobs_per_host and host and self.running_per_host[host] >= self.max_jobs_per_host:
+                skipped.append(item)
+                continue
+            ret = host, item[1]
+            break
+        for item in skipped:
+            heapq.heappush(self.due, item)
+        if isinstance(ret, tuple):
+            return ret
+        if len(self.due) > 0 and self.due[0][0] > now:
+            ret = min(ret, self.due[0][0] - now)
+        return ret
+
+    def __checkout(self, url: str) -> GitMirroredRepo:
+        with self.lock:
+            m = self.handles.pop(url, None)
+        return m if m is not None else self.open_repo(url)
+
+    def __checkin(self, url: str, m: GitMirroredRepo) -> None:
+        m.release()
+        evicted = []
+        with self.lock:
+            self.handles[url] = m
+            while len(self.handles) > self.max_open_repos:
+                evicted.append(self.handles.popitem(last=False)[1])
+        for e in evicted:
+            e.close()
+
+    def __backup(self, url: str) -> float:
+        """
+        Back up a repo once.
+        :param url: repo URL
+        :return: seconds until the next backup
+        """
+        metrics = RepoMetrics(url)
+        interval = self.min_interval
+        m = None
+        error = None
+        try:
+            with metrics.phase("init"):
+                m = self.__checkout(url)
+            m.metrics = metrics
+            m.update()
+            m.snapshot()
+            m.save_metrics()
+            if self.recursive:
+                for d in m.submodules():
+                    if self.add(d):
+                        logger.info(f"{d} appended to the queue")
+            interval = m.estimate_poll_interval(self.min_interval, self.max_interval)
+        except Exception as ex:
+            metrics.success = False
+            error = str(ex)
+            if isinstance(ex, git.exc.GitCommandError):
+                logger.exception(f"{url}: `{' '.join(ex.command)}` failed with error {ex.stderr}", stack_info=False)
+            else:
+                logger.exception(f"{url}: backup failed")
+
+        if self.on_backup is not None:
+            try:
+                self.on_backup(url, metrics, m, error)
+            except Exception:
+                logger.exception(f"{url}: post-backup hook failed")
+        if m is not None:
+            if error is None:
+                self.__checkin(url, m)
+            else:
+                # the handle may be in any state now; start afresh next time
+                m.close()
+        return interval
+
+    def __worker_loop(self) -> None:
+        while not self.stopped.is_set():
+            with self.lock:
+                job = self.__take()
+                if not isinstance(job, tuple):
+                    self.lock.wait(job)
+                    continue
+                host, url = job
+                self.running_per_host[host] += 1
+
+            logger.info(f"Backing up {url} ...")
+            interval = self.__backup(url)
+            logger.info(f"{url}: next backup in {int(interval)}s")
+
+            evicted = None
+            with self.lock:
+                self.running_per_host[host] -= 1
+                if url in self.removed:
+                    self.removed.discard(url)
+                    evicted = self.handles.pop(url, None)
+                    logger.info(f"{url} is no longer polled")
+                else:
+                    heapq.heappush(self.due, (time.monotonic() + interval, url))
+                self.lock.notify_all()
+            if evicted is not None:
+                evicted.close()
+
+    def __discovery_loop(self) -> None:
+        while not self.stopped.is_set():
+            count = 0
+            found = set()
+            try:
+                for r in self.discover():
+                    found.add(r)
+                    if self.add(r):
+                        count += 1
+            except Exception:
+                logger.exception("Repo discovery failed")
+                # an incomplete list says nothing about the repos missing from it
+                found = None
+            if found is not None:
+                for r in sorted(self.remove_vanished(found)):
+                    logger.info(f"{r} is gone from the directories, it is no longer polled")
+            logger.info(f"Discovery finished, {count} new repos, {len(self.known)} repos in total")
+            self.stopped.wait(self.discovery_interval)
+
+    def __on_signal(self, signum: int, frame: typing.Any) -> None:
+        logger.info(f"{signal.Signals(signum).name} received, waiting for the running backups to finish...")
+        self.stop()
+
+    def run(self) -> None:
+        """
+        Run until stop() is called, or until SIGTERM or SIGINT if called from the main thread. The running backups
+        are finished first.
+        :return: None
+        """
+        previous_handlers = dict()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(signum, self.__on_signal)
+        threads = [threading.Thread(target=self.__discovery_loop, name="umbrella-discovery", daemon=True)]
+        threads += [
+            threading.Thread(target=self.__worker_loop, name=f"umbrella-worker-{i}", daemon=True)
+            for i in range(self.jobs)
+        ]
+        for t in threads:
+            t.start()
+        try:
+            while not self.stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            logger.info("Interrupted, waiting for the running backups to finish...")
+            self.stop()
+        finally:
+            # a second signal interrupts the running backups
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler if handler is not None else signal.SIG_DFL)
+        for t in threads[1:]:
+            t.join()
+        for m in self.handles.values():
+            m.close()
+        self.handles.clear()
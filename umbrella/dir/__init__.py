@@ -1,9 +1,105 @@
 import typing
+import hashlib
+import importlib
+import functools
+from urllib.parse import urlencode
+from .cache import DiscoveryCache, CacheEntry
+
+# third party providers register under this entry point group, e.g. in their setup.py:
+#     entry_points={"umbrella.dir_providers": ["gitlab = umbrella_gitlab:GitLabDirProvider"]}
+PROVIDER_ENTRY_POINT_GROUP: str = "umbrella.dir_providers"
+# the providers that come with umbrella, as "module:class"; found even if umbrella runs from a source checkout
+BUILTIN_PROVIDERS: typing.Dict[str, str] = {
+    "null": "umbrella.dir.null:NullDirProvider",
+    "github": "umbrella.dir.github:GitHubDirProvider",
+}
 
 class DirProvider:
-    def __init__(self, config, auth_rule_matcher):
+    def __init__(self, config, auth_rule_matcher, cache: typing.Union[DiscoveryCache, None] = None):
         self.config = config
         self.auth_rule_matcher = auth_rule_matcher
-    
-    def search(self) -> typing.List[typing.AnyStr]:
+        self.cache = cache
+
+    def search(self) -> typing.Iterator[typing.AnyStr]:
+        """
+        Stream the URLs of the repos found. Yield them as soon as they are known, the backups start right away.
+        """
         raise NotImplementedError()
+
+    @staticmethod
+    def cache_key(url: str, params: typing.Union[typing.Dict[str, typing.Any], None] = None, auth=None) -> str:
+        """
+        Identify a request in the discovery cache. Different credentials may see different results, so the username
+        is part of the key (hashed, to keep it out of the cache file).
+        """
+        key = url
+        if params:
+            key += ("&" if "?" in url else "?") + urlencode(sorted(params.items()))
+        username = getattr(auth, "username", None)
+        if username:
+            key += "#" + hashlib.sha256(str(username).encode("utf-8")).hexdigest()
+        return key
+
+    def cached_get_json(self, session, url: str, params=None, auth=None, headers=None):
+        """
+        GET a JSON document through the discovery cache. If a cached copy exists, the request carries its validators
+        (If-None-Match / If-Modified-Since) and a 304 answer is served from the cache.
+        :param session: the requests.Session to use
+        :param url: request URL
+        :param params: query parameters
+        :param auth: requests auth object
+        :param headers: extra request headers
+        :return: (the response, the parsed JSON or None on errors, the parsed Link header)
+        """
+        key = self.cache_key(url, params, auth)
+        entry = self.cache.get(key) if self.cache is not None else None
+
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        r = session.get(url, params=params, auth=auth, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            self.cache.touch(key)
+            return r, entry.data, entry.links
+        if r.status_code != 200:
+            return r, None, {}
+
+        try:
+            data = r.json()
+        except ValueError:
+            # e.g. the HTML error page of a proxy
+            return r, None, {}
+        if self.cache is not None and ('ETag' in r.headers or 'Last-Modified' in r.headers):
+            self.cache.put(key, CacheEntry(r.headers.get('ETag'), r.headers.get('Last-Modified'), data, r.links))
+        return r, data, r.links
+
+
+def _iter_provider_entry_points() -> typing.Iterable[typing.Any]:
+    from importlib.metadata import entry_points
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=PROVIDER_ENTRY_POINT_GROUP)
+    # Python < 3.10
+    return eps.get(PROVIDER_ENTRY_POINT_GROUP, [])
+
+
+@functools.lru_cache(maxsize=None)
+def get_provider(name: str) -> typing.Union[typing.Type[DirProvider], None]:
+    """
+    Find a directory provider by name. Only the module of that provider is imported, so e.g. requests is not loaded
+    unless a provider needs it. Built-in providers are found without reading any package metadata.
+    :param name: provider name, case insensitive
+    :return: the provider class, or None if there is no provider with that name
+    """
+    name = name.lower()
+    if name in BUILTIN_PROVIDERS:
+        module_name, _, class_name = BUILTIN_PROVIDERS[name].partition(":")
+        return getattr(importlib.import_module(module_name), class_name)
+    for ep in _iter_provider_entry_points():
+        if ep.name.lower() == name:
+            return ep.load()
+    return None
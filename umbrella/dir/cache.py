@@ -0,0 +1,113 @@
+import logging
+import sqlite3
+import threading
+import json
+import time
+import typing
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class CacheEntry(typing.NamedTuple):
+    etag: typing.Union[str, None]
+    last_modified: typing.Union[str, None]
+    data: typing.Any
+    links: typing.Dict[str, typing.Any]
+
+
+class DiscoveryCache:
+    """
+    On-disk cache of directory provider responses, used to send conditional HTTP requests.
+    Entries are dropped after `ttl` seconds, and the least recently used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path: typing.AnyStr, ttl: float = 7 * 24 * 3600, max_entries: int = 100000) -> None:
+        self.path: str = str(path)
+        self.ttl: float = float(ttl)
+        self.max_entries: int = int(max_entries)
+        self.lock: threading.Lock = threading.Lock()
+
+        # providers query the cache from their worker threads; all the access is serialized by self.lock
+        self.db_connection: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.db_cursor: sqlite3.Cursor = self.db_connection.cursor()
+        self.db_cursor.execute(r"""PRAGMA journal_mode = WAL;""")
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "responses" (
+                "key"	TEXT,
+                "etag"	TEXT,
+                "last_modified"	TEXT,
+                "data"	TEXT,
+                "links"	TEXT,
+                "stored_at"	REAL,
+                "used_at"	REAL,
+                PRIMARY KEY("key")
+        );""")
+        self.db_cursor.execute(r"""
+            CREATE INDEX IF NOT EXISTS "responses_used_at" ON "responses" ("used_at");
+        """)
+        self.db_connection.commit()
+        self.evict()
+
+    def get(self, key: str) -> typing.Union[CacheEntry, None]:
+        """
+        Look up a cached response.
+        :param key: cache key, see DirProvider.cache_key()
+        :return: the entry, or None if there isn't a fresh one
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""
+                SELECT "etag", "last_modified", "data", "links" FROM "responses" WHERE "key" = ? AND "stored_at" >= ?;
+            """, (key, time.time() - self.ttl))
+            row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        return CacheEntry(row[0], row[1], json.loads(row[2]), json.loads(row[3]))
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        """
+        Store a response.
+        :param key: cache key
+        :param entry: the validators and the parsed content of the response
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            self.db_cursor.execute(r"""
+                INSERT OR REPLACE INTO "responses" ("key", "etag", "last_modified", "data", "links", "stored_at", "used_at")
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+            """, (key, entry.etag, entry.last_modified, json.dumps(entry.data), json.dumps(entry.links), now, now))
+            self.db_connection.commit()
+
+    def touch(self, key: str) -> None:
+        """
+        Mark an entry as just revalidated by the server.
+        :param key: cache key
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            self.db_cursor.execute(r"""
+                UPDATE "responses" SET "stored_at" = ?, "used_at" = ? WHERE "key" = ?;
+            """, (now, now, key))
+            self.db_connection.commit()
+
+    def evict(self) -> None:
+        """
+        Drop expired entries, then the least recently used ones until the cache fits in max_entries.
+        :return: None
+        """
+        with self.lock:
+            self.db_cursor.execute(r"""
+                DELETE FROM "responses" WHERE "stored_at" < ?;
+            """, (time.time() - self.ttl,))
+            self.db_cursor.execute(r"""
+                DELETE FROM "responses" WHERE "key" IN (
+                    SELECT "key" FROM "responses" ORDER BY "used_at" DESC LIMIT -1 OFFSET ?
+                );
+            """, (self.max_entries,))
+            if self.db_cursor.rowcount > 0:
+                logger.debug(f"{self.db_cursor.rowcount} discovery cache entries evicted")
+            self.db_connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db_connection.close()
@@ -1,67 +1,202 @@
 from . import DirProvider
 import requests
+import requests.adapters
+import concurrent.futures
+import collections
+import threading
 import logging
+import time
 import re
+import typing
+from urllib.parse import urlsplit, parse_qs
 
 logger: logging.Logger = logging.getLogger(__name__)
 
+
+class GitHubRateLimiter:
+    """
+    Tracks GitHub's rate limit headers and holds back requests when the quota is about to run out.
+    https://docs.github.com/en/rest/overview/resources-in-the-rest-api#rate-limiting
+    """
+
+    def __init__(self, reserve: int = 10) -> None:
+        """
+        :param reserve: stop sending requests when this many remain in the current window
+        """
+        self.reserve: int = reserve
+        self.lock: threading.Lock = threading.Lock()
+        self.remaining: typing.Union[int, None] = None
+        self.reset_at: float = 0
+
+    def wait(self) -> None:
+        """
+        Block until a request may be sent.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                if self.remaining is None or self.remaining > self.reserve or time.time() >= self.reset_at:
+                    if self.remaining is not None:
+                        # count the request we are about to send
+                        self.remaining -= 1
+                    return
+                delay = self.reset_at - time.time() + 1
+            logger.warning(f"GitHub API rate limit nearly exhausted, waiting {int(delay)}s for the reset")
+            time.sleep(delay)
+
+    def update(self, r: requests.Response) -> float:
+        """
+        Learn the current quota from a response.
+        :param r: the response
+        :return: seconds to wait before retrying if the request was rejected by the rate limit, otherwise 0
+        """
+        with self.lock:
+            if "X-RateLimit-Remaining" in r.headers:
+                self.remaining = int(r.headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in r.headers:
+                self.reset_at = float(r.headers["X-RateLimit-Reset"])
+
+            if r.status_code in (403, 429):
+                if "Retry-After" in r.headers:
+                    # secondary rate limit
+                    return float(r.headers["Retry-After"])
+                if self.remaining == 0:
+                    return max(self.reset_at - time.time(), 0) + 1
+        return 0
+
+
 class GitHubDirProvider(DirProvider):
-    def search(self):
+    per_page: int = 100
+    max_retries: int = 3
+
+    def __init__(self, config, auth_rule_matcher, cache=None):
+        super().__init__(config, auth_rule_matcher, cache)
+        self.concurrency: int = int(self.config.get('concurrency', 4))
+        self.rate_limiter = GitHubRateLimiter(int(self.config.get('rate_limit_reserve', 10)))
+
+        # one pooled session for all the requests, so TLS connections are reused
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'user-agent': 'umbrella/0 (+https://github.com/Jamesits/umbrella)',
+            'Accept': 'application/vnd.github.v3+json',
+        })
+
+    def __get_auth(self, url: str):
+        # search for the auth strategy
+        auth_strategy = self.auth_rule_matcher.match(url)
+        if auth_strategy['type'] == "username_password":
+            from requests.auth import HTTPBasicAuth
+            return HTTPBasicAuth(auth_strategy['username'], auth_strategy['password'])
+        elif auth_strategy['type'] == 'null':
+            return None
+        else:
+            logger.error(f"Unknown auth type {auth_strategy['type']}")
+            return None
+
+    def __get_page(self, url: str, page: int, auth) -> typing.Tuple[typing.List[typing.Any], typing.Dict[str, typing.Any]]:
+        """
+        Load one page of a listing.
+        :param url: API URL of the listing
+        :param page: page number, starting from 1
+        :param auth: requests auth object
+        :return: (the parsed items, the parsed Link header)
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            logger.debug(f"{url} loading page {page}")
+            # unchanged pages are answered with 304, which doesn't count against the rate limit
+            r, data, links = self.cached_get_json(
+                self.session,
+                url,
+                params={
+                    "sort": "full_name",
+                    "direction": "asc",
+                    "per_page": self.per_page,
+                    "page": page,
+                },
+                auth=auth,
+            )
+            retry_after = self.rate_limiter.update(r)
+            if retry_after > 0 and attempt < self.max_retries:
+                logger.warning(f"{r.url} hit the rate limit, retrying in {int(retry_after)}s")
+                time.sleep(retry_after)
+                continue
+            break
+
+        if data is None:
+            logger.error(f"{r.url} returned {r.status_code}: {r.text}")
+            return [], {}
+
+        if isinstance(data, dict):
+            # a single object rather than a listing
+            data = [data]
+        return data, links
+
+    @staticmethod
+    def __page_count(links: typing.Dict[str, typing.Any]) -> typing.Union[int, None]:
+        """
+        Find out the number of pages from the Link header.
+        https://docs.github.com/en/rest/guides/using-pagination-in-the-rest-api
+        :param links: the parsed Link header
+        :return: the page number of the last page, or None if unknown
+        """
+        if "last" not in links:
+            return None
+        try:
+            return int(parse_qs(urlsplit(links["last"]["url"]).query)["page"][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def __repo_urls(items: typing.List[typing.Any]) -> typing.List[str]:
         ret = []
-        per_page = 100
+        for repo in items:
+            if not isinstance(repo, dict):
+                continue
+            if "clone_url" in repo:
+                ret.append(repo["clone_url"])
+            if "has_wiki" in repo and repo['has_wiki'] == True:
+                ret.append(repo['html_url'] + '.wiki.git')
+        return ret
 
+    def search(self):
         api_endpoint = 'https://api.github.com'
         if 'api_endpoint' in self.config:
             api_endpoint = self.config['api_endpoint']
-        
-        if 'searches' in self.config:
-            for s in self.config['searches']:
-                url = f"{api_endpoint}/{s}"
-                # GitHub api doesn't support `//`` in URL, we need to fix that
-                url = re.subn('/+', '/', url)[0].replace(":/", "://")
-                headers = {
-                    'user-agent': 'umbrella/0 (+https://github.com/Jamesits/umbrella)',
-                    'Accept': 'application/vnd.github.v3+json',
-                }
-
-                # search for the auth strategy
-                auth = None
-                auth_strategy = self.auth_rule_matcher.match(f"{api_endpoint}/{s}")
-                if auth_strategy['type'] == "username_password":
-                    from requests.auth import HTTPBasicAuth
-                    auth = HTTPBasicAuth(auth_strategy['username'], auth_strategy['password'])
-                elif auth_strategy['type'] == 'null':
-                    auth = None
-                else:
-                    logger.error(f"Unknown auth type {auth_strategy['type']}")
-
-                current_page = 1
-                while True:
-                    logger.debug(f"{url} loading page {current_page}")
-                    r = requests.get(
-                        url,
-                        params={
-                            "sort": "full_name",
-                            "direction": "asc",
-                            "per_page": per_page,
-                            "page": current_page,
-                        },
-                        headers=headers,
-                        auth=auth,
-                    )
-
-                    if r.status_code != 200:
-                        logger.error(f"{r.url} returned {r.status_code}: {r.text}")
-                    
-                    for repo in r.json():
-                        if "clone_url" in repo:
-                            ret.append(repo["clone_url"])
-                        if "has_wiki" in repo and repo['has_wiki'] == True:
-                            ret.append(repo['html_url'] + '.wiki.git')
-
-                    if len(r.json()) < per_page:
-                        break
-                    else:
-                        current_page += 1
-
-        return ret
\ No newline at end of file
+
+        searches = []
+        for s in self.config.get('searches', None) or []:
+            url = f"{api_endpoint}/{s}"
+            # GitHub api doesn't support `//`` in URL, we need to fix that
+            url = re.subn('/+', '/', url)[0].replace(":/", "://")
+            searches.append((url, self.__get_auth(f"{api_endpoint}/{s}")))
+
+        # (search index, page number) of the pages still to be requested; the first page of every search goes first,
+        # the other pages are known once the first page's Link header has arrived
+        to_load: typing.Deque[typing.Tuple[int, int]] = collections.deque((i, 1) for i in range(len(searches)))
+        # keep a bounded number of pages in flight, so results don't pile up in memory faster than they are consumed
+        window = self.concurrency * 2
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight: typing.Dict[concurrent.futures.Future, typing.Tuple[int, int]] = dict()
+            while len(to_load) > 0 or len(in_flight) > 0:
+                while len(to_load) > 0 and len(in_flight) < window:
+                    i, page = to_load.popleft()
+                    url, auth = searches[i]
+                    in_flight[executor.submit(self.__get_page, url, page, auth)] = (i, page)
+
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    i, page = in_flight.pop(f)
+                    items, links = f.result()
+                    if page == 1:
+                        page_count = self.__page_count(links)
+                        if page_count is not None:
+                            to_load.extend((i, p) for p in range(2, page_count + 1))
+                    if "next" in links and self.__page_count(links) is None:
+                        # no "last" link; walk the "next" links one by one
+                        to_load.append((i, page + 1))
+                    yield from self.__repo_urls(items)
@@ -2,4 +2,4 @@ from . import DirProvider
 
 class NullDirProvider(DirProvider):
     def search(self):
-        return self.config['repos']
+        yield from self.config['repos']
@@ -5,15 +5,55 @@ import shutil
 import pathlib
 import typing
 import sqlite3
+import itertools
+import hashlib
+import subprocess
+import random
+import io
+import json
+import tempfile
+import glob
 import git
-from .utils import url_hide_sensitive, get_timestamp, get_os_string
+from .utils import url_hide_sensitive, get_timestamp, get_os_string, resolve_submodule_url
+from .git_objects import GitObjectInfoReader, GitObjectHashReader, GitObjectContentReader, GitObjectNameResolver
+from .pack_index import iter_object_sha1s, iter_loose_object_sha1s, list_pack_indexes, list_alternates, \
+    write_keep_files, PackIndex, ObjectDirectory
+from .metrics import RepoMetrics, get_object_store_bytes, get_directory_size
+from .object_pool import ObjectPool
+from .bitmap import ObjectBitmap
 
 UMBRELLA_CORE_VERSION: int = 1
+# version of the per-repo database layout, stored in umbrella_config
+# 1: initial layout
+# 2: objects_sha1 is a WITHOUT ROWID table
+# 3: refs_history and content-addressed configs replace refs_snapshot_{id} and configs
+# 4: objects_sha1 numbers the objects (object_id), reachability_bitmaps
+UMBRELLA_DB_SCHEMA_VERSION: int = 4
+# how the objects are kept on disk, stored in umbrella_config
+# loose: every pack is exploded into loose objects, so GC can never lose anything
+# packed: packs are kept as they are fetched (protected by .keep files) and rolled up into archive packs now and then
+STORAGE_LAYOUTS: typing.Tuple[str, ...] = ("loose", "packed")
+# content of the .keep files; tells the archive packs apart from the packs as fetched
+PACK_KEEP_MARKER: str = "umbrella\n"
+ARCHIVE_PACK_KEEP_MARKER: str = "umbrella archive\n"
 logger: logging.Logger = logging.getLogger(__name__)
 
 
 class GitMirroredRepo:
     askpass_py_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'askpass.py')
+    # how many objects to send to `git cat-file --batch-check` at once
+    object_details_batch_size: int = 10000
+    # how many rows to write into SQLite in one transaction
+    db_bulk_chunk_size: int = 50000
+    # above this many new commits, LFS objects are fetched for the whole history instead of commit by commit
+    lfs_max_incremental_commits: int = 1000
+    # how many revisions to put on a single git command line
+    revisions_per_command: int = 100
+    # packed layout: roll up into an archive pack once there are this many fetched packs, or this many loose objects
+    archive_pack_threshold: int = 50
+    archive_loose_object_threshold: int = 10000
+    # the first fetch of a repo is split into batches of this many refs, so an interrupted one can be resumed
+    initial_fetch_refs_per_batch: int = 50
 
     def __init__(
             self: 'GitMirroredRepo',
@@ -25,11 +65,33 @@ class GitMirroredRepo:
             git_ssh_key_path: typing.Union[typing.AnyStr, None] = None,
 
             git_lfs_enable: bool = True,
+            git_lfs_concurrent_transfers: typing.Union[int, None] = None,
+            skip_unchanged: bool = True,
+            metrics: typing.Union[RepoMetrics, None] = None,
+            storage_layout: typing.Union[str, None] = None,
+            object_pool_directory: typing.Union[typing.AnyStr, None] = None,
+            seed: typing.Union[typing.AnyStr, None] = None,
     ) -> None:
         self.storage_directory: str = str(storage_directory)
         self.upstream_url: typing.Union[str, None] = str(upstream_url) if upstream_url is not None else None
         self.repo: typing.Union[git.Repo, None] = None
         self.git_lfs_enabled: bool = git_lfs_enable
+        self.git_lfs_concurrent_transfers: typing.Union[int, None] = git_lfs_concurrent_transfers
+        # compare the upstream refs with the last snapshot before fetching anything
+        self.skip_unchanged: bool = skip_unchanged
+        # set by update() when the upstream has not changed since the last snapshot
+        self.up_to_date: bool = False
+        self.metrics: RepoMetrics = metrics if metrics is not None else RepoMetrics(self.upstream_url or "")
+        if storage_layout is not None and storage_layout not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout {storage_layout}")
+        # the layout asked for; only applies to new repos, existing ones keep theirs until migrated
+        self.storage_layout: typing.Union[str, None] = storage_layout
+        # share the objects with related repos (e.g. forks) through this pool
+        self.object_pool_directory: typing.Union[str, None] = \
+            str(object_pool_directory) if object_pool_directory is not None else None
+        # a git bundle or a local clone to take the objects from before the first fetch from upstream; git runs
+        # inside the git directory, so a relative path is resolved against the working directory here
+        self.seed: typing.Union[str, None] = os.path.abspath(str(seed)) if seed is not None else None
 
         self.git_username = git_username
         self.git_environment: typing.Dict[str, str] = dict()
@@ -63,22 +125,78 @@ class GitMirroredRepo:
         :return:
         """
         logger.debug("Initializing database connection...")
-        self.db_connection = sqlite3.connect(self.sqlite3_db_file)
+        # a repo may be opened in one thread and backed up in another (e.g. in daemon mode), but never concurrently
+        self.db_connection = sqlite3.connect(self.sqlite3_db_file, check_same_thread=False)
         self.db_cursor = self.db_connection.cursor()
 
+        # WAL + relaxed sync: a crash can only lose the last transactions, never corrupt the database
+        # https://www.sqlite.org/wal.html
+        self.db_cursor.execute(r"""PRAGMA journal_mode = WAL;""")
+        self.db_cursor.execute(r"""PRAGMA synchronous = NORMAL;""")
+        self.db_cursor.execute(r"""PRAGMA temp_store = MEMORY;""")
+        self.db_cursor.execute(r"""PRAGMA cache_size = -65536;""")
+
         self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "umbrella_config" (
             	"key"	TEXT,
                 "value"	TEXT,
                 PRIMARY KEY("key")
         );""")
 
+        # an older umbrella may have been stopped halfway through the schema version 2 migration
+        if self.__db_table_exists("objects_sha1") or self.__db_table_exists("objects_sha1_migration"):
+            schema_version = int(self.__db_get_config("schema_version", 1))
+            if schema_version < UMBRELLA_DB_SCHEMA_VERSION:
+                self.__db_migrate(schema_version)
+
+        self.__db_create_tables()
+
+        # the id=0 record denotes the information when the database is initialized
+        # it is not a real snapshot
+        self.db_cursor.execute(r"""
+            INSERT OR IGNORE INTO "snapshots" ("id", "timestamp", "umbrella_core_version", "os") VALUES (?, ?, ?, ?);
+        """, (0, get_timestamp(), UMBRELLA_CORE_VERSION, get_os_string()))
+
+        self.__db_set_config("schema_version", UMBRELLA_DB_SCHEMA_VERSION)
+
+        if self.__db_get_config("last_complete_snapshot") is None:
+            # snapshots taken before completion was tracked are all complete
+            self.__db_set_config("last_complete_snapshot", self.__db_get_last_snapshot_id())
+
+        stored_layout = self.__db_get_config("storage_layout")
+        if stored_layout is None:
+            # repos backed up before the layout was configurable are all loose
+            stored_layout = "loose" if self.__db_get_current_snapshot_id() > 0 else (self.storage_layout or "loose")
+            self.__db_set_config("storage_layout", stored_layout)
+        elif self.storage_layout is not None and self.storage_layout != stored_layout:
+            logger.warning(f"{self.storage_directory} uses the {stored_layout} storage layout, "
+                           f"run `umbrella migrate --storage-layout {self.storage_layout}` to convert it")
+        self.storage_layout = stored_layout
+
+        if self.__db_get_config("initial_fetch_complete") is None and self.__db_get_current_snapshot_id() > 0:
+            # backed up before the initial fetch was tracked
+            self.__db_set_config("initial_fetch_complete", 1)
+
+        self.db_connection.commit()
+
+    def __db_create_tables(self) -> None:
+        """
+        Create the tables of the current database layout if they don't exist.
+        :return: None
+        """
+        # the sha1 is all we look up by, so there is no point in keeping a separate rowid b-tree
         self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "objects_sha1" (
                 "sha1"	BLOB,
                 "type"  TEXT,
                 "size"  INTEGER,
                 "first_appearance_in_snapshots"	INTEGER,
+                "object_id"	INTEGER,
                 PRIMARY KEY("sha1")
-        );""")
+        ) WITHOUT ROWID;""")
+        # a stable number for every object, handed out in the order the objects arrive; the reachability bitmaps
+        # are indexed by it
+        self.db_cursor.execute(r"""
+            CREATE UNIQUE INDEX IF NOT EXISTS "objects_sha1_object_id" ON "objects_sha1" ("object_id");
+        """)
 
         self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "snapshots" (
                 "id"	INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -87,22 +205,194 @@ class GitMirroredRepo:
                 "os"	TEXT
         );""")
 
-        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "configs" (
+        # every row is one value a ref had, from snapshot "valid_from" up to (excluding) "valid_until"
+        # "valid_until" is NULL while the value is still current
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "refs_history" (
+                "path"	TEXT,
+                "commit"	TEXT,
+                "valid_from"	INTEGER,
+                "valid_until"	INTEGER,
+                PRIMARY KEY("path", "valid_from")
+        );""")
+        self.db_cursor.execute(r"""
+            CREATE INDEX IF NOT EXISTS "refs_history_valid_from" ON "refs_history" ("valid_from");
+        """)
+        self.db_cursor.execute(r"""
+            CREATE INDEX IF NOT EXISTS "refs_history_valid_until" ON "refs_history" ("valid_until");
+        """)
+
+        # Git config files, keyed by the sha1 of their content
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "config_contents" (
+                "sha1"	TEXT,
+                "content"	BLOB,
+                PRIMARY KEY("sha1")
+        );""")
+
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "snapshot_configs" (
                 "snapshot_id"	INTEGER PRIMARY KEY,
-                "content"	BLOB
+                "config_sha1"	TEXT
         );""")
 
-        # the id=0 record denotes the information when the database is initialized
-        # it is not a real snapshot
+        # performance history, one row per phase per run; snapshot_id is NULL if the run made no snapshot
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "phase_timings" (
+                "run_timestamp"	REAL,
+                "snapshot_id"	INTEGER,
+                "phase"	TEXT,
+                "seconds"	REAL
+        );""")
         self.db_cursor.execute(r"""
-            INSERT OR IGNORE INTO "snapshots" ("id", "timestamp", "umbrella_core_version", "os") VALUES (?, ?, ?, ?);
-        """, (0, get_timestamp(), UMBRELLA_CORE_VERSION, get_os_string()))
+            CREATE INDEX IF NOT EXISTS "phase_timings_run_timestamp" ON "phase_timings" ("run_timestamp");
+        """)
 
+        # submodule URLs found in every `.gitmodules` blob ever seen, as written in the file (JSON list)
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "gitmodules_cache" (
+                "blob_sha1"	TEXT,
+                "urls"	TEXT,
+                PRIMARY KEY("blob_sha1")
+        ) WITHOUT ROWID;""")
+
+        # the objects reachable from the refs of every snapshot, as a zlib compressed ObjectBitmap
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "reachability_bitmaps" (
+                "snapshot_id"	INTEGER PRIMARY KEY,
+                "object_count"	INTEGER,
+                "bitmap"	BLOB
+        );""")
+
+        self.db_cursor.execute(r"""CREATE TABLE IF NOT EXISTS "run_counters" (
+                "run_timestamp"	REAL,
+                "name"	TEXT,
+                "value"	INTEGER,
+                PRIMARY KEY("run_timestamp", "name")
+        );""")
+
+    def __db_table_exists(self, table_name: str) -> bool:
+        self.db_cursor.execute(r"""
+            SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;
+        """, (table_name,))
+        return self.db_cursor.fetchone() is not None
+
+    def __db_get_config(self, key: str, default: typing.Any = None) -> typing.Any:
+        """
+        Read a value from the umbrella_config table.
+        :param key: config key
+        :param default: returned if the key does not exist
+        :return: the stored value (as text)
+        """
+        self.db_cursor.execute(r"""
+            SELECT "value" FROM "umbrella_config" WHERE "key" = ?;
+        """, (key,))
+        row = self.db_cursor.fetchone()
+        return default if row is None else row[0]
+
+    def __db_set_config(self, key: str, value: typing.Any) -> None:
+        """
+        Write a value into the umbrella_config table. Does not commit.
+        :param key: config key
+        :param value: config value
+        :return: None
+        """
+        self.db_cursor.execute(r"""
+            INSERT OR REPLACE INTO "umbrella_config" ("key", "value") VALUES (?, ?);
+        """, (key, str(value)))
+
+    def __db_migrate(self, schema_version: int) -> None:
+        """
+        Upgrade a database created by an older version of umbrella to the current layout. Every step runs in its own
+        transaction, DDL included, which sqlite3 would otherwise run outside of one. An interrupted migration is rolled
+        back to the end of the last finished step, and the rest of it runs again on the next open.
+        :param schema_version: the layout version the database is in now
+        :return: None
+        """
+        logger.info(f"Migrating database from schema version {schema_version} to {UMBRELLA_DB_SCHEMA_VERSION}...")
         self.db_connection.commit()
 
-    def __db_get_current_snapshot_id(self) -> int:
+        if schema_version < 2:
+            # rebuild objects_sha1 as a WITHOUT ROWID table
+            self.db_cursor.execute(r"""BEGIN;""")
+            # without objects_sha1, an older umbrella was interrupted after dropping it, and the copy is complete
+            if self.__db_table_exists("objects_sha1"):
+                # the scratch table may be left over from an older umbrella that was interrupted before that
+                self.db_cursor.execute(r"""DROP TABLE IF EXISTS "objects_sha1_migration";""")
+                self.db_cursor.execute(r"""CREATE TABLE "objects_sha1_migration" (
+                        "sha1"	BLOB,
+                        "type"  TEXT,
+                        "size"  INTEGER,
+                        "first_appearance_in_snapshots"	INTEGER,
+                        PRIMARY KEY("sha1")
+                ) WITHOUT ROWID;""")
+                self.db_cursor.execute(r"""
+                    INSERT INTO "objects_sha1_migration" ("sha1", "type", "size", "first_appearance_in_snapshots")
+                    SELECT "sha1", "type", "size", "first_appearance_in_snapshots" FROM "objects_sha1";
+                """)
+                self.db_cursor.execute(r"""DROP TABLE "objects_sha1";""")
+            self.db_cursor.execute(r"""ALTER TABLE "objects_sha1_migration" RENAME TO "objects_sha1";""")
+            self.__db_set_config("schema_version", 2)
+            self.db_connection.commit()
+
+        self.db_cursor.execute(r"""BEGIN;""")
+        self.db_cursor.execute(r"""PRAGMA table_info("objects_sha1");""")
+        if "object_id" not in [row[1] for row in self.db_cursor.fetchall()]:
+            self.db_cursor.execute(r"""ALTER TABLE "objects_sha1" ADD COLUMN "object_id" INTEGER;""")
+        self.db_cursor.execute(r"""SELECT 1 FROM "objects_sha1" WHERE "object_id" IS NULL LIMIT 1;""")
+        if self.db_cursor.fetchone() is not None:
+            # number the objects in the order they arrived; this comes before the version 3 step below, which creates
+            # the tables and indexes of the current layout, including the one on object_id. A column left unnumbered
+            # by an interrupted migration of an older umbrella is numbered here, too; no bitmap refers to it yet.
+            self.db_cursor.execute(r"""DROP INDEX IF EXISTS "objects_sha1_object_id";""")
+            self.db_cursor.execute(r"""CREATE TEMP TABLE "object_numbering" (
+                    "sha1"	BLOB,
+                    "object_id"	INTEGER,
+                    PRIMARY KEY("sha1")
+            ) WITHOUT ROWID;""")
+            self.db_cursor.execute(r"""
+                INSERT INTO "object_numbering" ("sha1", "object_id")
+                SELECT "sha1", ROW_NUMBER() OVER (ORDER BY "first_appearance_in_snapshots", "sha1") FROM "objects_sha1";
+            """)
+            self.db_cursor.execute(r"""
+                UPDATE "objects_sha1" SET "object_id" = (
+                    SELECT "object_id" FROM "object_numbering" WHERE "object_numbering"."sha1" = "objects_sha1"."sha1"
+                );
+            """)
+            self.db_cursor.execute(r"""DROP TABLE "object_numbering";""")
+            self.db_cursor.execute(r"""
+                CREATE UNIQUE INDEX IF NOT EXISTS "objects_sha1_object_id" ON "objects_sha1" ("object_id");
+            """)
+        self.db_connection.commit()
+
+        if schema_version < 3:
+            # fold the per-snapshot ref tables into refs_history, and deduplicate the saved configs
+            self.db_cursor.execute(r"""BEGIN;""")
+            self.__db_create_tables()
+            self.db_cursor.execute(r"""
+                SELECT "name" FROM sqlite_master WHERE type='table' AND name LIKE 'refs\_snapshot\_%' ESCAPE '\';
+            """)
+            ref_tables = sorted(
+                (int(name[len("refs_snapshot_"):]), name) for name, in self.db_cursor.fetchall()
+                if name[len("refs_snapshot_"):].isdigit()
+            )
+            for snapshot_id, ref_table_name in ref_tables:
+                self.db_cursor.execute(fr"""
+                    SELECT "path", "commit" FROM "{ref_table_name}";
+                """)
+                self.__db_save_refs(snapshot_id, dict(self.db_cursor.fetchall()))
+                self.db_cursor.execute(fr"""DROP TABLE "{ref_table_name}";""")
+            logger.info(f"{len(ref_tables)} reference snapshots migrated.")
+
+            if self.__db_table_exists("configs"):
+                self.db_cursor.execute(r"""
+                    SELECT "snapshot_id", "content" FROM "configs";
+                """)
+                for snapshot_id, content in self.db_cursor.fetchall():
+                    self.__db_save_config(snapshot_id, content)
+                self.db_cursor.execute(r"""DROP TABLE "configs";""")
+
+            self.__db_set_config("schema_version", 3)
+            self.db_connection.commit()
+
+    def __db_get_last_snapshot_id(self) -> int:
         """
-        Get the current snapshot id (self increment) after inserting a new snapshot entry.
+        Get the current snapshot id (self increment) after inserting a new snapshot entry. The snapshot may not be
+        complete yet.
         :return: an integer id
         """
         self.db_cursor.execute(r"""
@@ -114,6 +404,161 @@ class GitMirroredRepo:
         except TypeError:
             return 0
 
+    def __db_get_current_snapshot_id(self) -> int:
+        """
+        Get the id of the latest complete snapshot. A snapshot is only complete once all its objects are recorded;
+        one that died halfway is taken again by the next snapshot().
+        :return: an integer id
+        """
+        return int(self.__db_get_config("last_complete_snapshot", self.__db_get_last_snapshot_id()))
+
+    def __check_snapshot_id(self, snapshot_id: int) -> None:
+        """
+        Make sure a snapshot id given by the user refers to a complete snapshot.
+        :param snapshot_id: the snapshot id; 0 stands for the empty state before the first snapshot
+        :return: None
+        """
+        current_snapshot_id = self.__db_get_current_snapshot_id()
+        if not 0 <= snapshot_id <= current_snapshot_id:
+            raise ValueError(f"Snapshot {snapshot_id} does not exist, the latest one is {current_snapshot_id}")
+
+    def __db_discard_snapshot_refs(self, snapshot_id: int) -> None:
+        """
+        Undo the references recorded for the latest snapshot. Does not commit.
+        :param snapshot_id: the snapshot id, must be the latest one
+        :return: None
+        """
+        self.db_cursor.execute(r"""
+            DELETE FROM "refs_history" WHERE "valid_from" = ?;
+        """, (snapshot_id,))
+        self.db_cursor.execute(r"""
+            UPDATE "refs_history" SET "valid_until" = NULL WHERE "valid_until" = ?;
+        """, (snapshot_id,))
+
+    def __db_get_snapshot_refs(self, snapshot_id: int) -> typing.Dict[str, str]:
+        """
+        Read the references as they were in a snapshot.
+        :param snapshot_id: the snapshot id
+        :return: a dict of ref path => commit sha1 (hex string); empty if the snapshot does not exist
+        """
+        self.db_cursor.execute(r"""
+            SELECT "path", "commit" FROM "refs_history"
+            WHERE "valid_from" <= ? AND ("valid_until" IS NULL OR "valid_until" > ?);
+        """, (snapshot_id, snapshot_id))
+        return dict(self.db_cursor.fetchall())
+
+    def __db_save_refs(self, snapshot_id: int, refs: typing.Dict[str, str]) -> int:
+        """
+        Record the references of a new snapshot. Only the refs that changed since the last snapshot are written.
+        Does not commit.
+        :param snapshot_id: the snapshot id, must be newer than any snapshot saved before
+        :param refs: a dict of ref path => commit sha1 (hex string)
+        :return: number of changed (including created and deleted) refs
+        """
+        self.db_cursor.execute(r"""
+            SELECT "path", "commit" FROM "refs_history" WHERE "valid_until" IS NULL;
+        """)
+        current: typing.Dict[str, str] = dict(self.db_cursor.fetchall())
+
+        ended = [(snapshot_id, path) for path, commit in current.items() if refs.get(path) != commit]
+        started = [(path, commit, snapshot_id) for path, commit in refs.items() if current.get(path) != commit]
+        self.db_cursor.executemany(r"""
+            UPDATE "refs_history" SET "valid_until" = ? WHERE "path" = ? AND "valid_until" IS NULL;
+        """, ended)
+        self.db_cursor.executemany(r"""
+            INSERT INTO "refs_history" ("path", "commit", "valid_from", "valid_until") VALUES (?, ?, ?, NULL);
+        """, started)
+        return len(set(path for _, path in ended) | set(path for path, _, _ in started))
+
+    def __db_save_config(self, snapshot_id: int, content: typing.AnyStr) -> None:
+        """
+        Record the Git config file of a snapshot. Identical contents are only stored once. Does not commit.
+        :param snapshot_id: the snapshot id
+        :param content: the config file content
+        :return: None
+        """
+        config_sha1 = hashlib.sha1(content.encode("utf-8") if isinstance(content, str) else content).hexdigest()
+        self.db_cursor.execute(r"""
+            INSERT OR IGNORE INTO "config_contents" ("sha1", "content") VALUES (?, ?);
+        """, (config_sha1, content))
+        self.db_cursor.execute(r"""
+            INSERT OR REPLACE INTO "snapshot_configs" ("snapshot_id", "config_sha1") VALUES (?, ?);
+        """, (snapshot_id, config_sha1))
+
+    def estimate_poll_interval(
+            self,
+            min_interval: float,
+            max_interval: float,
+            history: int = 10,
+    ) -> float:
+        """
+        Guess how long to wait before looking at the upstream again, from how often its references changed before.
+        Busy repos get short intervals; repos that changed rarely, or not for a long time, get long ones.
+        :param min_interval: shortest interval in seconds
+        :param max_interval: longest interval in seconds
+        :param history: number of recent changes to consider
+        :return: seconds
+        """
+        # snapshots are only taken when the refs changed (or the fetch was forced), so look at the refs themselves
+        self.db_cursor.execute(r"""
+            SELECT "timestamp" FROM "snapshots" WHERE "id" IN (
+                SELECT "valid_from" FROM "refs_history"
+                UNION
+                SELECT "valid_until" FROM "refs_history" WHERE "valid_until" IS NOT NULL
+            ) ORDER BY "id" DESC LIMIT ?;
+        """, (history,))
+        timestamps = [row[0] for row in self.db_cursor.fetchall()]
+        if len(timestamps) == 0:
+            return min_interval
+
+        since_last_change = max(get_timestamp() - timestamps[0], 0)
+        if len(timestamps) > 1:
+            average_gap = (timestamps[0] - timestamps[-1]) / (len(timestamps) - 1)
+        else:
+            average_gap = since_last_change
+        # poll about twice per expected change; a repo that has gone quiet is slowed down as time goes by
+        interval = max(average_gap, since_last_change) / 2
+        return min(max(interval, min_interval), max_interval)
+
+    def diff_snapshots(
+            self,
+            old_snapshot_id: int,
+            new_snapshot_id: typing.Union[int, None] = None,
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Compare the references of two snapshots. Only the refs touched between the two snapshots are read.
+        :param old_snapshot_id: the snapshot to compare from
+        :param new_snapshot_id: the snapshot to compare to; defaults to the latest one
+        :return: {"added": {path: commit}, "changed": {path: (old commit, new commit)}, "deleted": {path: commit}}
+        """
+        if new_snapshot_id is None:
+            new_snapshot_id = self.__db_get_current_snapshot_id()
+        self.__check_snapshot_id(old_snapshot_id)
+        self.__check_snapshot_id(new_snapshot_id)
+        low, high = sorted((old_snapshot_id, new_snapshot_id))
+
+        self.db_cursor.execute(r"""
+            SELECT "path", "commit", "valid_from", "valid_until" FROM "refs_history"
+            WHERE "path" IN (
+                SELECT "path" FROM "refs_history" WHERE "valid_from" > :low AND "valid_from" <= :high
+                UNION
+                SELECT "path" FROM "refs_history" WHERE "valid_until" > :low AND "valid_until" <= :high
+            ) AND "valid_from" <= :high AND ("valid_until" IS NULL OR "valid_until" > :low);
+        """, {"low": low, "high": high})
+
+        old_refs: typing.Dict[str, str] = dict()
+        new_refs: typing.Dict[str, str] = dict()
+        for path, commit, valid_from, valid_until in self.db_cursor.fetchall():
+            for snapshot_id, state in ((old_snapshot_id, old_refs), (new_snapshot_id, new_refs)):
+                if valid_from <= snapshot_id and (valid_until is None or valid_until > snapshot_id):
+                    state[path] = commit
+
+        return {
+            "added": {p: c for p, c in new_refs.items() if p not in old_refs},
+            "changed": {p: (c, new_refs[p]) for p, c in old_refs.items() if p in new_refs and new_refs[p] != c},
+            "deleted": {p: c for p, c in old_refs.items() if p not in new_refs},
+        }
+
     def __init_dir(self) -> None:
         """
         Set up directory structure.
@@ -134,10 +579,10 @@ class GitMirroredRepo:
                 assert self.upstream_url == self.repo.remote("origin").url
         else:
             logger.debug(f"Initializing Git repo at {self.git_directory}...")
-            # if a previous attempt failed, we have to remove the dead
-            if os.path.exists(self.git_directory):
+            if os.path.exists(self.git_directory) and not self.__reusable_git_directory():
+                # a previous attempt failed before the repo was even set up, we have to remove the dead
                 shutil.rmtree(self.git_directory)
-            # init repo
+            # init repo; on an existing repo this is harmless, and the objects fetched so far are kept
             self.repo = git.Repo.init(self.git_directory, bare=True)
 
             # not using repo.config_writer
@@ -146,7 +591,8 @@ class GitMirroredRepo:
 
             # add a remote
             # http://git.661346.n2.nabble.com/PATCH-1-2-clone-Add-an-option-to-set-up-a-mirror-td664305.html
-            self.repo.create_remote("origin", self.upstream_url, mirror="fetch")
+            if "origin" not in [r.name for r in self.repo.remotes]:
+                self.repo.create_remote("origin", self.upstream_url, mirror="fetch")
             # no auto CRLF conversion
             # https://stackoverflow.com/questions/21822650/disable-git-eol-conversions
             self.repo.git.config('core.autocrlf', 'false')
@@ -172,6 +618,57 @@ class GitMirroredRepo:
 
         assert self.repo.bare
 
+    def __reusable_git_directory(self) -> bool:
+        """
+        Check whether a git directory left behind by an interrupted initialization can be continued.
+        :return: True if it is a bare repo with no remote, or with the right origin
+        """
+        try:
+            repo = git.Repo(self.git_directory)
+            try:
+                if not repo.bare:
+                    return False
+                remotes = {r.name: r for r in repo.remotes}
+                return "origin" not in remotes or remotes["origin"].url == self.upstream_url
+            finally:
+                repo.close()
+        except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, git.exc.GitCommandError):
+            return False
+
+    def __fetch_seed(self) -> None:
+        """
+        Take the objects from a git bundle or a local clone, so only the delta has to come from upstream. The refs
+        go to a temporary namespace, where the following fetch from upstream uses them for negotiation.
+        :return: None
+        """
+        logger.info(f"Seeding {self.storage_directory} from {self.seed}...")
+        try:
+            self.repo.git.fetch(self.seed, "+refs/*:refs/umbrella-seed/*", "--no-tags")
+        except git.exc.GitCommandError:
+            # the seed only saves bandwidth; everything can still come from upstream
+            logger.exception(f"Seeding from {self.seed} failed, fetching everything from upstream")
+
+    def __drop_seed_refs(self) -> None:
+        seed_refs = [str(r.path) for r in self.repo.references if str(r.path).startswith("refs/umbrella-seed/")]
+        for ref in seed_refs:
+            self.repo.git.update_ref("-d", ref)
+
+    def __initial_fetch(self) -> None:
+        """
+        Fetch the upstream refs in batches. Every finished batch stays, so an interrupted first fetch of a huge repo
+        continues with the refs still missing next time instead of starting over.
+        :return: None
+        """
+        upstream_refs = self.__get_upstream_refs()
+        local_refs = self.__get_local_refs()
+        missing = sorted(path for path, commit in upstream_refs.items() if local_refs.get(path) != commit)
+        if len(missing) < len(upstream_refs):
+            logger.info(f"Resuming the initial fetch, {len(missing)}/{len(upstream_refs)} refs to go")
+        for i in range(0, len(missing), self.initial_fetch_refs_per_batch):
+            batch = missing[i:i + self.initial_fetch_refs_per_batch]
+            logger.debug(f"Initial fetch: refs {i + 1}-{i + len(batch)} of {len(missing)}...")
+            self.repo.git.fetch("origin", *[f"+{path}:{path}" for path in batch], "--no-tags", env=self.git_environment)
+
     def __unpack_git_objects(self) -> None:
         """
         Unpack all git packs into objects
@@ -200,6 +697,111 @@ class GitMirroredRepo:
 
         shutil.rmtree(self.temp_directory, ignore_errors=True)
 
+    def __keep_git_packs(self) -> None:
+        """
+        Mark every new pack with a .keep file, so that no git command (gc, repack) ever touches it.
+        :return: None
+        """
+        write_keep_files(os.path.join(self.git_directory, "objects"), PACK_KEEP_MARKER)
+
+    def __list_fetched_packs(self) -> typing.List[str]:
+        """
+        Find the packs that are not archive packs.
+        :return: full paths of their `*.idx` files
+        """
+        ret = []
+        for idx_file in list_pack_indexes(os.path.join(self.git_directory, "objects")):
+            keep_file = os.path.splitext(idx_file)[0] + ".keep"
+            if os.path.exists(keep_file):
+                with open(keep_file, "r") as f:
+                    if f.read() == ARCHIVE_PACK_KEEP_MARKER:
+                        continue
+            ret.append(idx_file)
+        return ret
+
+    def archive_git_objects(self, force: bool = False) -> bool:
+        """
+        Roll the fetched packs and the loose objects up into one archive pack. Nothing is pruned: every object of the
+        old packs is checked to be in the new pack before an old pack is deleted, and `git prune-packed` only removes
+        loose objects that are in a pack.
+        :param force: roll up even if the thresholds are not reached
+        :return: whether an archive pack was written
+        """
+        objects_directory = os.path.join(self.git_directory, "objects")
+        fetched_packs = self.__list_fetched_packs()
+        loose_count = sum(1 for _ in iter_loose_object_sha1s(objects_directory))
+        if loose_count == 0 and len(fetched_packs) == 0:
+            return False
+        if not force and len(fetched_packs) < self.archive_pack_threshold \
+                and loose_count < self.archive_loose_object_threshold:
+            return False
+        logger.debug(f"Archiving {len(fetched_packs)} packs and {loose_count} loose objects...")
+
+        # the object list can be huge, so it goes through a file rather than memory
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
+        os.makedirs(self.temp_directory, exist_ok=True)
+        object_list_file = os.path.join(self.temp_directory, "objects.txt")
+        with open(object_list_file, "w") as f:
+            for idx_file in fetched_packs:
+                with PackIndex(idx_file) as idx:
+                    for sha1 in idx:
+                        f.write(sha1.hex() + "\n")
+            for sha1 in iter_loose_object_sha1s(objects_directory):
+                f.write(sha1.hex() + "\n")
+
+        # https://git-scm.com/docs/git-pack-objects
+        # git runs inside the git directory, so the pack path must not be relative to ours
+        pack_directory = os.path.abspath(os.path.join(objects_directory, "pack"))
+        try:
+            with open(object_list_file, "rb") as f:
+                pack_name = self.repo.git.pack_objects("-q", os.path.join(pack_directory, "pack"), istream=f)
+        except git.exc.GitCommandError:
+            for temp_file in glob.glob(os.path.join(pack_directory, "tmp_*")):
+                os.remove(temp_file)
+            shutil.rmtree(self.temp_directory, ignore_errors=True)
+            raise
+        archive_idx_file = os.path.join(pack_directory, f"pack-{pack_name.strip()}.idx")
+        with open(os.path.splitext(archive_idx_file)[0] + ".keep", "w") as f:
+            f.write(ARCHIVE_PACK_KEEP_MARKER)
+
+        with PackIndex(archive_idx_file) as archive:
+            for idx_file in fetched_packs:
+                if os.path.abspath(idx_file) == archive_idx_file:
+                    continue
+                with PackIndex(idx_file) as idx:
+                    missing = sum(1 for sha1 in idx if sha1 not in archive)
+                if missing > 0:
+                    logger.error(f"{missing} objects of {idx_file} are not in the archive pack, keeping it")
+                    continue
+                base = os.path.splitext(idx_file)[0]
+                for ext in (".pack", ".idx", ".rev", ".keep"):
+                    if os.path.exists(base + ext):
+                        os.chmod(base + ext, stat.S_IREAD | stat.S_IWRITE)
+                        os.remove(base + ext)
+        self.repo.git.prune_packed()
+
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
+        return True
+
+    def migrate_storage_layout(self, storage_layout: str) -> None:
+        """
+        Convert the objects to another storage layout. Objects are never lost on the way.
+        :param storage_layout: one of STORAGE_LAYOUTS
+        :return: None
+        """
+        if storage_layout not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout {storage_layout}")
+        if storage_layout == self.storage_layout:
+            return
+        logger.info(f"Migrating {self.storage_directory} from {self.storage_layout} to {storage_layout} layout...")
+        if storage_layout == "loose":
+            self.__unpack_git_objects()
+        else:
+            self.archive_git_objects(force=True)
+        self.storage_layout = storage_layout
+        self.__db_set_config("storage_layout", storage_layout)
+        self.db_connection.commit()
+
     def update(self) -> None:
         """
         Pull everything from the remote once. May throw git.exc.GitCommandError if failed.
@@ -218,132 +820,795 @@ class GitMirroredRepo:
                 # might fail if the config does not exist in the first place
                 pass
 
+        self.up_to_date = False
+        if self.skip_unchanged:
+            with self.metrics.phase("preflight"):
+                unchanged = self.__upstream_unchanged()
+            if unchanged:
+                logger.info(f"{url_hide_sensitive(self.upstream_url)} is unchanged since the last snapshot")
+                self.up_to_date = True
+                self.__db_set_config("last_up_to_date_check", get_timestamp())
+                self.db_connection.commit()
+                return
+
         # Update the mirror
         # https://stackoverflow.com/a/6151419/2646069
         logger.debug(f"Fetching changes from {url_hide_sensitive(self.upstream_url)}...")
-        self.repo.remote("origin").update(env=self.git_environment)
+        pool = None
+        object_stores = [self.repo]
+        if self.object_pool_directory is not None:
+            pool = ObjectPool(self.object_pool_directory)
+            pool.link(os.path.join(self.git_directory, "objects"))
+            object_stores.append(pool.repo)
+        # small fetches are unpacked into loose objects, so count both
+        size_before = sum(get_object_store_bytes(r) for r in object_stores)
+        with self.metrics.phase("fetch"):
+            if pool is not None:
+                # the pool negotiates with the objects of all the related repos, so only new objects come over the
+                # wire; the fetch into the mirror itself then finds everything locally
+                member_key = hashlib.sha1(self.upstream_url.encode("utf-8")).hexdigest()
+                pool.fetch(self.upstream_url, member_key, self.git_environment)
+            if self.__db_get_config("initial_fetch_complete") is None:
+                if self.seed is not None:
+                    self.__fetch_seed()
+                self.__initial_fetch()
+            self.repo.remote("origin").update(env=self.git_environment)
+            if self.__db_get_config("initial_fetch_complete") is None:
+                self.__drop_seed_refs()
+                self.__db_set_config("initial_fetch_complete", 1)
+                self.db_connection.commit()
+        self.metrics.count("bytes_fetched", max(0, sum(get_object_store_bytes(r) for r in object_stores) - size_before))
+
+        if self.git_lfs_enabled:
+            with self.metrics.phase("lfs"):
+                self.__fetch_lfs_objects()
+
+    def __iter_reachable_sha1s(
+            self,
+            known_tips: typing.Iterable[str],
+            *options: str,
+            tips: typing.Union[typing.Iterable[str], None] = None,
+    ) -> typing.Iterator[bytes]:
+        """
+        Stream `git rev-list --all`, except what is already reachable from known_tips.
+        :param known_tips: object names whose history is already accounted for, e.g. the refs of the last snapshot
+        :param options: extra options for git rev-list, e.g. "--objects"
+        :param tips: walk from these object names instead of all the refs
+        :return: the bytes objects of the sha1s
+        """
+        os.makedirs(self.temp_directory, exist_ok=True)
+        # a file of its own for every walk, several may be in progress at once
+        fd, exclude_file = tempfile.mkstemp(prefix="rev-list-exclude-", suffix=".txt", dir=self.temp_directory)
+        process = None
+        try:
+            with os.fdopen(fd, "w") as f:
+                for tip in known_tips:
+                    f.write(f"^{tip}\n")
+                for tip in tips or []:
+                    f.write(f"{tip}\n")
+
+            with open(exclude_file, "rb") as f:
+                process = self.repo.git.rev_list(
+                    *options, *(["--all"] if tips is None else []), "--stdin", as_process=True, istream=f
+                )
+                for line in process.proc.stdout:
+                    yield bytes.fromhex(line[0:40].decode("ascii"))
+                # raises GitCommandError on failure
+                process.wait()
+        finally:
+            # the caller may stop early, or fail halfway
+            if process is not None and process.proc.poll() is None:
+                process.proc.kill()
+                process.proc.wait()
+            os.remove(exclude_file)
+
+    def __iter_reachable_object_sha1s(self, known_tips: typing.Iterable[str]) -> typing.Iterator[bytes]:
+        """
+        Enumerate the objects reachable from the refs, except the ones already reachable from known_tips. Needed when
+        the objects are borrowed through alternates, as they are not in the repo's own object directory.
+        :param known_tips: object names whose history is already accounted for, e.g. the refs of the last snapshot
+        :return: the bytes objects of the sha1s
+        """
+        return self.__iter_reachable_sha1s(known_tips, "--objects")
+
+    def iter_new_commits(self, known_tips: typing.Iterable[str]) -> typing.Iterator[bytes]:
+        """
+        Enumerate the commits reachable from the refs, except the ones already reachable from known_tips.
+        :param known_tips: commits whose history is already accounted for; empty to list every commit
+        :return: the bytes objects of the sha1s
+        """
+        return self.__iter_reachable_sha1s(known_tips)
+
+    def __db_get_object_ids(self, sha1s: typing.Iterable[bytes]) -> typing.Iterator[int]:
+        """
+        Look up the object ids of objects. Objects not in the database are skipped.
+        :param sha1s: the bytes objects of the sha1s
+        :return: the object ids, in no particular order
+        """
+        it = iter(sha1s)
+        while True:
+            # stay below SQLITE_MAX_VARIABLE_NUMBER of old SQLite versions (999)
+            chunk = list(itertools.islice(it, 500))
+            if len(chunk) == 0:
+                break
+            self.db_cursor.execute(fr"""
+                SELECT "object_id" FROM "objects_sha1" WHERE "sha1" IN ({", ".join("?" * len(chunk))});
+            """, chunk)
+            yield from (object_id for object_id, in self.db_cursor.fetchall())
+
+    def __db_get_reachability_bitmap(self, snapshot_id: int) -> typing.Union[ObjectBitmap, None]:
+        self.db_cursor.execute(r"""
+            SELECT "bitmap" FROM "reachability_bitmaps" WHERE "snapshot_id" = ?;
+        """, (snapshot_id,))
+        row = self.db_cursor.fetchone()
+        return None if row is None else ObjectBitmap.decompress(row[0])
+
+    def __build_reachability_bitmap(self, snapshot_id: int) -> ObjectBitmap:
+        """
+        Find and save the objects reachable from the refs of a snapshot. If the bitmap of the previous snapshot is
+        known, only the history that changed since then is walked: the objects only the lost tips reached (e.g.
+        rewritten `refs/pull/*/merge`) are dropped from it, and the objects new since the surviving tips are added;
+        otherwise the whole history is walked. Tag objects are not included, as the snapshots only record the commits
+        the refs point to.
+        Does not commit.
+        :param snapshot_id: the snapshot id
+        :return: the bitmap
+        """
+        tips = set(self.__db_get_snapshot_refs(snapshot_id).values())
+        known_tips = set(self.__db_get_snapshot_refs(snapshot_id - 1).values()) if snapshot_id > 1 else set()
+        bitmap = ObjectBitmap()
+        if len(known_tips) > 0:
+            previous_bitmap = self.__db_get_reachability_bitmap(snapshot_id - 1)
+            if previous_bitmap is not None:
+                # everything reachable before but not any more, including the lost tips themselves
+                lost_sha1s = list(self.__iter_reachable_sha1s(tips, "--objects", tips=known_tips))
+                lost = ObjectBitmap()
+                lost.add(self.__db_get_object_ids(lost_sha1s))
+                bitmap = previous_bitmap - lost
+                known_tips -= set(sha1.hex() for sha1 in lost_sha1s)
+            else:
+                known_tips = set()
+        if len(tips) > 0:
+            bitmap.add(self.__db_get_object_ids(self.__iter_reachable_sha1s(known_tips, "--objects", tips=tips)))
+
+        self.db_cursor.execute(r"""
+            INSERT OR REPLACE INTO "reachability_bitmaps" ("snapshot_id", "object_count", "bitmap") VALUES (?, ?, ?);
+        """, (snapshot_id, len(bitmap), bitmap.compress()))
+        return bitmap
+
+    def get_reachability_bitmap(self, snapshot_id: typing.Union[int, None] = None) -> ObjectBitmap:
+        """
+        Get the objects reachable from the refs of a snapshot. Snapshots taken before the bitmaps existed get their
+        bitmap computed now.
+        :param snapshot_id: the snapshot id; None for the latest
+        :return: the bitmap of object ids
+        """
+        if snapshot_id is None:
+            snapshot_id = self.__db_get_current_snapshot_id()
+        self.__check_snapshot_id(snapshot_id)
+        bitmap = self.__db_get_reachability_bitmap(snapshot_id)
+        if bitmap is None:
+            bitmap = self.__build_reachability_bitmap(snapshot_id)
+            self.db_connection.commit()
+        return bitmap
+
+    def lost_objects(
+            self,
+            old_snapshot_id: int,
+            new_snapshot_id: typing.Union[int, None] = None,
+    ) -> typing.List[typing.Tuple[str, typing.Union[str, None]]]:
+        """
+        List the objects reachable in one snapshot, but not in a later one, e.g. history that was force-pushed away
+        or deleted upstream. The objects themselves are still in the backup.
+        :param old_snapshot_id: the earlier snapshot
+        :param new_snapshot_id: the later snapshot; None for the latest
+        :return: (sha1 hex, type) of every lost object, in the order they arrived
+        """
+        lost = list(self.get_reachability_bitmap(old_snapshot_id) - self.get_reachability_bitmap(new_snapshot_id))
+        ret: typing.List[typing.Tuple[str, typing.Union[str, None]]] = []
+        for i in range(0, len(lost), 500):
+            chunk = lost[i:i + 500]
+            self.db_cursor.execute(fr"""
+                SELECT "sha1", "type" FROM "objects_sha1" WHERE "object_id" IN ({", ".join("?" * len(chunk))})
+                ORDER BY "object_id";
+            """, chunk)
+            ret.extend((sha1.hex(), object_type) for sha1, object_type in self.db_cursor.fetchall())
+
+        # the types are only known once fill_object_details() got to the objects
+        unknown = [sha1 for sha1, object_type in ret if object_type is None]
+        if len(unknown) > 0:
+            with GitObjectInfoReader(self.repo) as reader:
+                types = {name: object_type for name, object_type, _ in reader.query(unknown)}
+            ret = [(sha1, object_type or types.get(sha1)) for sha1, object_type in ret]
+        return ret
+
+    def get_storage_bytes(self) -> int:
+        """
+        Get the disk usage of the backup without walking every loose object: the git objects as counted by git, the
+        LFS objects and the database. Objects borrowed from an object pool are not included.
+        :return: bytes
+        """
+        return get_object_store_bytes(self.repo) \
+            + get_directory_size(os.path.join(self.git_directory, "lfs", "objects"), recursive=True) \
+            + get_directory_size(self.umbrella_directory)
+
+    def get_current_snapshot_id(self) -> int:
+        """
+        :return: id of the latest snapshot; 0 if there is none
+        """
+        return self.__db_get_current_snapshot_id()
+
+    def get_snapshot_refs(self, snapshot_id: typing.Union[int, None] = None) -> typing.Dict[str, str]:
+        """
+        Read the references as they were in a snapshot.
+        :param snapshot_id: the snapshot id; None for the latest
+        :return: a dict of ref path => commit sha1 (hex string)
+        """
+        if snapshot_id is None:
+            snapshot_id = self.__db_get_current_snapshot_id()
+        return self.__db_get_snapshot_refs(snapshot_id)
+
+    def get_snapshot_timestamp(self, snapshot_id: int) -> typing.Union[float, None]:
+        """
+        :param snapshot_id: the snapshot id
+        :return: UNIX timestamp (UTC) of the snapshot, or None if it does not exist
+        """
+        self.db_cursor.execute(r"""SELECT "timestamp" FROM "snapshots" WHERE "id" = ?;""", (snapshot_id,))
+        row = self.db_cursor.fetchone()
+        return None if row is None else row[0]
+
+    def export_bundle(
+            self,
+            bundle_file: typing.AnyStr,
+            since_snapshot_id: typing.Union[int, None] = None,
+    ) -> typing.Union[typing.Dict[str, typing.Any], None]:
+        """
+        Write what arrived since a snapshot as an incremental git bundle, e.g. to ship it to another copy of the
+        backup. The bundle holds the current references, plus the commits that were only referenced by the snapshots
+        in between, minus everything reachable from the references of since_snapshot_id. What a bundle can not hold
+        (the snapshots and their references) goes into the returned manifest, which import_bundle() needs too.
+        Nothing is recorded about the export until commit_export() is called.
+        :param bundle_file: where to write the bundle
+        :param since_snapshot_id: the snapshot the other copy already has; None to continue after the last committed
+                                  export
+        :return: the manifest; None if there are no snapshots after since_snapshot_id
+        """
+        if since_snapshot_id is None:
+            since_snapshot_id = int(self.__db_get_config("last_exported_snapshot", 0))
+        until_snapshot_id = self.__db_get_current_snapshot_id()
+        if until_snapshot_id <= since_snapshot_id:
+            return None
+
+        snapshots = [
+            {"id": i, "timestamp": self.get_snapshot_timestamp(i), "refs": self.__db_get_snapshot_refs(i)}
+            for i in range(since_snapshot_id + 1, until_snapshot_id + 1)
+        ]
+        refs: typing.Dict[str, str] = dict()
+        annotated_tags: typing.Dict[str, typing.Dict[str, str]] = dict()
+        for ref in self.repo.references:
+            path = str(ref.path)
+            if path.startswith("refs/umbrella-"):
+                continue
+            refs[path] = ref.object.hexsha
+            if ref.object.type == "tag":
+                annotated_tags[path] = {"object": ref.object.hexsha, "commit": str(ref.commit)}
+        basis = set(self.__db_get_snapshot_refs(since_snapshot_id).values())
+        # e.g. force-pushed away in the meantime; reachable from no current ref, but still part of the backup
+        tips = sorted(set(commit for s in snapshots for commit in s["refs"].values()) - basis)
+
+        bundle_written = True
+        # the bundle is cut from a scratch repo that borrows our objects, so the backup itself never gets extra refs
+        with tempfile.TemporaryDirectory(prefix="umbrella-export-") as scratch_directory:
+            scratch = git.Repo.init(os.path.join(scratch_directory, "repo.git"), bare=True)
+            try:
+                with open(os.path.join(scratch.git_dir, "objects", "info", "alternates"), "w") as f:
+                    f.write(os.path.abspath(os.path.join(self.git_directory, "objects")) + "\n")
+                commands_file = os.path.join(scratch_directory, "update-ref")
+                with open(commands_file, "w") as f:
+                    f.writelines(f"update {path} {sha1}\n" for path, sha1 in refs.items())
+                    f.writelines(f"update refs/umbrella-export/{sha1} {sha1}\n" for sha1 in tips)
+                with open(commands_file, "rb") as f:
+                    scratch.git.update_ref("--stdin", istream=f)
+
+                revisions_file = os.path.join(scratch_directory, "revisions")
+                with open(revisions_file, "w") as f:
+                    f.writelines(f"^{sha1}\n" for sha1 in sorted(basis))
+                with open(revisions_file, "rb") as f:
+                    scratch.git.bundle("create", os.path.abspath(bundle_file), "--all", "--stdin", istream=f)
+            except git.exc.GitCommandError as ex:
+                if "empty bundle" not in str(ex.stderr):
+                    raise
+                # only references were deleted, or snapshots taken with nothing new
+                bundle_written = False
+            finally:
+                scratch.close()
+
+        logger.debug(f"Snapshots {since_snapshot_id + 1}-{until_snapshot_id} exported to {bundle_file}")
+        return {
+            "umbrella_core_version": UMBRELLA_CORE_VERSION,
+            "upstream_url": self.upstream_url,
+            "since_snapshot": since_snapshot_id,
+            "until_snapshot": until_snapshot_id,
+            "bundle": os.path.basename(bundle_file) if bundle_written else None,
+            "annotated_tags": annotated_tags,
+            "snapshots": snapshots,
+        }
+
+    def commit_export(self, manifest: typing.Dict[str, typing.Any]) -> None:
+        """
+        Record an export as done, so the next export_bundle() continues after it. Call it only once the bundle and
+        the manifest are safely written; an export that is lost before is simply made again.
+        :param manifest: the manifest returned by export_bundle()
+        :return: None
+        """
+        self.__db_set_config("last_exported_snapshot", manifest["until_snapshot"])
+        self.db_connection.commit()
+
+    def import_bundle(self, manifest: typing.Dict[str, typing.Any], bundle_file: typing.Union[typing.AnyStr, None]) -> int:
+        """
+        Apply an export of another copy of this backup. Its snapshots are replayed one by one, so both copies end up
+        with the same snapshot ids and reference history. The objects of all the imported snapshots count as first
+        appearing in the first of them.
+        :param manifest: as returned by export_bundle()
+        :param bundle_file: the bundle; None if the manifest has none
+        :return: number of snapshots imported
+        """
+        current_snapshot_id = self.__db_get_current_snapshot_id()
+        if current_snapshot_id != manifest["since_snapshot"]:
+            raise ValueError(
+                f"the backup is at snapshot {current_snapshot_id}, but the export continues from snapshot "
+                f"{manifest['since_snapshot']}; exports have to be imported in order"
+            )
+
+        if bundle_file is not None:
+            # only stores the pack; checks that we have every prerequisite commit first
+            self.repo.git.bundle("unbundle", os.path.abspath(bundle_file))
+
+        annotated_tags: typing.Dict[str, typing.Dict[str, str]] = manifest.get("annotated_tags", dict())
+        for s in manifest["snapshots"]:
+            refs = {
+                path: annotated_tags[path]["object"]
+                if path in annotated_tags and annotated_tags[path]["commit"] == commit else commit
+                for path, commit in s["refs"].items()
+            }
+            self.__set_local_refs(refs)
+            self.up_to_date = False
+            self.snapshot(timestamp=s["timestamp"])
+            if self.__db_get_current_snapshot_id() != s["id"]:
+                logger.warning(f"Snapshot {s['id']} was imported as snapshot {self.__db_get_current_snapshot_id()}")
+        return len(manifest["snapshots"])
+
+    def __set_local_refs(self, refs: typing.Dict[str, str]) -> None:
+        """
+        Make the references of the mirror exactly the given ones, in one transaction.
+        :param refs: a dict of ref path => object sha1 (hex string)
+        :return: None
+        """
+        current = {str(ref.path) for ref in self.repo.references}
+        commands = [f"delete {path}\n" for path in sorted(current - set(refs))]
+        commands += [f"update {path} {sha1}\n" for path, sha1 in refs.items()]
+        process = self.repo.git.update_ref("--stdin", as_process=True, istream=subprocess.PIPE)
+        _, stderr = process.proc.communicate("".join(commands).encode("utf-8"))
+        if process.proc.returncode != 0:
+            raise git.exc.GitCommandError(["git", "update-ref", "--stdin"], process.proc.returncode, stderr)
+
+    def __get_local_refs(self) -> typing.Dict[str, str]:
+        """
+        List the references of the mirror.
+        :return: a dict of ref path => commit sha1 (hex string)
+        """
+        # all we need is head path and commit (although annotated tags looks different in packed refs)
+        # https://git-scm.com/book/en/v2/Git-Internals-Maintenance-and-Data-Recovery
+        return {str(head.path): str(head.commit) for head in self.repo.references}
+
+    def __git_rev_list(self, revisions: typing.List[str], *options: str) -> typing.List[str]:
+        """
+        Run `git rev-list`, passing the revisions through stdin so there is no limit on how many there are.
+        :param revisions: revisions, e.g. "<sha1>" or "^<sha1>"
+        :param options: extra options for git rev-list
+        :return: the object names printed
+        """
+        process = self.repo.git.rev_list(*options, "--stdin", as_process=True, istream=subprocess.PIPE)
+        stdout, stderr = process.proc.communicate("".join(f"{r}\n" for r in revisions).encode("utf-8"))
+        if process.proc.returncode != 0:
+            raise git.exc.GitCommandError(["git", "rev-list", *options, "--stdin"], process.proc.returncode, stderr)
+        return stdout.decode("utf-8").split()
+
+    def __uses_lfs(self, revisions: typing.List[str]) -> bool:
+        """
+        Check whether any .gitattributes file in the given revisions routes files through Git LFS.
+        :param revisions: commits to look at
+        :return: True if LFS is in use
+        """
+        for i in range(0, len(revisions), self.revisions_per_command):
+            try:
+                self.repo.git.grep(
+                    "-l", "-F", "-e", "filter=lfs",
+                    *revisions[i:i + self.revisions_per_command],
+                    "--", ".gitattributes", "*/.gitattributes",
+                )
+                return True
+            except git.exc.GitCommandError as ex:
+                # git grep exits with 1 when nothing matches
+                if ex.status != 1:
+                    raise
+        return False
+
+    def __fetch_lfs_objects(self) -> None:
+        """
+        Fetch the LFS objects referenced by the commits that arrived since the last snapshot.
+        Repos without any LFS attributes in the changed refs are skipped altogether.
+        :return: None
+        """
+        previous_refs = self.__db_get_snapshot_refs(self.__db_get_current_snapshot_id())
+        current_refs = self.__get_local_refs()
+        new_tips = sorted(set(c for path, c in current_refs.items() if previous_refs.get(path) != c))
+        if len(new_tips) == 0:
+            logger.debug("No new commits, skipping LFS")
+            return
+        if not self.__uses_lfs(new_tips):
+            logger.debug("No LFS attributes found, skipping LFS")
+            return
+
+        if self.git_lfs_concurrent_transfers:
+            self.repo.git.config('lfs.concurrenttransfers', str(self.git_lfs_concurrent_transfers))
 
         # GitPython have no direct support for Git LFS: https://github.com/gitpython-developers/GitPython/issues/739
         # https://help.github.com/en/github/creating-cloning-and-archiving-repositories/duplicating-a-repository
-        logger.debug(f"Fetching LFS objects from {url_hide_sensitive(self.upstream_url)}...")
-        self.repo.git.lfs('fetch', '--all')
+        new_commits = []
+        if len(previous_refs) > 0:
+            old_tips = sorted(set(previous_refs.values()))
+            new_commits = self.__git_rev_list(
+                new_tips + [f"^{c}" for c in old_tips],
+                f"--max-count={self.lfs_max_incremental_commits + 1}",
+            )
+        if len(previous_refs) == 0 or len(new_commits) > self.lfs_max_incremental_commits:
+            logger.debug(f"Fetching all LFS objects from {url_hide_sensitive(self.upstream_url)}...")
+            self.repo.git.lfs('fetch', '--all', 'origin', env=self.git_environment)
+            return
 
-    @staticmethod
-    def __sha1_string_from_bytes(sha1: bytes) -> str:
+        logger.debug(f"Fetching LFS objects of {len(new_commits)} new commits from {url_hide_sensitive(self.upstream_url)}...")
+        for i in range(0, len(new_commits), self.revisions_per_command):
+            self.repo.git.lfs(
+                'fetch', 'origin', *new_commits[i:i + self.revisions_per_command],
+                env=self.git_environment,
+            )
+
+    def __get_upstream_refs(self) -> typing.Dict[str, str]:
         """
-        Get the string hex form of the sha1 bytes object.
-        :param sha1: The bytes object
-        :return: the string form, e.g. "00e6ccf5da05d75c2c21068333ebfb920e4d6d3b"
+        List the references advertised by the upstream, without fetching anything.
+        Annotated tags are peeled, so the result is comparable with the refs saved by snapshot().
+        :return: a dict of ref path => commit sha1 (hex string)
         """
-        return sha1.hex().rjust(40, '0')
+        refs: typing.Dict[str, str] = dict()
+        peeled: typing.Dict[str, str] = dict()
+        output = self.repo.git.ls_remote("origin", env=self.git_environment)
+        for line in output.splitlines():
+            sha1, _, path = line.partition("\t")
+            if not path.startswith("refs/"):
+                # HEAD is not mirrored as a reference
+                continue
+            if path.endswith("^{}"):
+                peeled[path[:-3]] = sha1
+            else:
+                refs[path] = sha1
+        refs.update(peeled)
+        return refs
 
-    def __get_git_object_type(self, sha1: bytes) -> str:
+    def __upstream_unchanged(self) -> bool:
         """
-        Get the object type.
-        Note: git cat-file is very slow
-        :param sha1: the bytes object of the sha1
-        :return: "tree" || "blob" || "commit" || "tag"
+        Check whether every ref the upstream advertises is saved in the latest snapshot with the same value. Refs
+        deleted upstream are not compared, as the fetch keeps them anyway.
+        :return: True if fetching would not bring in anything new
         """
-        return str(self.repo.git.cat_file("-t", "--allow-unknown-type", self.__sha1_string_from_bytes(sha1)))
+        snapshot_id = self.__db_get_current_snapshot_id()
+        if snapshot_id == 0 or snapshot_id != self.__db_get_last_snapshot_id():
+            # nothing to compare with, or the last snapshot is incomplete and has to be taken again
+            return False
+        logger.debug(f"Listing references on {url_hide_sensitive(self.upstream_url)}...")
+        snapshot_refs = self.__db_get_snapshot_refs(snapshot_id)
+        return all(snapshot_refs.get(path) == commit for path, commit in self.__get_upstream_refs().items())
 
-    def __get_git_object_size(self, sha1: bytes) -> int:
+    @staticmethod
+    def __sha1_string_from_bytes(sha1: bytes) -> str:
         """
-        Get the object size in bytes.
-        Note: git cat-file is very slow
-        :param sha1: the bytes object of the sha1
-        :return: object size in bytes
+        Get the string hex form of the sha1 bytes object.
+        :param sha1: The bytes object
+        :return: the string form, e.g. "00e6ccf5da05d75c2c21068333ebfb920e4d6d3b"
         """
-        return int(self.repo.git.cat_file("-s", "--allow-unknown-type", self.__sha1_string_from_bytes(sha1)))
+        return sha1.hex().rjust(40, '0')
 
-    def __db_fill_object_details(self) -> None:
+    def fill_object_details(self, max_objects: typing.Union[int, None] = None) -> int:
         """
         Prefetch the object type and size into database. Note the object sha1 itself must be in the database first.
-        Caution: very slow
-        :return: None
+        All the lookups go through a single `git cat-file --batch-check` process.
+
+        Objects are walked in sha1 order, one chunk at a time; every chunk is committed together with the last sha1
+        done, so memory use is bounded and an interrupted run picks up where it stopped.
+        :param max_objects: stop after this many objects (the rest is done next time); None for no limit
+        :return: number of objects looked up
         """
-        self.db_cursor.execute(r"""
-            SELECT "sha1", "type", "size" FROM "objects_sha1" WHERE "type" IS NULL OR "size" IS NULL;
-        """)
+        cursor = self.__db_get_config("metadata_fill_cursor")
+        last_sha1 = bytes.fromhex(cursor) if cursor else b""
+        if cursor:
+            logger.debug(f"Resuming object metadata fill after {cursor}")
 
-        updated_rows = []
         object_count = 0
-        for row in self.db_cursor:
-            object_count += 1
-            if object_count % 100 == 0:
+        with GitObjectInfoReader(self.repo) as reader:
+            while max_objects is None or object_count < max_objects:
+                batch_size = self.object_details_batch_size
+                if max_objects is not None:
+                    batch_size = min(batch_size, max_objects - object_count)
+                self.db_cursor.execute(r"""
+                    SELECT "sha1", "type", "size" FROM "objects_sha1"
+                    WHERE "sha1" > ? AND ("type" IS NULL OR "size" IS NULL)
+                    ORDER BY "sha1" LIMIT ?;
+                """, (last_sha1, batch_size))
+                rows = self.db_cursor.fetchall()
+                if len(rows) == 0:
+                    # done; start from the beginning next time, new objects may sort before the cursor
+                    self.db_cursor.execute(r"""DELETE FROM "umbrella_config" WHERE "key" = 'metadata_fill_cursor';""")
+                    self.db_connection.commit()
+                    break
+
+                names = [self.__sha1_string_from_bytes(sha1) for sha1, _, _ in rows]
+                updated_rows = []
+                for (sha1, t, s), (_, object_type, object_size) in zip(rows, reader.query(names)):
+                    if t is None:
+                        t = object_type
+                    if s is None:
+                        s = object_size
+                    updated_rows.append((t, s, sha1))
+                self.db_cursor.executemany(r"""
+                    UPDATE "objects_sha1" SET "type" = ?, "size" = ? WHERE "sha1" = ?;
+                """, updated_rows)
+
+                last_sha1 = rows[-1][0]
+                self.__db_set_config("metadata_fill_cursor", last_sha1.hex())
+                self.db_connection.commit()
+                object_count += len(rows)
                 logger.debug(f"Calculating object: {object_count}")
-            sha1, t, s = row
-            if t is None:
-                t = self.__get_git_object_type(sha1)
-            if s is None:
-                s = self.__get_git_object_size(sha1)
-            updated_rows.append((t, s, sha1))
-
-        logger.debug("Writing object metadata...")
-        self.db_cursor.executemany("""UPDATE "objects_sha1" 
-            SET "type" = ?, "size" = ?
-            WHERE "sha1" = ?;
-        """, updated_rows)
-        self.db_connection.commit()
+
         logger.debug(f"{object_count} objects documented.")
+        return object_count
+
+    def __db_bulk_insert_objects(self, sha1s: typing.Iterable[bytes], snapshot_id: int) -> typing.Tuple[int, int]:
+        """
+        Record object sha1s in chunked transactions. Objects already in the database are left untouched.
+        :param sha1s: the bytes objects of the sha1s
+        :param snapshot_id: the snapshot the new objects first appear in
+        :return: (number of objects seen, number of new objects)
+        """
+        object_count = 0
+        new_object_count = 0
+        it = iter(sha1s)
+        while True:
+            chunk = [(sha1, snapshot_id) for sha1 in itertools.islice(it, self.db_bulk_chunk_size)]
+            if len(chunk) == 0:
+                break
+            changes_before = self.db_connection.total_changes
+            self.db_cursor.executemany(r"""
+                INSERT OR IGNORE INTO "objects_sha1" ("sha1", "first_appearance_in_snapshots", "object_id")
+                VALUES (?, ?, (SELECT COALESCE(MAX("object_id"), 0) + 1 FROM "objects_sha1"));
+            """, chunk)
+            self.db_connection.commit()
+            object_count += len(chunk)
+            new_object_count += self.db_connection.total_changes - changes_before
+            logger.debug(f"Scanning object: {object_count}")
+        return object_count, new_object_count
 
-    def snapshot(self) -> None:
+    def snapshot(self, timestamp: typing.Union[int, None] = None) -> None:
         """
-        Log the repo status into the database
+        Log the repo status into the database. Does nothing if update() found the upstream unchanged.
+        :param timestamp: when the snapshot was taken; None for now (set when replaying the snapshots of an import)
         :return: None
         """
-        self.__unpack_git_objects()
+        if self.up_to_date:
+            logger.debug("Nothing changed, skipping snapshot")
+            return
 
-        # create a new snapshot
-        self.db_cursor.execute(r"""
-                        INSERT INTO "snapshots" ("timestamp", "umbrella_core_version", "os") VALUES (?, ?, ?);
-                    """, (get_timestamp(), UMBRELLA_CORE_VERSION, get_os_string()))
-        snapshot_id: int = self.__db_get_current_snapshot_id()
-        ref_table_name: str = f"refs_snapshot_{snapshot_id}"
+        if self.storage_layout == "packed":
+            with self.metrics.phase("archive"):
+                self.__keep_git_packs()
+                self.archive_git_objects()
+        else:
+            with self.metrics.phase("unpack"):
+                self.__unpack_git_objects()
 
-        self.db_cursor.execute(fr"""CREATE TABLE IF NOT EXISTS "{ref_table_name}" (
-                "path"	TEXT,
-                "commit"	TEXT,
-                PRIMARY KEY("path")
-        );""")
+        # create a new snapshot
+        snapshot_values = (get_timestamp() if timestamp is None else timestamp, UMBRELLA_CORE_VERSION, get_os_string())
+        snapshot_id: int = self.__db_get_last_snapshot_id()
+        if snapshot_id != self.__db_get_current_snapshot_id():
+            # the last snapshot died before all its objects were recorded; take it again under the same id, the
+            # objects it got to stay recorded as first appearing in it
+            logger.info(f"Snapshot {snapshot_id} is incomplete, taking it again")
+            self.__db_discard_snapshot_refs(snapshot_id)
+            self.db_cursor.execute(r"""
+                UPDATE "snapshots" SET "timestamp" = ?, "umbrella_core_version" = ?, "os" = ? WHERE "id" = ?;
+            """, (*snapshot_values, snapshot_id))
+        else:
+            self.db_cursor.execute(r"""
+                            INSERT INTO "snapshots" ("timestamp", "umbrella_core_version", "os") VALUES (?, ?, ?);
+                        """, snapshot_values)
+            snapshot_id = self.__db_get_last_snapshot_id()
 
         # save heads
-        head: git.Reference
-        head_count = 0
-        for head in self.repo.references:
-            # all we need is head path and commit (although annotated tags looks different in packed refs)
-            # https://git-scm.com/book/en/v2/Git-Internals-Maintenance-and-Data-Recovery
-            # print(head.path, head.commit)
-            self.db_cursor.execute(fr"""
-                        INSERT INTO "{ref_table_name}" ("path", "commit") VALUES (?, ?);
-                    """, (str(head.path), str(head.commit)))
-            head_count += 1
-        logger.debug(f"{head_count} references saved.")
+        previous_refs = self.__db_get_snapshot_refs(snapshot_id - 1)
+        with self.metrics.phase("refs"):
+            refs = self.__get_local_refs()
+            changed_ref_count = self.__db_save_refs(snapshot_id, refs)
+        logger.debug(f"{changed_ref_count}/{len(refs)} references changed.")
+        self.metrics.count("refs", len(refs))
+        self.metrics.count("changed_refs", changed_ref_count)
 
         # save config
         with open(os.path.join(self.git_directory, "config"), "r") as f:
-            self.db_cursor.execute(r"""
-                INSERT INTO "configs" ("snapshot_id", "content") VALUES (?, ?);
-            """, (snapshot_id, f.read()))
+            self.__db_save_config(snapshot_id, f.read())
 
         # save objects
-        object_count = 0
-        new_object_count = 0
-        for sha1_hash in self.repo.odb.sha_iter():
-            object_count += 1
-            # if object_count % 100 == 0:
-            #     logger.debug(f"Scanning object: {object_count}")
-            try:
+        # read the pack indexes and loose object directories directly; much faster than repo.odb.sha_iter()
+        objects_directory = os.path.join(self.git_directory, "objects")
+        sha1s = iter_object_sha1s(objects_directory)
+        if len(list_alternates(objects_directory)) > 0:
+            # most objects are borrowed from a pool, which also holds objects of other repos; count the ones reachable
+            # from our own refs (the ones reachable from the last snapshot are already recorded)
+            sha1s = itertools.chain(sha1s, self.__iter_reachable_object_sha1s(previous_refs.values()))
+        with self.metrics.phase("scan_objects"):
+            object_count, new_object_count = self.__db_bulk_insert_objects(sha1s, snapshot_id)
+        logger.debug(f"{new_object_count}/{object_count} new objects saved.")
+        self.metrics.count("objects", object_count)
+        self.metrics.count("new_objects", new_object_count)
+
+        with self.metrics.phase("bitmap"):
+            self.__build_reachability_bitmap(snapshot_id)
+
+        # commit; the snapshot only counts from here on, the object scan above commits as it goes
+        self.__db_set_config("last_complete_snapshot", snapshot_id)
+        with self.metrics.phase("db_commit"):
+            self.db_connection.commit()
+
+    def verify(self, hash_sample_rate: float = 0.0, incremental: bool = True) -> typing.Dict[str, typing.Any]:
+        """
+        Check that every object recorded in the database is still in the repo. Presence is checked against the pack
+        indexes and loose object files; a sample of the objects is also read back and hashed again.
+        If nothing is wrong, the latest snapshot is remembered as verified.
+        :param hash_sample_rate: share of the objects to hash, from 0 (none) to 1 (all)
+        :param incremental: only check the objects that first appeared after the last verified snapshot
+        :return: {"since_snapshot": id, "until_snapshot": id, "snapshots": {snapshot id: {"checked": n, "hashed": n,
+                 "missing": [sha1 hex], "corrupt": [sha1 hex]}}}
+        """
+        since_snapshot = int(self.__db_get_config("last_verified_snapshot", 0)) if incremental else 0
+        until_snapshot = self.__db_get_current_snapshot_id()
+        logger.debug(f"Verifying objects of snapshots {since_snapshot + 1} to {until_snapshot}...")
+
+        snapshots: typing.Dict[int, typing.Dict[str, typing.Any]] = dict()
+
+        def report(snapshot_id: int) -> typing.Dict[str, typing.Any]:
+            return snapshots.setdefault(snapshot_id, {"checked": 0, "hashed": 0, "missing": [], "corrupt": []})
+
+        rng = random.Random()
+        last_sha1 = b""
+        with ObjectDirectory(os.path.join(self.git_directory, "objects")) as objects, \
+                GitObjectHashReader(self.repo) as reader:
+            while True:
                 self.db_cursor.execute(r"""
-                    INSERT INTO "objects_sha1" ("sha1", "first_appearance_in_snapshots") VALUES (?, ?);
-                """, (sha1_hash, snapshot_id))
-                new_object_count += 1
-            except sqlite3.IntegrityError:
-                pass
+                    SELECT "sha1", "first_appearance_in_snapshots" FROM "objects_sha1"
+                    WHERE "sha1" > ? AND "first_appearance_in_snapshots" > ? AND "first_appearance_in_snapshots" <= ?
+                    ORDER BY "sha1" LIMIT ?;
+                """, (last_sha1, since_snapshot, until_snapshot, self.object_details_batch_size))
+                rows = self.db_cursor.fetchall()
+                if len(rows) == 0:
+                    break
+                last_sha1 = rows[-1][0]
 
-        logger.debug(f"{new_object_count}/{object_count} new objects saved.")
+                to_hash: typing.List[typing.Tuple[str, int]] = []
+                for sha1, snapshot_id in rows:
+                    r = report(snapshot_id)
+                    r["checked"] += 1
+                    if sha1 not in objects:
+                        r["missing"].append(sha1.hex())
+                    elif hash_sample_rate >= 1 or (hash_sample_rate > 0 and rng.random() < hash_sample_rate):
+                        to_hash.append((sha1.hex(), snapshot_id))
 
-        # commit
+                names = [name for name, _ in to_hash]
+                for (name, snapshot_id), (_, _, _, actual) in zip(to_hash, reader.query(names)):
+                    r = report(snapshot_id)
+                    r["hashed"] += 1
+                    if actual != name:
+                        r["corrupt"].append(name)
+
+        if not any(len(r["missing"]) > 0 or len(r["corrupt"]) > 0 for r in snapshots.values()):
+            self.__db_set_config("last_verified_snapshot", until_snapshot)
+            self.__db_set_config("last_verified_at", get_timestamp())
+            self.db_connection.commit()
+
+        return {
+            "since_snapshot": since_snapshot,
+            "until_snapshot": until_snapshot,
+            "snapshots": snapshots,
+        }
+
+    def save_metrics(self) -> None:
+        """
+        Append the phase timings collected in this run to the per-repo history.
+        :return: None
+        """
+        snapshot_id = None if self.up_to_date else self.__db_get_current_snapshot_id()
+        self.db_cursor.executemany(r"""
+            INSERT INTO "phase_timings" ("run_timestamp", "snapshot_id", "phase", "seconds") VALUES (?, ?, ?, ?);
+        """, [(self.metrics.started_at, snapshot_id, p.phase, p.seconds) for p in self.metrics.phases])
+        self.db_cursor.executemany(r"""
+            INSERT INTO "run_counters" ("run_timestamp", "name", "value") VALUES (?, ?, ?);
+        """, [(self.metrics.started_at, name, value) for name, value in self.metrics.counters.items()])
         self.db_connection.commit()
 
-    def submodules(self):
-        return [x.url for x in self.repo.submodules]
+    @staticmethod
+    def __parse_gitmodules(content: bytes) -> typing.List[str]:
+        """
+        Extract the submodule URLs from a `.gitmodules` file.
+        :param content: the file content
+        :return: the URLs as written in the file
+        """
+        f = io.BytesIO(content)
+        f.name = ".gitmodules"
+        try:
+            parser = git.config.GitConfigParser(f, read_only=True)
+            parser.read()
+            return [
+                str(parser.get_value(s, "url")) for s in parser.sections()
+                if s.startswith("submodule ") and parser.has_option(s, "url")
+            ]
+        except Exception:
+            # a broken .gitmodules in some old commit shouldn't stop the backup
+            logger.debug("Unable to parse a .gitmodules file", exc_info=True)
+            return []
+
+    def submodules(self) -> typing.List[str]:
+        """
+        Find the submodules used on any branch or tag, not only HEAD. Every `.gitmodules` blob is only parsed once,
+        so refs that didn't change it cost a single batched lookup.
+        :return: the absolute URLs of the submodules
+        """
+        revisions = sorted(set(f"{commit}:.gitmodules" for commit in self.__get_local_refs().values()))
+        with GitObjectNameResolver(self.repo) as resolver:
+            blobs = set(blob for _, blob in resolver.query(revisions) if blob is not None)
+
+        urls: typing.Dict[str, typing.List[str]] = dict()
+        for blob in blobs:
+            self.db_cursor.execute(r"""SELECT "urls" FROM "gitmodules_cache" WHERE "blob_sha1" = ?;""", (blob,))
+            row = self.db_cursor.fetchone()
+            if row is not None:
+                urls[blob] = json.loads(row[0])
+
+        new_blobs = sorted(blobs - urls.keys())
+        if len(new_blobs) > 0:
+            logger.debug(f"Parsing {len(new_blobs)} new .gitmodules files...")
+            with GitObjectContentReader(self.repo) as reader:
+                for blob, _, _, content in reader.query(new_blobs):
+                    urls[blob] = self.__parse_gitmodules(content) if content is not None else []
+            self.db_cursor.executemany(r"""
+                INSERT OR REPLACE INTO "gitmodules_cache" ("blob_sha1", "urls") VALUES (?, ?);
+            """, [(blob, json.dumps(urls[blob])) for blob in new_blobs])
+            self.db_connection.commit()
+
+        ret = set()
+        for blob_urls in urls.values():
+            for url in blob_urls:
+                ret.add(resolve_submodule_url(self.upstream_url, url))
+        return sorted(ret)
+
+    def release(self) -> None:
+        """
+        Stop the git processes held open by GitPython and drop its idle pack mmaps, e.g. before the repo sits idle
+        for a while. The repo is still usable; they are started again on demand. The database connection stays open.
+        :return: None
+        """
+        self.repo.close()
+
+    def close(self) -> None:
+        """
+        Release the database connection and the git processes held open by GitPython.
+        :return: None
+        """
+        self.db_connection.close()
+        self.repo.close()
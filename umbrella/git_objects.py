@@ -0,0 +1,203 @@
+import logging
+import hashlib
+import subprocess
+import threading
+import typing
+import git
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+ObjectInfo = typing.Tuple[str, typing.Union[str, None], typing.Union[int, None]]
+
+
+class GitObjectInfoReader:
+    """
+    Query object type and size through one long-lived `git cat-file --batch-check` process,
+    instead of starting a new `git cat-file` for every single object.
+    """
+    batch_option: str = "--batch-check"
+    batch_format: str = "%(objectname) %(objecttype) %(objectsize)"
+
+    def __init__(self: 'GitObjectInfoReader', repo: git.Repo) -> None:
+        self.repo: git.Repo = repo
+        self.process = None
+
+    def __enter__(self: 'GitObjectInfoReader') -> 'GitObjectInfoReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __start(self) -> None:
+        if self.process is not None:
+            return
+        logger.debug(f"Starting git cat-file {self.batch_option}...")
+        self.process = self.repo.git.cat_file(
+            f"{self.batch_option}={self.batch_format}",
+            "--allow-unknown-type",
+            as_process=True,
+            istream=subprocess.PIPE,
+        )
+
+    def close(self) -> None:
+        """
+        Stop the background git process.
+        :return: None
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.proc.stdin.close()
+            self.process.wait()
+        except (OSError, git.exc.GitCommandError):
+            logger.debug(f"git cat-file {self.batch_option} exited abnormally")
+        self.process = None
+
+    def _read_header(self, stdout: typing.BinaryIO) -> typing.Union[typing.List[str], None]:
+        """
+        Read the line describing one object from the git process.
+        :param stdout: stdout of the git process
+        :return: the fields of batch_format, or None for missing objects
+        """
+        line = stdout.readline()
+        if not line:
+            raise git.exc.GitCommandError(["git", "cat-file", self.batch_option], self.process.proc.poll())
+        fields = line.decode("utf-8").rstrip("\n").split(" ")
+        if len(fields) == 3:
+            return fields
+        # "<name> missing" or "<name> ambiguous"
+        return None
+
+    def _read_object(self, stdout: typing.BinaryIO, name: str) -> ObjectInfo:
+        """
+        Read the answer about one object from the git process.
+        :param stdout: stdout of the git process
+        :param name: the object name asked for
+        :return: (name, type, size); type and size are None for missing objects
+        """
+        fields = self._read_header(stdout)
+        if fields is None:
+            return name, None, None
+        return name, fields[1], int(fields[2])
+
+    def query(self, names: typing.Sequence[str]) -> typing.Iterator[ObjectInfo]:
+        """
+        Look up a batch of objects. The names are written from a helper thread while the results are read back, so
+        a batch of any size can't deadlock on full pipes.
+        :param names: object names, usually hex SHA-1 strings; anything `git rev-parse` understands works
+        :return: (name, type, size) for every input in the same order; type and size are None for missing objects
+        """
+        if len(names) == 0:
+            return
+        self.__start()
+        stdin = self.process.proc.stdin
+        stdout = self.process.proc.stdout
+
+        def feed() -> None:
+            try:
+                stdin.write(b"".join(f"{n}\n".encode("utf-8") for n in names))
+                stdin.flush()
+            except (BrokenPipeError, ValueError):
+                # the reader side reports the failure
+                pass
+
+        writer = threading.Thread(target=feed, name="umbrella-cat-file-feeder", daemon=True)
+        writer.start()
+        finished = False
+        try:
+            for i, n in enumerate(names):
+                result = self._read_object(stdout, n)
+                # consumers like zip() never ask for the item after the last one
+                finished = i == len(names) - 1
+                yield result
+        finally:
+            if not finished:
+                # the caller gave up half way; the process state is unknown now, so throw it away
+                self.process.proc.kill()
+                self.close()
+            writer.join()
+
+
+class GitObjectHashReader(GitObjectInfoReader):
+    """
+    Read whole objects through one `git cat-file --batch` process and hash them again, to find out whether the stored
+    data still matches the object name. The content is streamed into the hash, never held in memory as a whole.
+    """
+    batch_option: str = "--batch"
+    read_chunk_size: int = 1024 * 1024
+
+    def _read_object(self, stdout: typing.BinaryIO, name: str) -> ObjectInfo:
+        """
+        :return: (name, type, size, the sha1 of the content as read back); the last three are None for missing objects
+        """
+        name, object_type, object_size = super()._read_object(stdout, name)
+        if object_type is None:
+            return name, None, None, None
+
+        # https://git-scm.com/book/en/v2/Git-Internals-Git-Objects#_object_storage
+        h = hashlib.sha1(f"{object_type} {object_size}\0".encode("utf-8"))
+        remaining = object_size
+        while remaining > 0:
+            chunk = stdout.read(min(remaining, self.read_chunk_size))
+            if not chunk:
+                raise git.exc.GitCommandError(["git", "cat-file", self.batch_option], self.process.proc.poll())
+            h.update(chunk)
+            remaining -= len(chunk)
+        # every object is followed by a newline
+        stdout.read(1)
+        return name, object_type, object_size, h.hexdigest()
+
+    def query(self, names: typing.Sequence[str]) -> typing.Iterator[ObjectInfo]:
+        """
+        :return: (name, type, size, the sha1 of the content as read back) for every input in the same order; the last
+                 three are None for missing objects, and for objects git fails to read
+        """
+        start = 0
+        while start < len(names):
+            done = start
+            try:
+                for result in super().query(names[start:]):
+                    done += 1
+                    yield result
+            except git.exc.GitCommandError:
+                # git exits on the first object it can't read (e.g. a corrupt loose object); report that one and
+                # carry on with the rest in a new process
+                logger.warning(f"git cat-file {self.batch_option} failed to read {names[done]}")
+                yield names[done], None, None, None
+                done += 1
+            start = done
+
+
+class GitObjectContentReader(GitObjectInfoReader):
+    """
+    Read whole objects through one `git cat-file --batch` process. The content is held in memory, so this is meant
+    for small objects like `.gitmodules` blobs.
+    """
+    batch_option: str = "--batch"
+
+    def _read_object(self, stdout: typing.BinaryIO, name: str) -> ObjectInfo:
+        """
+        :return: (name, type, size, content); the last three are None for missing objects
+        """
+        name, object_type, object_size = super()._read_object(stdout, name)
+        if object_type is None:
+            return name, None, None, None
+        content = stdout.read(object_size)
+        if len(content) != object_size:
+            raise git.exc.GitCommandError(["git", "cat-file", self.batch_option], self.process.proc.poll())
+        # every object is followed by a newline
+        stdout.read(1)
+        return name, object_type, object_size, content
+
+
+class GitObjectNameResolver(GitObjectInfoReader):
+    """
+    Resolve revisions to object names in batch, e.g. `<commit>:<path>` to the blob of a file in that commit.
+    """
+
+    def _read_object(self, stdout: typing.BinaryIO, name: str) -> typing.Tuple[str, typing.Union[str, None]]:
+        """
+        :return: (revision, hex sha1); the sha1 is None if the revision doesn't exist
+        """
+        fields = self._read_header(stdout)
+        return name, None if fields is None else fields[0]
@@ -0,0 +1,223 @@
+import logging
+import os
+import sys
+import time
+import json
+import threading
+import contextlib
+import typing
+import git
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_bytes() -> typing.Union[int, None]:
+    """
+    Get the peak resident set size so far, of this process or of any git child process, whichever is larger.
+    The kernel only tracks the peak over the whole lifetime of a process, so this is only meaningful for a whole run.
+    :return: bytes, or None if unsupported on this platform
+    """
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # macOS reports bytes, everything else kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_directory_size(path: typing.AnyStr, recursive: bool = False) -> int:
+    """
+    Sum up the size of the files in a directory. Symbolic links are not followed.
+    :param path: the directory
+    :param recursive: include the subdirectories
+    :return: bytes; 0 if the directory does not exist
+    """
+    if not os.path.isdir(path):
+        return 0
+    total = 0
+    for e in os.scandir(path):
+        if e.is_file(follow_symlinks=False):
+            total += e.stat(follow_symlinks=False).st_size
+        elif recursive and e.is_dir(follow_symlinks=False):
+            total += get_directory_size(e.path, recursive=True)
+    return total
+
+
+def get_object_store_bytes(repo: git.Repo) -> int:
+    """
+    Get the disk usage of the objects of a repo, loose and packed, from `git count-objects -v`. Objects borrowed
+    through alternates are not included.
+    :param repo: the repo
+    :return: bytes
+    """
+    counts = dict(line.split(": ", 1) for line in repo.git.count_objects("-v").splitlines())
+    # both are in KiB
+    return (int(counts.get("size", 0)) + int(counts.get("size-pack", 0))) * 1024
+
+
+class PhaseRecord(typing.NamedTuple):
+    phase: str
+    seconds: float
+
+
+class RepoMetrics:
+    """
+    Timings and counters of one repo in one run.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url: str = url
+        self.phases: typing.List[PhaseRecord] = []
+        self.counters: typing.Dict[str, int] = dict()
+        self.success: bool = True
+        self.started_at: float = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        """
+        Time a block of work. The record is kept even if the block raises.
+        :param name: phase name, e.g. "fetch"
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append(PhaseRecord(name, time.perf_counter() - start))
+
+    def count(self, name: str, value: int) -> None:
+        """
+        Add to a counter, e.g. "bytes_fetched" or "objects".
+        :param name: counter name
+        :param value: amount to add
+        :return: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    @property
+    def seconds(self) -> float:
+        return sum(p.seconds for p in self.phases)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "url": self.url,
+            "success": self.success,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "phases": [p._asdict() for p in self.phases],
+            "counters": self.counters,
+        }
+
+
+def _prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class RunMetrics:
+    """
+    Collects the RepoMetrics of a whole run and exports a summary.
+    """
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.repos: typing.List[RepoMetrics] = []
+        self.started_at: float = time.time()
+        self.finished_at: typing.Union[float, None] = None
+
+    def new_repo(self, url: str) -> RepoMetrics:
+        """
+        Start collecting the metrics of a repo. Thread safe.
+        :param url: repo URL
+        :return: the RepoMetrics to fill in
+        """
+        m = RepoMetrics(url)
+        self.add_repo(m)
+        return m
+
+    def add_repo(self, m: RepoMetrics, replace: bool = False) -> None:
+        """
+        Add the metrics of a repo. Thread safe.
+        :param m: the metrics
+        :param replace: drop the metrics collected before for the same repo, e.g. when a daemon backs it up again
+        :return: None
+        """
+        with self.lock:
+            if replace:
+                self.repos = [r for r in self.repos if r.url != m.url]
+            self.repos.append(m)
+
+    def finish(self) -> None:
+        self.finished_at = time.time()
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            repos = list(self.repos)
+        return {
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": (self.finished_at or time.time()) - self.started_at,
+            "repos_total": len(repos),
+            "repos_failed": sum(1 for r in repos if not r.success),
+            "peak_rss_bytes": get_peak_rss_bytes(),
+            "repos": [r.to_dict() for r in repos],
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Render the run in the Prometheus text exposition format, e.g. for node_exporter's textfile collector.
+        https://prometheus.io/docs/instrumenting/exposition_formats/
+        """
+        d = self.to_dict()
+        lines: typing.List[str] = []
+
+        def metric(name: str, help_text: str, samples: typing.Iterable[typing.Tuple[typing.Dict[str, str], typing.Any]]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ",".join(f'{k}="{_prometheus_label(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric("umbrella_run_start_timestamp_seconds", "When the last run started.", [({}, d["started_at"])])
+        metric("umbrella_run_duration_seconds", "Wall clock time of the last run.", [({}, d["seconds"])])
+        metric("umbrella_run_repos", "Repos processed in the last run.", [({}, d["repos_total"])])
+        metric("umbrella_run_repos_failed", "Repos that failed in the last run.", [({}, d["repos_failed"])])
+        metric("umbrella_run_peak_rss_bytes", "Peak RSS of umbrella or any git process.", [({}, d["peak_rss_bytes"])])
+        metric("umbrella_repo_success", "Whether the repo was backed up successfully.", [
+            ({"repo": r["url"]}, int(r["success"])) for r in d["repos"]
+        ])
+        metric("umbrella_repo_phase_duration_seconds", "Wall clock time of every phase of a repo backup.", [
+            ({"repo": r["url"], "phase": p["phase"]}, p["seconds"]) for r in d["repos"] for p in r["phases"]
+        ])
+        counter_names = sorted(set(c for r in d["repos"] for c in r["counters"]))
+        for c in counter_names:
+            metric(f"umbrella_repo_{c}", f"Value of the {c} counter of a repo backup.", [
+                ({"repo": r["url"]}, r["counters"][c]) for r in d["repos"] if c in r["counters"]
+            ])
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_file: typing.Union[str, None], prometheus_file: typing.Union[str, None]) -> None:
+        """
+        Write the run summary. Files are replaced atomically, so collectors never see half-written content.
+        :param json_file: path of the JSON summary, or None to skip
+        :param prometheus_file: path of the Prometheus textfile, or None to skip
+        :return: None
+        """
+        for path, content in ((json_file, lambda: json.dumps(self.to_dict(), indent=2) + "\n"),
+                              (prometheus_file, self.to_prometheus)):
+            if not path:
+                continue
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(content())
+            os.replace(temp_path, path)
+            logger.debug(f"Metrics written to {path}")
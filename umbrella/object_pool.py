@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import typing
+import git
+from .pack_index import write_keep_files
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# content of the .keep files of the pool packs
+POOL_PACK_KEEP_MARKER: str = "umbrella pool\n"
+
+# fetches into the same pool are serialized, so the forks of one network don't download the same objects at once
+_pool_locks: typing.Dict[str, threading.Lock] = dict()
+_pool_locks_lock: threading.Lock = threading.Lock()
+
+
+def _get_pool_lock(path: str) -> threading.Lock:
+    with _pool_locks_lock:
+        return _pool_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class ObjectPool:
+    """
+    A bare repo holding the objects of a group of repos that share history, e.g. a repo and its forks. The member
+    repos borrow its objects through `objects/info/alternates`; every member's refs are kept in the pool under
+    `refs/forks/<member key>/`, so that the objects stay reachable and fetches can negotiate against all of them.
+    https://git-scm.com/docs/gitrepository-layout#Documentation/gitrepository-layout.txt-objectsinfoalternates
+    """
+
+    def __init__(self: 'ObjectPool', path: typing.AnyStr) -> None:
+        self.path: str = str(path)
+        self.objects_directory: str = os.path.join(self.path, "objects")
+        self.lock: threading.Lock = _get_pool_lock(self.path)
+
+        with self.lock:
+            if os.path.isfile(os.path.join(self.path, "HEAD")):
+                self.repo: git.Repo = git.Repo(self.path)
+            else:
+                logger.debug(f"Initializing object pool at {self.path}...")
+                os.makedirs(self.path, exist_ok=True)
+                self.repo = git.Repo.init(self.path, bare=True)
+                # objects of one member may only be reachable from another member's refs; never let git drop any
+                self.repo.git.config('gc.auto', '0')
+                self.repo.git.config('gc.pruneExpire', 'never')
+                self.repo.git.config('gc.reflogExpire', 'never')
+                self.repo.git.config('core.autocrlf', 'false')
+
+    def link(self, objects_directory: typing.AnyStr) -> None:
+        """
+        Let a member repo borrow the objects of this pool.
+        :param objects_directory: the `objects` directory of the member repo
+        :return: None
+        """
+        # a relative path keeps working if the whole backup root is moved
+        pool_objects = os.path.relpath(self.objects_directory, objects_directory)
+        alternates_file = os.path.join(objects_directory, "info", "alternates")
+        if os.path.isfile(alternates_file):
+            with open(alternates_file, "r") as f:
+                if pool_objects in (line.strip() for line in f):
+                    return
+        os.makedirs(os.path.dirname(alternates_file), exist_ok=True)
+        with open(alternates_file, "a") as f:
+            f.write(pool_objects + "\n")
+
+    def fetch(self, url: str, member_key: str, env: typing.Dict[str, str]) -> None:
+        """
+        Fetch the refs and objects of a member repo into the pool. Only the objects no other member has are
+        transferred; the member's own fetch afterwards finds all the objects locally.
+        :param url: upstream URL of the member repo
+        :param member_key: unique name of the member repo within the pool
+        :param env: environment variables for git (authentication)
+        :return: None
+        """
+        with self.lock:
+            self.repo.git.fetch(url, f"+refs/*:refs/forks/{member_key}/*", "--prune", "--no-tags", env=env)
+            write_keep_files(self.objects_directory, POOL_PACK_KEEP_MARKER)
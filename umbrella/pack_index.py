@@ -0,0 +1,211 @@
+import logging
+import os
+import mmap
+import struct
+import typing
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# https://git-scm.com/docs/pack-format#_version_2_pack_idx_files_support_packs_larger_than_4_gib_and
+PACK_IDX_V2_MAGIC: bytes = b"\377tOc"
+PACK_IDX_FANOUT_OFFSET: int = 8
+PACK_IDX_SHA1_TABLE_OFFSET: int = PACK_IDX_FANOUT_OFFSET + 256 * 4
+SHA1_SIZE: int = 20
+
+
+class PackIndex:
+    """
+    Read-only view of a version 2 pack index (`objects/pack/*.idx`) through mmap. Nothing is copied until an object
+    name is actually handed out.
+    """
+
+    def __init__(self: 'PackIndex', path: typing.AnyStr) -> None:
+        self.path: str = str(path)
+        with open(self.path, "rb") as f:
+            self.mmap: mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view: memoryview = memoryview(self.mmap)
+
+        if self.view[0:4] != PACK_IDX_V2_MAGIC or struct.unpack_from(">I", self.view, 4)[0] != 2:
+            self.close()
+            raise ValueError(f"{self.path} is not a version 2 pack index")
+
+        self.fanout: typing.Tuple[int, ...] = struct.unpack_from(">256I", self.view, PACK_IDX_FANOUT_OFFSET)
+        self.object_count: int = self.fanout[255]
+        if len(self.view) < PACK_IDX_SHA1_TABLE_OFFSET + self.object_count * SHA1_SIZE:
+            self.close()
+            raise ValueError(f"{self.path} is truncated")
+
+    def __enter__(self: 'PackIndex') -> 'PackIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.object_count
+
+    def close(self) -> None:
+        """
+        Unmap the file. Views returned by sha1_table() must not be used afterwards.
+        :return: None
+        """
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def sha1_table(self) -> memoryview:
+        """
+        Get the sorted table of all the object names, as one contiguous buffer of 20-byte entries.
+        :return: a memoryview into the mapped file
+        """
+        return self.view[PACK_IDX_SHA1_TABLE_OFFSET:PACK_IDX_SHA1_TABLE_OFFSET + self.object_count * SHA1_SIZE]
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        table = self.sha1_table()
+        try:
+            for offset in range(0, len(table), SHA1_SIZE):
+                yield table[offset:offset + SHA1_SIZE].tobytes()
+        finally:
+            table.release()
+
+    def __contains__(self, sha1: bytes) -> bool:
+        """
+        Binary search for an object, narrowed down by the fanout table first.
+        :param sha1: the bytes object of the sha1
+        :return: whether the object is in this pack
+        """
+        first_byte = sha1[0]
+        low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self.fanout[first_byte]
+        while low < high:
+            mid = (low + high) // 2
+            offset = PACK_IDX_SHA1_TABLE_OFFSET + mid * SHA1_SIZE
+            current = self.view[offset:offset + SHA1_SIZE].tobytes()
+            if current == sha1:
+                return True
+            if current < sha1:
+                low = mid + 1
+            else:
+                high = mid
+        return False
+
+
+def list_pack_indexes(objects_directory: typing.AnyStr) -> typing.List[str]:
+    """
+    Find all the pack index files of a repo.
+    :param objects_directory: the `objects` directory of the repo
+    :return: full paths of the `*.idx` files
+    """
+    packs_dir = os.path.join(objects_directory, "pack")
+    if not os.path.isdir(packs_dir):
+        return []
+    return sorted(
+        os.path.join(packs_dir, f) for f in os.listdir(packs_dir) if os.path.splitext(f)[-1] == ".idx"
+    )
+
+
+def write_keep_files(objects_directory: typing.AnyStr, marker: str) -> int:
+    """
+    Mark every pack that has no .keep file yet with one, so that no git command (gc, repack) ever touches it.
+    :param objects_directory: the `objects` directory of the repo
+    :param marker: content of the new .keep files
+    :return: number of packs marked
+    """
+    count = 0
+    for idx_file in list_pack_indexes(objects_directory):
+        keep_file = os.path.splitext(idx_file)[0] + ".keep"
+        if not os.path.exists(keep_file):
+            with open(keep_file, "w") as f:
+                f.write(marker)
+            count += 1
+    return count
+
+
+def list_alternates(objects_directory: typing.AnyStr) -> typing.List[str]:
+    """
+    Read `objects/info/alternates`: the object directories of other repos this repo borrows objects from.
+    https://git-scm.com/docs/gitrepository-layout#Documentation/gitrepository-layout.txt-objectsinfoalternates
+    :param objects_directory: the `objects` directory of the repo
+    :return: full paths of the alternate object directories
+    """
+    alternates_file = os.path.join(objects_directory, "info", "alternates")
+    if not os.path.isfile(alternates_file):
+        return []
+    ret = []
+    with open(alternates_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            # relative paths are relative to the objects directory
+            ret.append(os.path.normpath(os.path.join(objects_directory, line)))
+    return ret
+
+
+def iter_loose_object_sha1s(objects_directory: typing.AnyStr) -> typing.Iterator[bytes]:
+    """
+    Enumerate the loose objects of a repo by their file names.
+    :param objects_directory: the `objects` directory of the repo
+    :return: the bytes objects of the sha1s
+    """
+    for prefix in os.scandir(objects_directory):
+        if len(prefix.name) != 2 or not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            # skip temporary files like `tmp_obj_*`
+            if len(entry.name) != 2 * SHA1_SIZE - 2:
+                continue
+            try:
+                yield bytes.fromhex(prefix.name + entry.name)
+            except ValueError:
+                continue
+
+
+def iter_object_sha1s(objects_directory: typing.AnyStr) -> typing.Iterator[bytes]:
+    """
+    Enumerate every object in a repo, packed or loose, without unpacking anything.
+    An object that is stored more than once is returned more than once.
+    :param objects_directory: the `objects` directory of the repo
+    :return: the bytes objects of the sha1s
+    """
+    for idx_file in list_pack_indexes(objects_directory):
+        logger.debug(f"Reading pack index {idx_file}...")
+        with PackIndex(idx_file) as idx:
+            yield from idx
+    yield from iter_loose_object_sha1s(objects_directory)
+
+
+class ObjectDirectory:
+    """
+    Answers whether an object is present in a repo, by looking at the pack indexes and the loose object files
+    directly. Nothing is read or decompressed, so this is much cheaper than `git cat-file -e` or `git fsck`.
+    Objects borrowed through alternates count as present.
+    """
+
+    def __init__(self: 'ObjectDirectory', objects_directory: typing.AnyStr) -> None:
+        self.objects_directory: str = str(objects_directory)
+        self.directories: typing.List[str] = [self.objects_directory] + list_alternates(self.objects_directory)
+        self.packs: typing.List[PackIndex] = [
+            PackIndex(f) for d in self.directories for f in list_pack_indexes(d)
+        ]
+
+    def __enter__(self: 'ObjectDirectory') -> 'ObjectDirectory':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for idx in self.packs:
+            idx.close()
+        self.packs = []
+
+    def __contains__(self, sha1: bytes) -> bool:
+        for idx in self.packs:
+            if sha1 in idx:
+                return True
+        h = sha1.hex()
+        return any(os.path.isfile(os.path.join(d, h[0:2], h[2:])) for d in self.directories)
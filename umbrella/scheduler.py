@@ -0,0 +1,182 @@
+import logging
+import threading
+import collections
+import heapq
+import itertools
+import typing
+from .utils import get_url_host
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class _Descending:
+    """
+    Reverses the order of a sort key, so that the heap pops the highest priority first.
+    """
+    __slots__ = ("key",)
+
+    def __init__(self, key: typing.Any) -> None:
+        self.key = key
+
+    def __lt__(self, other: '_Descending') -> bool:
+        return self.key > other.key
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Descending) and self.key == other.key
+
+
+class BackupScheduler:
+    """
+    A worker pool that runs backup jobs in parallel. Jobs are grouped by their upstream host so that the number of
+    concurrent jobs against a single server can be capped. Of the jobs that may start, the one with the highest
+    priority goes first; given the expected durations, the longest jobs start early and don't stretch the run at
+    its end. Hosts with equal priorities are served round-robin.
+    """
+
+    def __init__(
+            self: 'BackupScheduler',
+            worker: typing.Callable[[str], typing.Optional[typing.Iterable[str]]],
+            jobs: int = 1,
+            max_jobs_per_host: int = 0,
+            max_pending: int = 0,
+            priority: typing.Union[typing.Callable[[str], typing.Any], None] = None,
+    ) -> None:
+        """
+        :param worker: the function to run for every repo URL; it may return more URLs (e.g. submodules) to be queued
+        :param jobs: the number of worker threads
+        :param max_jobs_per_host: the max number of concurrent jobs against the same host; 0 means unlimited
+        :param max_pending: blocking submissions wait while this many jobs are queued; 0 means unlimited
+        :param priority: gives the sort key of a repo URL, e.g. its expected duration; higher runs first. None to run
+                         the jobs of every host in the order they were submitted
+        """
+        self.worker = worker
+        self.priority = priority
+        self.jobs: int = max(1, int(jobs))
+        self.max_jobs_per_host: int = max(0, int(max_jobs_per_host))
+        self.max_pending: int = max(0, int(max_pending))
+
+        self.lock: threading.Condition = threading.Condition()
+        # host => heap of (negated priority, submission order, url)
+        self.pending: typing.Dict[str, typing.List[typing.Tuple[typing.Any, int, str]]] = collections.OrderedDict()
+        self.submission_counter: typing.Iterator[int] = itertools.count()
+        self.running_per_host: typing.Dict[str, int] = collections.defaultdict(int)
+        self.seen: typing.Set[str] = set()
+        self.pending_count: int = 0
+        self.running_count: int = 0
+        self.started_count: int = 0
+        self.closed: bool = False
+
+    def submit(self, url: str, block: bool = False) -> bool:
+        """
+        Add a repo to the queue. Repos that have already been queued (or finished) in this run are ignored.
+        Thread safe. Workers may submit too, but must not block, or they could end up waiting for themselves.
+        :param url: repo URL
+        :param block: wait until the queue is shorter than max_pending
+        :return: True if the repo is newly queued
+        """
+        with self.lock:
+            while block and self.max_pending and self.pending_count >= self.max_pending and url not in self.seen:
+                self.lock.wait()
+            if url in self.seen:
+                return False
+            self.seen.add(url)
+            key = _Descending(self.priority(url) if self.priority is not None else 0)
+            heapq.heappush(self.pending.setdefault(get_url_host(url), []), (key, next(self.submission_counter), url))
+            self.pending_count += 1
+            self.lock.notify_all()
+            return True
+
+    def mark_done(self, urls: typing.Iterable[str]) -> None:
+        """
+        Treat repos as backed up already, e.g. by an earlier attempt of a resumed run; submitting them does nothing.
+        :param urls: repo URLs
+        :return: None
+        """
+        with self.lock:
+            for url in urls:
+                if url not in self.seen:
+                    self.seen.add(url)
+                    self.started_count += 1
+
+    def close(self) -> None:
+        """
+        Declare that no more repos will be submitted from outside the workers. The workers exit when the queue drains.
+        :return: None
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def __take(self) -> typing.Union[typing.Tuple[str, str], None]:
+        """
+        Pick the next repo whose host still has free slots. Must be called with the lock held.
+        :return: (host, url), or None if nothing is runnable right now
+        """
+        best_host = None
+        for host, q in self.pending.items():
+            if len(q) == 0:
+                continue
+            if self.max_jobs_per_host and host and self.running_per_host[host] >= self.max_jobs_per_host:
+                continue
+            # on a tie the host that waited longest wins
+            if best_host is None or q[0][0] < self.pending[best_host][0][0]:
+                best_host = host
+        if best_host is None:
+            return None
+        _, _, url = heapq.heappop(self.pending[best_host])
+        self.pending_count -= 1
+        # rotate the host to the end so that hosts are served round-robin
+        self.pending.move_to_end(best_host)
+        return best_host, url
+
+    def __worker_loop(self) -> None:
+        while True:
+            with self.lock:
+                while True:
+                    job = self.__take()
+                    if job is not None:
+                        break
+                    if self.closed and self.running_count == 0 and self.pending_count == 0:
+                        self.lock.notify_all()
+                        return
+                    self.lock.wait()
+                host, url = job
+                # a blocked submitter may have room now
+                self.lock.notify_all()
+                self.running_count += 1
+                self.running_per_host[host] += 1
+                self.started_count += 1
+                logger.info(f"{self.started_count}/{len(self.seen)} backing up {url} ...")
+
+            try:
+                discovered = self.worker(url)
+                for d in discovered or []:
+                    if self.submit(d):
+                        logger.info(f"{d} appended to the queue")
+                    else:
+                        logger.debug(f"{d} already queued or backed up")
+            except Exception:
+                logger.exception(f"{url}: backup failed")
+            finally:
+                with self.lock:
+                    self.running_count -= 1
+                    self.running_per_host[host] -= 1
+                    self.lock.notify_all()
+
+    def run(self) -> None:
+        """
+        Run all the queued jobs and block until every job (including the ones discovered on the way) is finished.
+        :return: None
+        """
+        if self.jobs == 1:
+            self.__worker_loop()
+            return
+
+        threads = [
+            threading.Thread(target=self.__worker_loop, name=f"umbrella-worker-{i}", daemon=True)
+            for i in range(self.jobs)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
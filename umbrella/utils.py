@@ -2,6 +2,8 @@ from urllib.parse import urlparse, ParseResult, urlunparse, urlsplit, SplitResul
 import typing
 import datetime
 import platform
+import re
+import os
 
 
 def url_hide_sensitive(original_url: typing.AnyStr) -> str:
@@ -52,3 +54,119 @@ def dict_search(d: typing.Dict[typing.Any, typing.Any], *searches) -> typing.Any
             return None
 
     return d
+
+
+def get_url_host(url: typing.AnyStr) -> str:
+    """
+    Get the host part of a Git remote URL, used to group repos from the same upstream server.
+    Supports the usual URL forms as well as the scp-like `user@host:path` syntax.
+    :param url: The remote URL
+    :return: the lower-cased host name, or an empty string for local paths
+    """
+    u: SplitResult = urlsplit(url)
+    if u.netloc:
+        return (u.hostname or "").lower()
+    if u.scheme == "" and ":" in url and "/" not in url.split(":", maxsplit=1)[0]:
+        # scp-like syntax, e.g. git@github.com:Jamesits/umbrella.git
+        return url.split(":", maxsplit=1)[0].rsplit("@", maxsplit=1)[-1].lower()
+    return ""
+
+
+def get_object_pool_key(url: typing.AnyStr) -> str:
+    """
+    Group the repos that probably share history, e.g. a GitHub repo and its forks: same host, same repo name.
+    :param url: The remote URL
+    :return: a string usable as a file name
+    """
+    if get_url_host(url) and urlsplit(url).netloc:
+        path = urlsplit(url).path
+    else:
+        path = url.split(":", maxsplit=1)[-1] if get_url_host(url) else url
+    name = path.replace("\\", "/").rstrip("/").rsplit("/", maxsplit=1)[-1]
+    if name.lower().endswith(".git"):
+        name = name[:-4]
+    key = f"{get_url_host(url) or 'local'}_{name}".lower()
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+
+
+def resolve_submodule_url(superproject_url: typing.AnyStr, url: typing.AnyStr) -> str:
+    """
+    Resolve the URL of a submodule the way Git does: relative URLs (starting with `./` or `../`) are relative to the
+    URL of the superproject's remote.
+    https://git-scm.com/docs/git-submodule#Documentation/git-submodule.txt-add
+    :param superproject_url: remote URL of the repo containing the submodule
+    :param url: submodule URL from `.gitmodules`
+    :return: the absolute URL
+    """
+    url = url.strip()
+    if not (url.startswith("./") or url.startswith("../")):
+        return url
+
+    base = superproject_url.rstrip("/")
+    # the part that can't be removed by `..`: scheme and host, or the `host:` of scp-like URLs
+    u: SplitResult = urlsplit(base)
+    if u.scheme and base.startswith(f"{u.scheme}://"):
+        # the netloc may be empty, e.g. file:///srv/repo.git
+        prefix = f"{u.scheme}://{u.netloc}"
+        path = u.path
+    elif get_url_host(base):
+        prefix, path = base.split(":", maxsplit=1)
+        prefix += ":"
+    else:
+        prefix, path = "", base
+    components = [c for c in path.split("/") if c]
+    leading_slash = path.startswith("/")
+
+    for part in url.split("/"):
+        if part == "..":
+            if len(components) > 0:
+                components.pop()
+        elif part not in (".", ""):
+            components.append(part)
+    path = "/".join(components)
+    if leading_slash:
+        path = "/" + path
+    return prefix + path
+
+
+# git error messages of failures that may well go away on their own: network trouble and overloaded servers
+TRANSIENT_GIT_ERROR_PATTERNS: typing.List[str] = [
+    r"Could not resolve host",
+    r"Temporary failure in name resolution",
+    r"Connection (timed out|reset|refused|closed)",
+    r"Operation timed out",
+    r"Operation too slow",
+    r"The remote end hung up unexpectedly",
+    r"early EOF",
+    r"RPC failed",
+    r"returned error: 5\d\d",
+    r"HTTP/?\S* 5\d\d",
+    r"gnutls_handshake\(\) failed",
+    r"SSL_ERROR_SYSCALL",
+]
+TRANSIENT_GIT_ERROR_REGEX: typing.Pattern = re.compile("|".join(TRANSIENT_GIT_ERROR_PATTERNS), re.IGNORECASE)
+
+
+def is_transient_git_error(stderr: typing.Union[str, bytes, None]) -> bool:
+    """
+    Guess whether a failed git command is worth retrying.
+    :param stderr: what git printed to stderr
+    :return: True if the error looks like a network or server problem
+    """
+    if stderr is None:
+        return False
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode("utf-8", errors="replace")
+    return TRANSIENT_GIT_ERROR_REGEX.search(stderr) is not None
+
+
+def get_state_directory(backup_root: typing.AnyStr = ".") -> str:
+    """
+    Get (and create) the directory for umbrella's own run-wide data at the backup root, e.g. caches.
+    Per-repo data lives in the `umbrella` directory of each backup instead.
+    :param backup_root: the backup root directory
+    :return: path to the directory
+    """
+    path = os.path.join(backup_root, ".umbrella")
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -0,0 +1,51 @@
+import logging
+import os
+import typing
+import concurrent.futures
+import git
+from .git_mirror import GitMirroredRepo
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def verify_backup(storage_directory: str, hash_sample_rate: float, incremental: bool) -> typing.Dict[str, typing.Any]:
+    """
+    Verify one backup. Runs in a worker process.
+    :param storage_directory: the backup directory of a repo
+    :param hash_sample_rate: share of the objects to hash, from 0 (none) to 1 (all)
+    :param incremental: only check the objects added since the last verification
+    :return: the report of GitMirroredRepo.verify(), or {"error": message}
+    """
+    if not os.path.isfile(os.path.join(storage_directory, "umbrella", "initialized")):
+        return {"error": "not an umbrella backup"}
+    try:
+        m = GitMirroredRepo(storage_directory, None)
+        try:
+            return m.verify(hash_sample_rate=hash_sample_rate, incremental=incremental)
+        finally:
+            m.close()
+    except (git.exc.GitError, OSError, ValueError) as ex:
+        return {"error": str(ex)}
+
+
+def verify_backups(
+        storage_directories: typing.Iterable[str],
+        hash_sample_rate: float = 0.0,
+        incremental: bool = True,
+        jobs: typing.Union[int, None] = None,
+) -> typing.Iterator[typing.Tuple[str, typing.Dict[str, typing.Any]]]:
+    """
+    Verify many backups in parallel, one process per repo at a time, so that the presence checks and the hashing of
+    different repos use all the cores.
+    :param storage_directories: the backup directories
+    :param hash_sample_rate: share of the objects to hash, from 0 (none) to 1 (all)
+    :param incremental: only check the objects added since the last verification
+    :param jobs: number of worker processes (default: number of CPUs)
+    :return: (backup directory, report) as each backup finishes
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(verify_backup, d, hash_sample_rate, incremental): d for d in storage_directories
+        }
+        for f in concurrent.futures.as_completed(futures):
+            yield futures[f], f.result()